@@ -49,6 +49,7 @@ changes the Pi(thedta)d theta into dX 1-D integral and evalueates it by trapizod
 #import Gauss_landscape as gl
 from x_means import xmean
 from Age_date import *
+from spectra_lib_utils import share, attach
 a=nu.seterr(all='ignore')
 def nested_sampling(data,N,bins,elogf=1.1,stop=10**-3):
 #main nested sampling program
@@ -78,12 +79,16 @@ def nested_sampling(data,N,bins,elogf=1.1,stop=10**-3):
     #calculate likeihood for each point and sort
     po=Pool()
     temp=[]
+    #publish once so tasks only carry the point
+    shared_data,shared_lib=share(data),share(lib_vals)
     for j in points:
         #multicore
-        po.apply_async(multi_samp,(j,data,lib_vals,metal_unq,age_unq,bins,),callback=temp.append)
+        po.apply_async(multi_samp,(j,shared_data,shared_lib,metal_unq,age_unq,bins,),callback=temp.append)
         #j=multi_samp(j,data,lib_vals,metal_unq,age_unq,bins)
     po.close()
     po.join()
+    #removes shared files
+    del shared_data,shared_lib
     points=nu.copy(nu.array(temp))
 
     index=nu.argsort(points[:,-1])
@@ -231,6 +236,8 @@ def MCMC_samp(data,points,age_unq,metal_unq,lib_vals,bins,itter=20):
 
 def multi_samp(j,data,lib_vals,metal_unq,age_unq,bins):
     #callable function for generating first iteration of points
+    #data and lib_vals can be shared
+    data,lib_vals=attach(data),attach(lib_vals)
     model=get_model_fit_opt(j[:-2],lib_vals,age_unq,metal_unq,bins) 
     model=data_match_new(data,model,bins)
     N=[]
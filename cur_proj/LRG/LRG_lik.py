@@ -2,11 +2,16 @@ import likelihood_class as lik
 import numpy as np
 import database_utils as util
 import interp_utils as interp
-from scipy.spatial import Delaunay
 from scipy.interpolate import griddata
 import itertools
 import sys
-from mpi4py import MPI as mpi
+import os
+try:
+    from mpi4py import MPI as mpi
+except ImportError:
+    # only local processes
+    mpi = None
+import multiprocessing as multi
 import scipy.stats as stats_dist
 import spectra_utils as ag
 import MC_utils as MC
@@ -18,12 +23,130 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 
 
+class Grid_Cube(object):
+    '''Dense (tau, age, metalicity, wavelength) cube of all spectra in a
+    burst database, read from the database once. The cube is saved next
+    to the database as a .npy file and memory-mapped by later loads, so
+    processes on a node share it. Missing grid points are nan.'''
+    def __init__(self, db_name, use_cache=True):
+        self.db_name = db_name
+        cube_path = db_name + '.cube.npy'
+        axes_path = db_name + '.axes.npz'
+        if not (use_cache and self._load_cache(cube_path, axes_path)):
+            self._load_db()
+            if use_cache:
+                self._save_cache(cube_path, axes_path)
+        self.param_range = [self.tau, self.age, self.metal]
+
+    def _load_cache(self, cube_path, axes_path):
+        '''Memory-maps saved cube if it and its axes are newer than the
+        database and match. Returns True if loaded'''
+        try:
+            db_time = os.path.getmtime(self.db_name)
+            if (os.path.getmtime(cube_path) < db_time or
+                os.path.getmtime(axes_path) < db_time):
+                return False
+            axes = np.load(axes_path)
+            tau, age = axes['tau'], axes['age']
+            metal, wave = axes['metalicity'], axes['wave']
+            cube = np.load(cube_path, mmap_mode='r')
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        if cube.shape != (len(tau), len(age), len(metal), len(wave)):
+            return False
+        self.tau, self.age, self.metal, self.wave = tau, age, metal, wave
+        self.cube = cube
+        return True
+
+    def _save_cache(self, cube_path, axes_path):
+        '''Saves cube and axes next to database. Written to temp files and
+        renamed, axes first, so other processes never map a partly written
+        cube or pair a new cube with old axes'''
+        temp = '.%i.tmp'%os.getpid()
+        try:
+            with open(axes_path + temp, 'wb') as out:
+                np.savez(out, tau=self.tau, age=self.age,
+                         metalicity=self.metal, wave=self.wave)
+            with open(cube_path + temp, 'wb') as out:
+                np.save(out, self.cube)
+            os.rename(axes_path + temp, axes_path)
+            os.rename(cube_path + temp, cube_path)
+        except (IOError, OSError):
+            # can't write next to db, keep in memory
+            for path in (axes_path + temp, cube_path + temp):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _load_db(self):
+        '''Reads whole table into cube with 1 query'''
+        db = util.numpy_sql(self.db_name)
+        table_name = db.execute('select * from sqlite_master').fetchall()[0][1]
+        rows = db.execute('SELECT tau, age, metalicity, spec FROM %s'%
+                          table_name).fetchall()
+        db.close()
+        params = np.asarray([row[:3] for row in rows], dtype=float)
+        self.tau, self.age, self.metal = [np.unique(params[:, i])
+                                          for i in range(3)]
+        self.wave = util.convert_array(rows[0][3])[:, 0]
+        self.cube = np.zeros((len(self.tau), len(self.age), len(self.metal),
+                              len(self.wave))) + np.nan
+        index = [np.searchsorted(grid, params[:, i]) for i, grid in
+                 enumerate([self.tau, self.age, self.metal])]
+        for i, row in enumerate(rows):
+            self.cube[index[0][i], index[1][i], index[2][i]] = \
+                util.convert_array(row[3])[:, 1]
+
+    def in_range(self, points):
+        '''(Grid_Cube, ndarray) -> ndarray(bool)
+        True for (tau, age, metalicity) points inside the grid'''
+        points = np.atleast_2d(points)
+        out = np.ones(points.shape[0], dtype=bool)
+        for i, grid in enumerate(self.param_range):
+            out &= (points[:, i] >= grid[0]) & (points[:, i] <= grid[-1])
+        return out
+
+    def interp(self, points):
+        '''(Grid_Cube, ndarray) -> ndarray
+        Trilinear interpolation of the cube at (N, 3) array of (tau, age,
+        metalicity) points. Returns (N, nwave) array, rows are inf if out
+        of the grid or next to a missing grid point.'''
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        bad = ~self.in_range(points)
+        lower, weight = [], []
+        for i, grid in enumerate(self.param_range):
+            low = np.clip(np.searchsorted(grid, points[:, i], 'right') - 1,
+                          0, max(len(grid) - 2, 0))
+            up = np.minimum(low + 1, len(grid) - 1)
+            width = grid[up] - grid[low]
+            w = np.zeros(points.shape[0])
+            w[width > 0] = ((points[width > 0, i] - grid[low][width > 0]) /
+                            width[width > 0])
+            lower.append((low, up))
+            weight.append(np.clip(w, 0, 1))
+        out = np.zeros((points.shape[0], len(self.wave)))
+        for corner in itertools.product((0, 1), repeat=3):
+            w = np.ones(points.shape[0])
+            for i, side in enumerate(corner):
+                w *= weight[i] if side else 1 - weight[i]
+            use = w > 0
+            if not np.any(use):
+                continue
+            out[use] += w[use, None] * self.cube[lower[0][corner[0]][use],
+                                                 lower[1][corner[1]][use],
+                                                 lower[2][corner[2]][use]]
+        bad |= ~np.isfinite(out).all(1)
+        out[bad] = np.inf
+        return out
+
+
 class Multi_LRG_burst(lik.Example_lik_class):
     '''Single core, LRG likelihood function'''
     def __init__(self, data, db_name='burst_dtau_10.db', have_dust=False,
-                 have_losvd=False):
+                 have_losvd=False, marginalize_norm=False):
         self.has_dust = have_dust
         self.has_losvd = have_losvd
+        # integrate out normalization instead of using best fit
+        self.marginalize_norm = marginalize_norm
         self.db_name = db_name
         #check if data is right type
         
@@ -39,16 +162,21 @@ class Multi_LRG_burst(lik.Example_lik_class):
             if self.data[i].shape[1] == 3:
                 # Propagate the uncertany
                 self.data[i][:,2] *= self.norm[i]
+        self._define_gauss()
         self.db = util.numpy_sql(db_name)
         self._table_name = self.db.execute('select * from sqlite_master').fetchall()[0][1]
         # Tell which models are avalible and how many galaxies to fit
         self.models = {'burst': data.keys()}
-        # Get param range (tau, age, metal)
-        self.param_range = []
-        for column in ['tau', 'age', 'metalicity']:
-            self.param_range.append(np.sort(np.ravel(self.db.execute(
-                'Select DISTINCT %s FROM %s'%(column,self._table_name)).fetchall())))
-        self._hull = None
+        # all spectra in memory (tau, age, metal)
+        self.cube = Grid_Cube(db_name)
+        self.param_range = self.cube.param_range
+        self._make_domain()
+        # rebinning operators for data_match
+        self._rebin_cache = {}
+        # adaptive proposals of each step size
+        self._adapt = {}
+        # MC.Random_Streams for proposals of each galaxy, None is global
+        self.streams = None
         # make resolution
         self._define_resolu()
         
@@ -58,19 +186,107 @@ class Multi_LRG_burst(lik.Example_lik_class):
         for gal in self.data:
             self.resolu[gal] = 3. * 299792.458 / self.data[gal][:,0].mean()
 
-    def _make_hull(self):
-        '''Make convex hull obj for telling if param is in range'''
-        # Make all points in param space
-        points = np.asarray([point for point in
-                             itertools.product(*self.param_range)])
-        self._hull = Delaunay(points)
+    def _define_gauss(self):
+        # likelihood kernel of each galaxy
+        self._gauss = {}
+        for gal in self.data:
+            if self.data[gal].shape[1] >= 3:
+                # Has Uncertanty
+                self._gauss[gal] = MC.Gauss_Lik(self.data[gal][:,1],
+                                                self.data[gal][:,2])
+            else:
+                self._gauss[gal] = MC.Gauss_Lik(self.data[gal][:,1])
+
+    def _make_domain(self):
+        '''Make prior domain of all parameters, in order of _columns.
+        normalization prior depends on the data so is added in
+        prior_many'''
+        self._domain = MC.Domain()
+        tau, age, metal = self.param_range
+        self._domain.uniform('tau', tau.min(), tau.ptp())
+        self._domain.normal('age', 9.65, 0.43)
+        self._domain.clip('age', upper=age.max())
+        self._domain.uniform('metalicity', metal.min(), metal.ptp())
+        # make sure norm isn't too small
+        self._domain.free('normalization')
+        self._domain.clip('normalization', lower=-10)
+        self._domain.uniform('redshift', 0, .055)
+        if self.has_dust:
+            self._domain.uniform('dust', 0, 4, 2)
+        if self.has_losvd:
+            self._domain.uniform('$\\sigma$', 0, 3.2)
+            self._domain.uniform('$V$', 0, 4)
+            self._domain.free('h3_h4', 2)
 
     def is_in_hull(self, point):
         '''Checks if a point in in the param range Retuns bool'''
-        if not isinstance(self._hull, Delaunay):
-            self._make_hull()
-        return self._hull.find_simplex(point) >= 0
+        return self.cube.in_range(np.asarray(point, dtype=float)).all()
     
+    def _columns(self):
+        '''Names of parameters in same order as initalize_param'''
+        columns = ['tau', 'age', 'metalicity', 'normalization', 'redshift']
+        if self.has_dust:
+            columns += ['$T_{bc}$', '$T_{ism}$']
+        if self.has_losvd:
+            columns += ['$\\sigma$', '$V$', '$h_3$', '$h_4$']
+        return columns
+
+    def _make_model(self, param, gal, normalize=True, spec=None):
+        '''Makes model spectra on data wavelengths of gal for a 1 row
+        DataFrame of params that is inside the grid. spec is the
+        interpolated spectra of param if already made'''
+        columns = ['tau', 'age', 'metalicity']
+        if spec is None:
+            spec = self.cube.interp(param[columns].values)
+        # age 0 so dust gives birth cloud and ism like the old dict key
+        if normalize:
+            model = ag.SpectralModel(self.cube.wave, spec, [0.])
+        else:
+            model = ag.SpectralModel(self.cube.wave, spec *
+                10**param['normalization'].iat[0], [0.])
+        # Redshift on the rest frame grid, so rebinning operators are cached
+        model.flux = ag.redshift_flux(model.wave, model.flux,
+                                      param['redshift'].iat[0])
+        # Dust
+        if self.has_dust:
+            columns = ['$T_{bc}$','$T_{ism}$']
+            model = ag.dust(param[columns].iloc[0], model)
+        # LOSVD
+        if self.has_losvd:
+            # wave range for convolution
+            wave_range = [self.data[gal][:,0].min(),
+                          self.data[gal][:,0].max()]
+            # check if resolution has been calculated
+            columns = ['$\\sigma$','$V$','$h_3$','$h_4$']
+            send_param = param[columns].iloc[0]
+            model = ag.LOSVD(model, send_param,
+                               wave_range, self.resolu[gal],
+                               self._rebin_cache)
+        #match data wavelengths with model
+        try:
+            model = ag.data_match(self.data[gal], model,
+                                  op_cache=self._rebin_cache)
+        except:
+            model = ag.data_match(self.data[gal], model, rebin=False)
+        #calculate map for normalization
+        norm = self._gauss[gal].amplitude(model.flux[0])
+        self.norm_prior[gal] = np.log10(norm)
+        if normalize:
+            model.flux[0] *= norm
+        return model.flux
+
+    def _loglik(self, flux, gal, normalize=False, log_norm=None):
+        '''Log likelyhood of each row of model flux for gal. If normalize
+        and marginalize_norm, flux is at its best fit normalization
+        (log_norm, default norm_prior) and normalization is integrated
+        out with a flat prior'''
+        if normalize and self.marginalize_norm:
+            if log_norm is None:
+                log_norm = self.norm_prior[gal]
+            return (self._gauss[gal].marginalize(flux) +
+                    np.log(10) * log_norm)
+        return self._gauss[gal](flux)
+
     def lik(self, param, bins, return_model=False, normalize=True):
         '''Calculates log likelyhood for burst model'''
         for gal in param[bins]:
@@ -78,69 +294,41 @@ class Multi_LRG_burst(lik.Example_lik_class):
             # get interp spectra
             #check if points are in range
             columns = ['tau', 'age', 'metalicity']
-            if self.is_in_hull(param[bins][gal][columns]):
-                # check if db works
-                try:
-                    self.db.execute('select * from sqlite_master').fetchall()[0][1]
-                except: #ProgrammingError:
-                    #make new database connection
-                    self.db = util.numpy_sql(self.db_name)
-                    
-                spec = tri_lin_interp(self.db,
-                    param[bins][gal][columns], self.param_range)
-            else:
+            if not self.is_in_hull(param[bins][gal][columns]):
                 if return_model:
                     yield -np.inf, gal, []
                 else:
                     yield -np.inf, gal
                 continue
-            if normalize:
-                model = {'wave':spec[:,0],0: spec[:,1]}
-            else:
-                model = {'wave':spec[:,0],
-                     0: spec[:,1] * 10**param[bins][gal]['normalization'].iat[0]}
-            # Redshift
-            model['wave'] = ag.redshift(model['wave'],
-                                        param[bins][gal]['redshift']) 
-            # Dust
-            if self.has_dust:
-                columns = ['$T_{bc}$','$T_{ism}$']
-                model = ag.dust(param[bins][gal][columns].iloc[0],
-                                model)
-        
-            # LOSVD
-            if self.has_losvd:
-                # wave range for convolution
-                wave_range = [self.data[gal][:,0].min(),
-                              self.data[gal][:,0].max()]
-                # check if resolution has been calculated
-                columns = ['$\\sigma$','$V$','$h_3$','$h_4$']
-                send_param = param[bins][gal][columns].iloc[0]
-                model = ag.LOSVD(model, send_param,
-                                   wave_range, self.resolu[gal])
-            #match data wavelengths with model
-            try:
-                model = ag.data_match(self.data[gal], model)
-            except:
-                model = ag.data_match(self.data[gal], model, rebin=False)
-            #calculate map for normalization
-            norm = ag.normalize(self.data[gal], model[0])
-            self.norm_prior[gal] = np.log10(norm)
-            if normalize:
-                model[0] *= norm
+            model = self._make_model(param[bins][gal], gal, normalize)
             # Calc liklihood
-            if self.data[gal].shape[1] >= 3:
-                # Has Uncertanty
-                out_lik = stats_dist.norm.logpdf(
-                self.data[gal][:,1], model[0], self.data[gal][:,2])
-            else:
-                #no uncertanty or bad entry
-                out_lik = stats_dist.norm.logpdf(
-                    self.data[gal][:,1], model[0])
+            out_lik = self._loglik(model[0], gal, normalize)
             if return_model:
-                yield out_lik.sum(), gal, model
+                yield out_lik, gal, model
             else:
-                yield out_lik.sum(), gal
+                yield out_lik, gal
+
+    def lik_many(self, points, gal, normalize=True):
+        '''(Multi_LRG_burst, ndarray, str, bool) -> ndarray
+        Log likelyhood of (N, nparams) array of points for galaxy gal, with
+        columns in order of initalize_param. Grid check and likelyhoods are
+        done for all points at once.'''
+        points = pd.DataFrame(np.atleast_2d(points), columns=self._columns())
+        out = np.zeros(len(points)) - np.inf
+        inside = np.nonzero(self.cube.in_range(
+            points[['tau', 'age', 'metalicity']].values))[0]
+        if len(inside) > 0:
+            # interpolate all spectra at once
+            spec = self.cube.interp(
+                points[['tau', 'age', 'metalicity']].values[inside])
+            flux, log_norm = [], []
+            for j, i in enumerate(inside):
+                flux.append(self._make_model(points.iloc[[i]], gal,
+                                             normalize, spec[[j]]))
+                log_norm.append(self.norm_prior[gal])
+            out[inside] = self._loglik(np.vstack(flux), gal, normalize,
+                                       np.asarray(log_norm))
+        return out
 
     def step_func(self, step_crit, param, step_size, itter):
         '''(Example_lik_class, float, ndarray or list, ndarray, any type) ->
@@ -149,8 +337,7 @@ class Multi_LRG_burst(lik.Example_lik_class):
         Evaluates step_criteria, with help of param and model and 
         changes step size during burn-in perior. Outputs new step size
         '''
-        diag = np.diagonal(step_size)
-        
+        adapt = self._adapt_for(step_size)
         '''if np.all(step_crit > 0.3) and np.all(diag < 8.):
             step_size *= 1.05
         elif np.all(step_crit < 0.2) and np.any(diag > 10**-6):
@@ -158,35 +345,34 @@ class Multi_LRG_burst(lik.Example_lik_class):
         # Switch statement
         if step_crit < 0.001:
             # reduce by 90 percent
-            step_size *= 0.1
+            adapt.rescale(0.1)
         elif step_crit < 0.05:
             # reduce by 50 percent
-            step_size *= 0.5
+            adapt.rescale(0.5)
         elif step_crit < 0.2:
             # reduce by ten percent
-            step_size *= 0.9
+            adapt.rescale(0.9)
         elif step_crit > 0.95:
             # increase by factor of ten
-            step_size *= 10.0
+            adapt.rescale(10.0)
         elif step_crit > 0.75:
             # increase by double
-            step_size *= 2.0
+            adapt.rescale(2.0)
         elif step_crit > 0.5:
             # increase by ten percent
-            step_size *= 1.1
-        #cov matrix
+            adapt.rescale(1.1)
+        # running cov matrix of new rows of chain
         if itter % 500 == 0 and itter > 0.:
-            
-            Tstep_size = np.cov(np.vstack(param[-2000:]).T)
-            #make sure not stuck
-            index = np.isclose(Tstep_size, 0, rtol=1e-6) == False
-            step_size[index] = Tstep_size[index]
-        # make sure none of the diagonal elements are smaller than 10**-4
-        diag = np.diagonal(step_size)
-        index = np.where(diag < 10**-4)[0]
-        for i in index:
-            step_size[i,i] = 10**-4
-        return step_size
+            rows = param[adapt.seen:]
+            if len(rows) > 0:
+                adapt.update(np.vstack(rows))
+            adapt.seen = len(param)
+        return adapt.sigma
+
+    def _adapt_for(self, sigma):
+        '''Adaptive proposal with step size sigma. None of the diagonal
+        elements are smaller than 10**-4'''
+        return MC.Adapt_Cov.of(sigma, self._adapt, floor=10**-4)
 
     def initalize_param(self, bins):
         dtype = []
@@ -226,43 +412,23 @@ class Multi_LRG_burst(lik.Example_lik_class):
     
     def prior(self, param, bins):
         '''Calculates priors of all parameters'''
-        # Uniform
-        # tau, age, metalicity
         for gal in param[bins]:
-            out_lik = 0.
-            for i,ran in enumerate(self.param_range):
-                if i ==1:
-                    #age
-                    if param[bins][gal].iloc[0][i] > ran.max():
-                        out_lik += -np.inf
-                    else:
-                        out_lik += stats_dist.norm.logpdf(param[bins][gal].iloc[0][i], 9.65, 0.43)
-                else:
-                    #other
-                    out_lik += stats_dist.uniform.logpdf(param[bins][gal].iloc[0][i],
-                                                         ran.min(),ran.ptp())
-                                
-            # Redshift
-            out_lik += stats_dist.uniform.logpdf(param[bins][gal]['redshift'],
-                                                 0,.055)
-            # make sure norm isn't too small
-            norm = param[bins][gal]['normalization'] < -10
-            
-            if norm.bool():
-                out_lik += -np.inf
-            else:
-                out_lik += stats_dist.norm.logpdf(param[bins][gal]['normalization'],
-                                              self.norm_prior[gal], 10)
-            
-            if self.has_dust:
-                out_lik += stats_dist.uniform.logpdf(param[bins][gal][['$T_{ism}$',
-                                                '$T_{bc}$']],0,4).sum()
-            if self.has_losvd:
-                out_lik += stats_dist.uniform.logpdf(param[bins][gal]['$\\sigma$'],
-                                                 0,3.2)
-                out_lik += stats_dist.uniform.logpdf(param[bins][gal]['$V$'],0,4)
-            yield out_lik, gal
+            point = param[bins][gal][self._columns()].values
+            yield self.prior_many(point, gal)[0], gal
     
+    def prior_many(self, points, gal):
+        '''(Multi_LRG_burst, ndarray, str) -> ndarray
+        Log prior of (N, nparams) array of points for galaxy gal, columns
+        in order of initalize_param'''
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        # Uniform and bounds of all params
+        out = self._domain.logpdf(points)
+        # normalization is around best fit normalization
+        out += MC.norm_logpdf(
+            points[:, self._columns().index('normalization')],
+            self.norm_prior[gal], 10)
+        return out
+
     def model_prior(self, model):
         return 0.
     
@@ -271,11 +437,10 @@ class Multi_LRG_burst(lik.Example_lik_class):
         out = {}
         for gal in Mu:
             mu = Mu[gal].values[0]
-            try:
-                out[gal] =  np.random.multivariate_normal(mu, Sigma[gal])
-            except:
-                pass
-                #ipdb.set_trace()
+            random = None
+            if self.streams is not None:
+                random = self.streams.stream('proposal', gal)
+            out[gal] = self._adapt_for(Sigma[gal]).draw(mu, random=random)
             # put back into DataFrame
             out[gal] = pd.DataFrame(out[gal],Mu[gal].columns).T
             #set h3 and h4 to 0
@@ -296,158 +461,210 @@ class Multi_LRG_burst(lik.Example_lik_class):
         
 class LRG_mpi_lik(Multi_LRG_burst):
     '''Does LRG fitting and sends likelihood cal to different
-    processors'''
+    processors. Each worker is given a block of galaxies when the fitting
+    data is sent and every step is 1 broadcast of a command, a scatter
+    of the float64 params and a gather of the likelihoods.
+
+    With 1 rank or no mpi4py, likelihoods are done by a pool of processes
+    forked from root, which share the spectral grid. processes is the
+    size of the pool, default number of cpus, 1 is serial.'''
+    # commands broadcast from root
+    _LIK, _LIK_MODEL, _DATA, _EXIT = 10, 11, 3, 2
     def __init__(self,  data, db_name='burst_dtau_10.db', have_dust=False,
-                 have_losvd=False, use_mpi=False):
+                 have_losvd=False, use_mpi=False, processes=None):
+        # stop pool from old data
+        if getattr(self, '_pool', None) is not None:
+            self._close_pool()
         # Set up like Muliti
         Multi_LRG_burst.__init__(self, data, db_name, have_dust, have_losvd)
-        self._comm = mpi.COMM_WORLD
-        self._rank = self._comm.Get_rank()
-        self._size = self._comm.Get_size()
+        if mpi is None:
+            self._comm, self._rank, self._size = None, 0, 1
+        else:
+            self._comm = mpi.COMM_WORLD
+            self._rank = self._comm.Get_rank()
+            self._size = self._comm.Get_size()
+        self._cmd = np.zeros(1, dtype='i')
+        self._nparam = len(self._columns())
+        if processes is None:
+            processes = multi.cpu_count()
+        self._processes = processes
+        self._pool = None
         if self._size > 1:
             # get workers
+            self.get_workers()
+            self._assign_blocks()
             if self._rank == 0:
-                self.get_workers()
                 self.lik = self.lik_root
-                 
             else:
                 self.calc_lik = self.lik
                 self.lik = self.lik_worker
         else:
             self.get_workers()
             self._size = 5
+            if self._processes > 1 and len(self.data) > 1:
+                self.calc_lik = self.lik
+                self.lik = self.lik_pool
+
+    def _assign_blocks(self):
+        '''Splits galaxies into contiguous blocks, one for each worker.
+        Root has no galaxies'''
+        self._gals = sorted(self.data.keys())
+        self._blocks = [[]] + [[self._gals[j] for j in i] for i in
+            np.array_split(np.arange(len(self._gals)), self._size - 1)]
+        self._block_size = np.array([len(i) for i in self._blocks])
+        self._local = self._blocks[self._rank]
+
+    def _bcast_cmd(self, cmd=None):
+        '''Broadcast command from root, returns command'''
+        if cmd is not None:
+            self._cmd[0] = cmd
+        self._comm.Bcast([self._cmd, mpi.INT], root=0)
+        return int(self._cmd[0])
 
+    def _vec_args(self, buf, size):
+        '''Args for Scatterv/Gatherv of buf with size float64 per galaxy'''
+        counts = self._block_size * size
+        displs = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        return [buf, counts, displs, mpi.DOUBLE]
+
+    def _exchange(self, points=None, return_model=False):
+        '''Scatters (ngal, nparam) points to workers, they calculate
+        likelihoods of their block and results are gathered to root as
+        (ngal, 2) array of [likelihood, norm_prior] and a flat array of model
+        fluxes. Rows of points that are nan are not calculated'''
+        local = np.empty((len(self._local), self._nparam))
+        self._comm.Scatterv(self._vec_args(points, self._nparam)
+                            if self._rank == 0 else None, local, root=0)
+        out = np.zeros((len(self._local), 2)) - np.inf
+        length = [len(self.data[gal]) for gal in self._local]
+        model = np.zeros(sum(length))
+        if self._rank > 0:
+            param = {}
+            for gal, row in zip(self._local, local):
+                if not np.any(np.isnan(row)):
+                    param[gal] = pd.DataFrame(row[np.newaxis],
+                                              columns=self._columns())
+            index = dict((gal, i) for i, gal in enumerate(self._local))
+            start = np.concatenate(([0], np.cumsum(length)))
+            for recv in self.calc_lik({0:param}, 0, return_model):
+                i = index[recv[1]]
+                out[i] = recv[0], self.norm_prior[recv[1]]
+                if return_model and len(recv[2]) > 0:
+                    model[start[i]:start[i+1]] = np.ravel(recv[2])
+        results, models = None, None
+        if self._rank == 0:
+            results = np.empty((len(self._gals), 2))
+            models = np.empty(sum(len(self.data[gal]) for gal in self._gals))
+        self._comm.Gatherv(out, self._vec_args(results, 2)
+                           if self._rank == 0 else None, root=0)
+        if return_model:
+            size = np.array([sum(len(self.data[gal]) for gal in block)
+                             for block in self._blocks])
+            displs = np.concatenate(([0], np.cumsum(size)[:-1]))
+            self._comm.Gatherv(model, [models, size, displs, mpi.DOUBLE]
+                               if self._rank == 0 else None, root=0)
+        return results, models
+        
     def lik_worker(self):
-        '''Does lik calculation for sent galaxies, returns likelihood'''
+        '''Does lik calculation for block of galaxies each step, until root
+        sends exit'''
         # keep calculating till run is over
         self._proc_name = mpi.Get_processor_name()
         while True:
-            # Send ready signal
-            self._comm.send([{'rank': self._rank,
-                              'name':self._proc_name}], dest=0, tag=1)
-            status = mpi.Status()
-            recv = self._comm.recv(source=0, tag=mpi.ANY_TAG, status=status)
+            cmd = self._bcast_cmd()
             # check if should quit
-            if  status.tag == 2:
-               #print 'trying to quit worker %i'%self._rank
-               self._comm.isend([], dest=0, tag=2)
-               sys.exit(0)
-            # recived data
-            if status.tag == 10:
-                #Multi_LRG_burst.lik
-                gal = recv[1]
-                Lik = self.calc_lik({0:{gal:recv[0]}},0)
-                out_lik = Lik.next()[0]
-                self._comm.send((gal, out_lik, self.norm_prior[gal]),
-                                dest=0, tag=10)
-            if status.tag == 11:
-                #Multi_LRG_burst.lik return model too
-                gal = recv[1]
-                Lik = self.calc_lik({0:{gal:recv[0]}}, 0, True)
-                out_lik = Lik.next()
-                self._comm.send((gal, out_lik[0], self.norm_prior[gal],out_lik[2]),
-                                dest=0, tag=11)
-            if status.tag == 5:
-                #do nothing
-                pass
-            if status.tag == 3:
+            if cmd == self._EXIT:
+                sys.exit(0)
+            if cmd == self._DATA:
                 # recive fitting data
+                self.data, self.norm_prior, self.norm = self._comm.bcast(
+                    None, root=0)
                 print "%i recived new data from root"%self._rank
-                self.data, self.norm_prior, self.norm = recv
+                self._define_gauss()
                 # change resolution
                 self._define_resolu()
-                
+                self._assign_blocks()
+            if cmd in [self._LIK, self._LIK_MODEL]:
+                self._exchange(return_model=cmd == self._LIK_MODEL)
                 
     def lik_root(self, param, bins, return_model=False):
-        '''Root lik calculator, manages workers for likelihood calcs'''
-        # feed all queued jobs to workers
-        # tag 1 codes for initialization.
-        # tag 10 codes for requesting more data.
-        # tag 11 codes for requesting more data but return model spectra
-        # tag 5 codes for doing nothing
-        # Tag 2 codes for a worker exiting.
-        # Tag 3 codes to send/recive new fitting data
-        index = -1
-        #gal = param[bins].keys()[index]
-        recv_num = []
-        while True:
-            status = mpi.Status()
-            recv = self._comm.recv(source=mpi.ANY_SOURCE, tag=mpi.ANY_TAG,
-                                   status=status)
-            if status.tag == 1:
-                #send data to source
-                if index+1 < len(param[bins]):
-                    index += 1
-                    gal = param[bins].keys()[index]
-                    if not return_model:
-                        self._comm.send((param[bins][gal],gal),
-                                        dest=status.source, tag=10)
-                    else:
-                        self._comm.send((param[bins][gal],gal),
-                                        dest=status.source, tag=11)
-                    #print 'Send %s to %i'%(gal,status.source)
-                else:
-                    # send nothing
-                    self._comm.send([], dest=status.source, tag=5)
-                    
-            if status.tag == 10:
-                #recive likelyhoods
-                recv_gal, recv_lik, recv_norm = recv
-                self.norm_prior[recv_gal] = recv_norm
-                #print 'Recived %s with chi %f'%(recv_gal,recv_lik)
-                yield recv_lik, recv_gal
-                recv_num.append(recv_gal)
-                # Check if should exit
-                if len(recv_num) == len(param[bins].keys()):
-                    #print 'done'
-                    break
-                
-            if status.tag == 11:
-                recv_gal, recv_lik, recv_norm, recv_model = recv
-                self.norm_prior[recv_gal] = recv_norm
-                #print 'Recived %s with chi %f'%(recv_gal,recv_lik)
-                yield recv_lik, recv_gal, recv_model
-                recv_num.append(recv_gal)
-                # Check if should exit
-                if len(recv_num) == len(param[bins].keys()):
-                    #print 'done'
-                    break
-                
-            if status.tag == 2:
-                # Worker crashed
-                self.remove_workers(status.source)
+        '''Root lik calculator, sends params of all galaxies to workers
+        and gets likelihoods back in 1 exchange'''
+        self._bcast_cmd(self._LIK_MODEL if return_model else self._LIK)
+        # galaxies not in param are skipped by workers
+        points = np.empty((len(self._gals), self._nparam)) + np.nan
+        for i, gal in enumerate(self._gals):
+            if gal in param[bins]:
+                points[i] = param[bins][gal][self._columns()].values
+        results, models = self._exchange(points, return_model)
+        start = np.concatenate(([0], np.cumsum(
+            [len(self.data[gal]) for gal in self._gals])))
+        index = dict((gal, i) for i, gal in enumerate(self._gals))
+        # same order as serial lik
+        for gal in param[bins]:
+            i = index[gal]
+            recv_lik, recv_norm = results[i]
+            if np.isfinite(recv_norm):
+                self.norm_prior[gal] = recv_norm
+            if not return_model:
+                yield recv_lik, gal
+            elif not np.isfinite(recv_lik):
+                yield recv_lik, gal, []
+            else:
+                yield recv_lik, gal, models[np.newaxis, start[i]:start[i+1]]
                 
+    def _start_pool(self):
+        '''Forks pool of processes with copy of self. Spectral grid is
+        memory mapped or in pages shared with root'''
+        self._pool = multi.Pool(self._processes, _pool_init, (self,))
+        # contiguous blocks of galaxies, about 1 for each process
+        gals = sorted(self.data.keys())
+        self._pool_blocks = [[gals[j] for j in i] for i in
+            np.array_split(np.arange(len(gals)), self._processes) if len(i)]
+
+    def _close_pool(self):
+        '''Stops pool processes'''
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+
+    def lik_pool(self, param, bins, return_model=False):
+        '''Likelihood calculator with local pool of processes. Params of
+        each block of galaxies are sent as float64 arrays'''
+        if self._pool is None:
+            self._start_pool()
+        jobs = []
+        for block in self._pool_blocks:
+            points = dict((gal, np.asarray(
+                param[bins][gal][self._columns()].values, dtype=float))
+                          for gal in block if gal in param[bins])
+            # norm_prior of root, as blocks can go to any process
+            norms = dict((gal, self.norm_prior[gal]) for gal in points)
+            if len(points) > 0:
+                jobs.append((points, norms, return_model))
+        results = {}
+        for out in self._pool.imap(_pool_lik_block, jobs):
+            for recv in out:
+                self.norm_prior[recv[1]] = recv[-1]
+                results[recv[1]] = recv[:-1]
+        # same order as serial lik
+        for gal in param[bins]:
+            yield results[gal]
+
     def send_fitting_data(self):
         '''Sends fitting data to workers from root'''
+        if self._pool is not None:
+            # new pool is forked with data on next lik
+            self._close_pool()
         # check if needed
-        if self._comm.size < 2:
+        if self._comm is None or self._comm.size < 2:
             return None
-        index = -1
-        recv_num = []
-        # send to all
-        while True:
-            status = mpi.Status()
-            recv = self._comm.recv(source=mpi.ANY_SOURCE, tag=mpi.ANY_TAG,
-                                   status=status)
-            if not status.tag == 1:
-                print "Didn't get right signal"
-                raise
-            if recv[0]['rank'] in recv_num:
-                continue
-            recv_num.append(recv[0]['rank'])
-            # Send data
-            #print self.data.keys()
-            self._comm.send((self.data,self.norm_prior,self.norm), dest=status.source,
-                             tag=3)
-            # Check if all workers have data
-            if np.all(np.sort(recv_num) == np.sort(self._workers)):
-                # send a 5 so they listen again
-                for worker in recv_num:
-                    self._comm.send([], dest=worker, tag=5)
-                break
+        self._bcast_cmd(self._DATA)
+        self._comm.bcast((self.data,self.norm_prior,self.norm), root=0)
+        self._assign_blocks()
         
     def get_workers(self):
-        if self._comm.Get_size() > 1:
+        if self._size > 1:
             self._workers = range(1,self._size)
         else:
             # single processing
@@ -460,44 +677,65 @@ class LRG_mpi_lik(Multi_LRG_burst):
 
     def exit_signal(self):
         '''Sets varables needed for mpi'''
+        if self._pool is not None:
+            self._close_pool()
         if not self._rank == 0 or isinstance(self._workers, str):
             return None
         # send exit signal to all workers
-        while len(self._workers) > 0:
-            status = mpi.Status()
-            recv = self._comm.recv(source=mpi.ANY_SOURCE, tag=mpi.ANY_TAG,
-                                   status=status)
-            #print recv
-            if status.tag == 1:
-                # Send Kill Signal
-                print 'Killing worker %i on %s'%(recv[0]['rank'],recv[0]['name'])
-                self._comm.send([], dest=status.source, tag=2)
-                
-            if status.tag == 2:
-                # remove worker
-                self.remove_workers(status.source)
+        self._bcast_cmd(self._EXIT)
+        self._workers = []
 
                 
 
+# likelihood object of pool processes
+_pool_lik = None
+
+def _pool_init(lik):
+    # lik is inherited when pool forks, not pickled
+    global _pool_lik
+    _pool_lik = lik
+
+def _pool_lik_block(args):
+    '''(dict, dict, bool) -> list
+    Does lik in pool process for {gal: param row} of a block, returns
+    list of (lik, gal, [model], norm_prior)'''
+    points, norms, return_model = args
+    _pool_lik.norm_prior.update(norms)
+    param = dict((gal, pd.DataFrame(np.atleast_2d(points[gal]),
+                                    columns=_pool_lik._columns()))
+                 for gal in points)
+    return [recv + (_pool_lik.norm_prior[recv[1]],) for recv in
+            _pool_lik.calc_lik({0:param}, 0, return_model)]
+
+
 class LRG_Tempering(LRG_mpi_lik):
     '''parallel Tempering liklihood'''
     def __init__(self, data, db_name='burst_dtau_10.db', have_dust=False,
-                 have_losvd=False):
+                 have_losvd=False, processes=None):
         # initalize from old class
-        LRG_mpi_lik.__init__(self, data ,db_name, have_dust, have_losvd)
+        LRG_mpi_lik.__init__(self, data ,db_name, have_dust, have_losvd,
+                             processes=processes)
         # Check data should only have 1 gal
         assert len(data.keys()) == 1, 'Only 1 gal at a time'
 
     def initalize_temp(self, num_temp):
-        '''Initalize different tempering spaced by delta_t'''
-        # make temp data from 0=no to num ofcpu =high temp
-        data = {}
+        '''Makes num_temp - 1 replicas of the galaxy, key_000 is coldest.
+        Replicas share the data and kernels of the galaxy and are
+        calculated together by the workers or pool'''
         key = self.data.keys()[0]
-        for cpu in range(num_temp-1):
-            data[key+'_%03d'%cpu] = np.copy(self.data[key])
-        self.data = data
-        LRG_mpi_lik.__init__(self, data ,self.db_name, self.has_dust,
-                             self.has_losvd)
+        keys = [key + '_%03d'%cpu for cpu in range(num_temp - 1)]
+        for attr in ['data', 'norm', 'norm_prior', '_gauss', 'resolu']:
+            gal = getattr(self, attr)[key]
+            setattr(self, attr, dict((i, gal) for i in keys))
+        self.models = {'burst': keys}
+        if self._comm is not None and self._comm.Get_size() > 1:
+            self._assign_blocks()
+        elif self._processes > 1 and len(keys) > 1:
+            if self._pool is not None:
+                self._close_pool()
+            if self.lik != self.lik_pool:
+                self.calc_lik = self.lik
+                self.lik = self.lik_pool
         
 
                 
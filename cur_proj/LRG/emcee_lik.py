@@ -28,6 +28,16 @@ class LRG_emcee(Multi_LRG_burst):
             pass
         return Lik + Prior
     
+    def lnprob_many(self, points):
+        '''(LRG_emcee, ndarray) -> ndarray
+        Log posterior of a whole ensemble (nwalkers, dim) at once'''
+        out = self.prior_many(points, self._gal)
+        index = nu.isfinite(out)
+        if nu.any(index):
+            out[index] += self.lik_many(nu.atleast_2d(points)[index],
+                                        self._gal, normalize=False)
+        return out
+
     def dummy_prior(self, param):
         '''Dummy prior for PTsampler'''
         return 0.
@@ -101,6 +111,16 @@ class LRG_emcee_PT(LRG_emcee):
             pass
         return Lik, Prior
           
+class BatchPool(object):
+    '''Pool for emcee that gives all walkers to the likelihood's
+    lnprob_many in one call instead of calling it once per walker'''
+
+    def map(self, function, points):
+        # emcee wraps the likelihood, get it back out
+        lik_fun = getattr(function, 'f', function)
+        return list(lik_fun.lnprob_many(nu.asarray(points)))
+
+        
 class MPIPool_stay_alive(emcee.utils.MPIPool):
     '''
     Like emcee pool object, but has own instance of likeihood function.
@@ -185,7 +205,7 @@ if __name__ == '__main__':
                                             posterior, pool=pool)
         else:
             sampler = emcee.EnsembleSampler(nwalkers, posterior.ndim() ,
-                                            posterior, threads=10)
+                                            posterior, pool=BatchPool())
         # save sample line by lin
 
         #pos, prob, rstate= sampler.sample(pos0, iterations=1000)
@@ -26,11 +26,12 @@ def Single_LRG_model(db_path='/home/thuso/Phd/experements/hierarical/LRG_Stack/b
     return out_class, real_param, data
     
 
-def Multiple_LRG_model(num_galm, db_path='/home/thuso/Phd/experements/hierarical/LRG_Stack/burst_dtau_10.db'):
-    '''Makes multiple models and fits them simultaneously'''
+def Multiple_LRG_model(num_galm, db_path='/home/thuso/Phd/experements/hierarical/LRG_Stack/burst_dtau_10.db', processes=None):
+    '''Makes multiple models and fits them simultaneously. Galaxies are
+    split over processes local cores, default all'''
     data, real_param = get_data(num_gal, db_path)
     # run
-    fun = lik.Multi_LRG_burst(data, db_path) #,have_dust=True,have_losvd=True)
+    fun = lik.LRG_mpi_lik(data, db_path, processes=processes) #,have_dust=True,have_losvd=True)
     top = mpi_top.Topologies('single')
     out_class = mltry.multi_main(fun, top, max_iter=1000)
     return out_class, real_param, data
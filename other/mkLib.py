@@ -250,9 +250,11 @@ def ESPS(inpath,outpath):
             nu.savetxt(outpath+'ssp_%1.4f_%1.6f.spec' %(Z,nu.log10(age[j])),
                        nu.vstack((wave,temp[:,j])).T)
 
-def ulyss_fits(inpath,outpath):
+def ulyss_fits(inpath,outpath,binary=None):
+    '''take ssp lib froma fits file and turns into correct format.
+    If binary is a file name writes a binary .aglib library there
+    instead of .spec files in outpath'''
     import pyfits as fits
-    #take ssp lib froma fits file and turns into correct format   
     if outpath[-1]!='/':
         outpath=outpath+'/'
 
@@ -276,6 +278,15 @@ def ulyss_fits(inpath,outpath):
     #convert metal from dex to solar 
     metal=10**metal
     
+    if binary is not None:
+        spect=[wave]
+        names=[]
+        for i in range(len(age)):
+            for j in range(len(metal)):
+                names.append('ssp_%1.4f_%1.6f.spec' %(metal[j],age[i]))
+                spect.append(files[0].data[j,i,1:])
+        write_bin(binary,nu.vstack(spect).T,names)
+        return
     #save 
     temp=-nu.ones([wave.shape[0],2])
     temp[:,0]=wave
@@ -285,6 +296,31 @@ def ulyss_fits(inpath,outpath):
             temp[:,1]=files[0].data[j,i,1:]
             nu.savetxt(outpath+outname,temp)
 
+def write_bin(outname,spect,names,dtype=nu.float64):
+    '''writes [wave,spec1,spec2...] columns with ssp_metal_age.spec names
+    as a binary memmap library (see spectra_lib_utils.save_spec_lib)'''
+    import spectra_lib_utils as lib_utils
+    if not outname.endswith(lib_utils.LIB_EXT):
+        outname+=lib_utils.LIB_EXT
+    lib_utils.save_spec_lib(outname,spect,names,dtype=dtype)
+
+def spec_to_bin(inpath,outname,dtype=nu.float64):
+    '''packs the standard ssp_metal_age.spec files in inpath, made with
+    the functions above, into one binary library. All files must have the
+    same wavelengths'''
+    if inpath[-1]!='/':
+        inpath=inpath+'/'
+    names=sorted(i for i in os.listdir(inpath) if i.endswith('.spec'))
+    assert len(names)>0, 'No .spec files in %s' %inpath
+    temp=nu.loadtxt(inpath+names[0])
+    spect=nu.zeros([temp.shape[0],len(names)+1])
+    spect[:,0]=temp[:,0]
+    for i,j in enumerate(names):
+        temp=nu.loadtxt(inpath+j)
+        assert nu.allclose(temp[:,0],spect[:,0]), '%s has diffrent wavelengths' %j
+        spect[:,i+1]=temp[:,1]
+    write_bin(outname,spect,names,dtype)
+
 ####from astrophysiscs tools#######
 def air_to_vacuum(airwl,nouvconv=True):
     """
@@ -8,6 +8,7 @@ from multiprocessing import *
 from scipy.cluster import vq as sci
 from scipy.stats import levene, f_oneway
 import sys
+from Age_RJMCMC import random_permute
 a=nu.seterr(all='ignore')
 
 
@@ -175,7 +176,7 @@ def MCMC_SA(data, burnin, k_max, option, rank, q_talk, q_final, fun):
     print "Starting processor %i" %rank
     #part on every modual wanting to fit the spectra
     #controls input and expot of files for fitt
-    nu.random.seed(random_permute(current_process().ident))
+    nu.random.seed(random_permute(rank))
     #fun = MC_func(data,bins)
     #cpu = float(cpu_count())
     #initalize parmeters and chi squared
@@ -332,23 +333,6 @@ def SA(i, i_fin, T_start, T_stop):
     else:
         return (T_stop - T_start) / float(i_fin) * i + T_start
 
-def random_permute(seed):
-    #does random sequences to produice a random seed for parallel programs
-    ##middle squared method
-    seed = str(seed**2)
-    while len(seed) < 7:
-        seed=str(int(seed)**2)
-    #do more randomization
-    ##multiply with carry
-    a,b,c = int(seed[-1]), 2**32, int(seed[-3])
-    j = nu.random.random_integers(4, len(seed))
-    for i in range(int(seed[-j:-j+3])):
-        seed = (a*int(seed) + c) % b
-        c = (a * seed + c) / b
-        seed = str(seed)
-    return int(seed)
-
-
 def Covarence_mat(param, j):
     #creates a covarence matrix for the step size 
     #only takes cov of last 1000 itterations
@@ -54,7 +54,8 @@ def timeit(method):
     return timed
 
 
-def RJMC_main(fun, option, burnin=5*10**3, birth_rate=0.5,max_iter=10**5, seed=None, fail_recover=True):
+def RJMC_main(fun, option, burnin=5*10**3, birth_rate=0.5,max_iter=10**5, seed=None, fail_recover=True,
+              ess_target=10**5, ess_every=2000):
     '''(likelihood object, running object, int, int, bool) ->
     dict(ndarray), dict(ndarray)
 
@@ -68,6 +69,8 @@ def RJMC_main(fun, option, burnin=5*10**3, birth_rate=0.5,max_iter=10**5, seed=N
     seed is random seed (optional), usefull when runing in multiprocess
     mode.
     tot_iter is number of iterations to stop at.
+    ess_target is effective sample size of current model after burn-in to
+    stop at, checked every ess_every iterations.
     fail recover tell program to search local dir for file called "failed_gid.pik" incase
     tring to revcover from crash. Can be file path to recovery file or bool wheather to check
 
@@ -82,6 +85,9 @@ def RJMC_main(fun, option, burnin=5*10**3, birth_rate=0.5,max_iter=10**5, seed=N
     #see if to use specific seed
     if seed is not None:
         nu.random.seed(seed)
+        #own stream for proposals
+        if hasattr(fun, 'streams'):
+            fun.streams = MC.Random_Streams(seed)
     #see if should recover from file
     eff = -999999
     if type(fail_recover) is bool:
@@ -287,9 +293,11 @@ def RJMC_main(fun, option, burnin=5*10**3, birth_rate=0.5,max_iter=10**5, seed=N
             if option.current > max_iter:
                 option.iter_stop = False
             #exit if reached target effective sample size
-            if option.current % 501 == 0:
-                eff = MC.ess(param[bins])
-                if eff > 10**5 and option.current > 10**5 :
+            if option.current % ess_every == 0 and T_cuurent[bins] > burnin:
+                rows = MC.list_dict_to(param[bins][burnin - T_cuurent[bins]:],
+                                       fun._key_order)
+                eff = nu.nanmin(MC.ess(rows))
+                if eff >= ess_target:
                     option.iter_stop = False
         #pik.dump((t_pro,t_swarm,t_lik,t_accept,t_step,t_unsitc,t_birth,t_house,t_comm),open('time_%i.pik'%option.rank_world,'w'),2)
     #####################################return once finished 
@@ -300,20 +308,11 @@ def RJMC_main(fun, option, burnin=5*10**3, birth_rate=0.5,max_iter=10**5, seed=N
     
 
 def random_permute(seed):
-    #does random sequences to produice a random seed for parallel programs
-    ##middle squared method
-    seed = str(seed**2)
-    while len(seed) < 7:
-        seed=str(int(seed)**2)
-    #do more randomization
-    ##multiply with carry
-    a,b,c = int(seed[-1]), 2**32, int(seed[-3])
-    j = nu.random.random_integers(4, len(seed))
-    for i in range(int(seed[-j:-j+3])):
-        seed = (a*int(seed) + c) % b
-        c = (a * seed + c) / b
-        seed = str(seed)
-    return int(seed)
+    '''(int) -> ndarray
+    Seed of random stream for a parallel program from seed (rank or
+    index of worker), processes with different seeds get uncorrelated
+    streams'''
+    return MC.stream_seed('random_permute', seed)
 
 
 
@@ -163,7 +163,8 @@ def none(active_param, active_dust, active_losvd, rank, birth_rate, option,T_cuu
 #+===================================
 #main function  
 def rjmcmc_swarm(fun, option, swarm_function=vanilla, burnin=5*10**3):
-    nu.random.seed(random_permute(current_process().pid))
+    #stream of worker from its rank, so runs can be repeated
+    nu.random.seed(random_permute(option.rank_world))
     #file = csv.writer(open('out'+str(rank)+'txt','w'))
     #initalize boundaries
     lib_vals = fun._lib_vals
@@ -40,14 +40,21 @@ import ipdb
 # from memory_profiler import profile
 from glob import glob
 a = nu.seterr(all='ignore')
+# name of fail recovery file in save dir
+CHECK_NAME = 'checkpoint.chk'
 
 
 def multi_main(fun, option, burnin=5*10**3,  max_iter=10**5,
-            seed=None, fail_recover=False):
-    '''Main multi RJMCMC program. Like gibbs sampler but for RJMCMC'''
+            seed=None, fail_recover=False, ess_target=None, ess_every=5000):
+    '''Main multi RJMCMC program. Like gibbs sampler but for RJMCMC.
+    If ess_target is set, stops once every galaxy has that effective
+    sample size after tuning, checked every ess_every itterations'''
     # see if to use specific seed
     if seed is not None:
         nu.random.seed(seed)
+        # own stream for proposals of each galaxy
+        if hasattr(fun, 'streams'):
+            fun.streams = MC.Random_Streams(seed)
     # initalize paramerts/class for use by program
     Param = Param_MCMC(fun, burnin)
     if fail_recover:
@@ -61,52 +68,58 @@ def multi_main(fun, option, burnin=5*10**3,  max_iter=10**5,
             timeInit += 0
             if  timeInit > 10:
                 raise MCMCError('Bad Starting position, check params')
-    # Start RJMCMC
-    while option.iter_stop:
-        bins = Param.bins
-        if option.current % 1 == 0 and option.current > 0:
-            acpt = nu.min([i[-1] for i in Param.acept_rate[bins].values()])
-            chi = nu.sum([i[-1] for i in Param.chi[bins].values()])
-            try:
-                show = ('acpt = %.2f,log lik = %e, model = %s, steps = %i,Temp = %2.0f'
-                    %(acpt, chi, bins, option.current, nu.min(Param.sa.values())))
-                print show
-            except:
-                pass
-            sys.stdout.flush()
-        # stay, try or jump
-        doStayTryJump =  nu.random.rand()
-        stay(Param, fun)
-        '''if doStayTryJump <= .3:
-            # Stay
+    # Start RJMCMC, checkpoint is closed even if run fails so queued
+    # records are written
+    try:
+        while option.iter_stop:
+            bins = Param.bins
+            if option.current % 1 == 0 and option.current > 0:
+                acpt = nu.min([i[-1] for i in Param.acept_rate[bins].values()])
+                chi = nu.sum([i[-1] for i in Param.chi[bins].values()])
+                try:
+                    show = ('acpt = %.2f,log lik = %e, model = %s, steps = %i,Temp = %2.0f'
+                        %(acpt, chi, bins, option.current, nu.min(Param.sa.values())))
+                    print show
+                except:
+                    pass
+                sys.stdout.flush()
+            # stay, try or jump
+            doStayTryJump =  nu.random.rand()
             stay(Param, fun)
-        elif doStayTryJump > .3 and doStayTryJump < .6:
-            # Try
-            pass
-        else:
-            # Jump
-            pass
-            # jump(Param, fun, birth_rate)'''
-        # Change Step size
-        if option.current < burnin * 2:
-            Param.step(fun, option.current, 500)
-        # Change parameter grouping
-        # reconfigure(Param)
-        # Change temperature
-        Param.SA(option.current)
-        # Tunr SA after burin tuneing
-        if option.current > burnin * 2 and  option.current < burnin * 3:
-            Param.tune_sa()
-        # Convergence assement
-        if option.current % 5000 == 0 and option.current > 1:
-            pass
-            #Param.eff = MC.effectiveSampleSize(Param.param[bins])
-        # Save currnent Chain state
-        Param.save_state(option.current)
-        option.current += 1
-        if option.current >= max_iter:
-            option.iter_stop = False
-    # Finish and return
+            '''if doStayTryJump <= .3:
+                # Stay
+                stay(Param, fun)
+            elif doStayTryJump > .3 and doStayTryJump < .6:
+                # Try
+                pass
+            else:
+                # Jump
+                pass
+                # jump(Param, fun, birth_rate)'''
+            # Change Step size
+            if option.current < burnin * 2:
+                Param.step(fun, option.current, 500)
+            # Change parameter grouping
+            # reconfigure(Param)
+            # Change temperature
+            Param.SA(option.current)
+            # Tunr SA after burin tuneing
+            if option.current > burnin * 2 and  option.current < burnin * 3:
+                Param.tune_sa()
+            # Convergence assement
+            if (option.current % ess_every == 0 and
+                option.current > burnin * 3):
+                Param.eff = Param.ess(option.current - burnin * 3)
+                print 'ESS = %.0f'%Param.eff
+                if ess_target is not None and Param.eff >= ess_target:
+                    option.iter_stop = False
+            # Save currnent Chain state
+            Param.save_state(option.current)
+            option.current += 1
+            if option.current >= max_iter:
+                option.iter_stop = False
+    finally:
+        Param.close_checkpoint()
     fun.exit_signal()
     return Param
 
@@ -214,6 +227,8 @@ class Param_MCMC(object):
         self.T_start = {}
         self.sa = {}
         self.T_stop =  1.
+        # fail recovery file
+        self.checkpoint = None
         
     def initalize(self, lik_fun):
         '''Initalize certan parms'''
@@ -225,7 +240,7 @@ class Param_MCMC(object):
                 #self.active_chi[bins][gal] = {}
                 self.out_sigma[bins][gal]  =  [self.sigma[bins][gal][:]]
             
-                self.acept_rate[bins][gal] = []
+                self.acept_rate[bins][gal] = MC.Chain_Store()
             
         # check if params are in range
         lik, prior = (lik_fun.lik(self.active_param, bins),
@@ -235,227 +250,131 @@ class Param_MCMC(object):
         for Prior, gal in prior:
             if not nu.isfinite(Prior):
                 return True
-            self.chi[bins][gal] = [Prior]
+            self.chi[bins][gal] = MC.Chain_Store(Prior)
             self.active_chi[bins][gal] = Prior
         for Lik, gal in lik:
             if not nu.isfinite(Lik):
                 return True
             self.chi[bins][gal][-1] += Lik
             self.active_chi[bins][gal] = Lik
-            self.param[bins][gal] = [self.active_param[bins][gal].copy()]
-            self.T_start[gal] = abs(nu.max(self.chi[bins].values()))
+            self.param[bins][gal] = MC.Chain_Store(self.active_param[bins][gal])
+            self.T_start[gal] = abs(nu.max([i[-1] for i in
+                                            self.chi[bins].values()]))
             
         self.SA(0)
         self.save_state(0, lik_fun)
-        return not nu.all(nu.isfinite(self.chi[bins].values()))
+        return not nu.all(nu.isfinite([i[-1] for i in
+                                       self.chi[bins].values()]))
 
     def fail_recover(self, path, lik_fun, option):
         '''Loads params from old run'''
-        out_size = 0
-        if isinstance(path, str):
-            # Path is a path
-            if not os.path.exists(path):
-                # Print warning and make save recovery dir
-                pass
-        else:
+        if not isinstance(path, str):
             # standard path
-            if not os.path.exists('save_files'):
-                raise MCMCError('No fail recovery. Turn off in options')
-            else:
-                path = 'save_files'
-        self.save_path = {}
+            path = 'save_files'
+        check_path = os.path.join(path, CHECK_NAME)
+        if not os.path.exists(check_path):
+            raise MCMCError('No fail recovery. Turn off in options')
+        check, end = MC.Checkpoint.read(check_path)
+        # remove broken record so new ones are readable
+        size = os.path.getsize(check_path)
+        if size > end:
+            print 'Removing %i bytes of broken record from checkpoint'%(
+                size - end)
+            with open(check_path, 'r+b') as f:
+                f.truncate(end)
         lik_fun.data = {}
         lik_fun.norm_prior = {}
         lik_fun.norm = {}
-        # should be 3 layers of files [models,gal,local_parameters]
-        walker = os.walk(path)
-        dir, models,files = walker.next()
-        for model in models:
-            self.save_path[model] = {}
-        # Get gal
-        dir, gals, files = walker.next()
-        dir = path
-        for model in models:
+        # global params
+        self.T_stop = float(check['', '', 'T_stop'])
+        burnin = float(check['', '', 'burnin'])
+        # rows read are already saved, new ones are appended
+        self.checkpoint = MC.Checkpoint(check_path, 'a')
+        out_size = 0
+        objects = set((model, gal) for model, gal, var in check if model)
+        for model, gal in sorted(objects):
             self.bins = model
-            dir = os.path.join(dir, model)
-            # global params
-            for globes in files:
-                g = globes.split('.')[0]
-                if not g in ['burnin']:
-                    exec('self.%s = nu.loadtxt(open(os.path.join(dir,globes)))'%g)
-                    
-                else:
-                    burnin = nu.loadtxt(open(os.path.join(dir,globes)))
-            for gal in gals:
-                dir = os.path.join(dir, gal)
-                self.save_path[model][gal] = {}
-                files = os.listdir(dir)
-                for param in files:
-                    p = param.split('.')[0]
-                    if p in gals:
-                        lik_fun.data[p] = nu.loadtxt(os.path.join(dir,param))
-                        lik_fun.norm_prior[p] = 1.
-                        # Get header
-                        header = open(os.path.join(dir,param)).readline()
-                        lik_fun.norm[p] = float(header.split('*')[-1])
-                        continue
-                    self.save_path[model][gal][p] = []
-                    # Open file
-                    if p in ['sigma', 'T_start', 'Nacept', 'Nreject']:
-                        self.save_path[model][gal][p].append(os.path.join(dir,param))
-                    else:
-                        self.save_path[model][gal][p].append(open(os.path.join(dir,param),
-                                                              'a'))
-                    # Path
-                    self.save_path[model][gal][p].append(os.path.join(dir,param))
-                    # Load param
-                    try:
-                        if p == 'param':
-                            self.param[model][gal] = []
-                            temp = pd.DataFrame.from_csv(open(os.path.join(dir,param)),
-                                                              sep=' ',index_col=None
-                                                              ,header=0)
-                            # append into param
-                            self.param[model][gal] = [temp.irow([i])
-            for i in range(temp.index.max()-self._look_back,temp.index.max())]
-                           
-                        elif p == 'T_start':
-                            exec('self.%s["%s"]'%(p, gal)
-                                +' = float(nu.loadtxt(open(os.path.join(dir,param))))')
-                        else:
-                            try:
-                                exec('self.%s["%s"]["%s"]'%(p, model, gal)
-                                +' = nu.loadtxt(open(os.path.join(dir,param)))')
-                            except:
-                                ipdb.set_trace()
-                            #print 'self.%s["%s"]["%s"]'%(p, model, gal)
-                            # Check shape
-                            size = nu.size(eval('self.%s["%s"]["%s"]'%(p, model, gal)))
-                            if size > 1 and not p in ['sigma']:
-                                out_size = max(out_size,
-                                    eval('self.%s["%s"]["%s"].shape[0]'%(p, model, gal)))
-                                exec('self.%s["%s"]["%s"] = '%(p, model, gal) +
-                                 'self.%s["%s"]["%s"][-self._look_back:]'%(p, model, gal))
-                            elif not p in ['sigma']:
-                                # change from ndarray(0-d) to float or int
-                                #print 'self.%s["%s"]["%s"].shape[0]'%(p, model, gal)
-                                exec('self.%s["%s"]["%s"] = '%(p, model, gal) +
-                                 'float(self.%s["%s"]["%s"])'%(p, model, gal))
-                    except KeyError:
-                        exec('self.%s["%s"]'%(p, gal)
-                            +' = float(nu.loadtxt(open(os.path.join(dir,param))))')
-                        #print 'self.%s["%s"]'%(p, gal)
-                    
-                    # Remove all but curent few
-                dir = os.path.split(dir)[0]
-                # set activie param
-                self.active_chi[model][gal] = nu.copy(self.chi[model][gal][-1])
-                self.chi[model][gal] = [i for i in self.chi[model][gal]]
-                self.acept_rate[model][gal] = [i for i in self.acept_rate[model][gal]]
-                self.active_param[model][gal] = self.param[model][gal][-1].copy()
+            lik_fun.data[gal] = check[model, gal, 'data']
+            lik_fun.norm_prior[gal] = 1.
+            lik_fun.norm[gal] = float(check[model, gal, 'norm'])
+            self.sigma[model][gal] = check[model, gal, 'sigma']
+            self.T_start[gal] = float(check[model, gal, 'T_start'])
+            for var in ['Nacept', 'Nreject']:
+                if (model, gal, var) in check:
+                    getattr(self, var)[model][gal] = float(check[model, gal, var])
+            for var in ['chi', 'acept_rate', 'param']:
+                rows = check.get((model, gal, var), [])
+                out_size = max(out_size, len(rows))
+                columns = None
+                if var == 'param':
+                    columns = check.get((model, gal, 'columns'))
+                # Remove all but curent few
+                store = MC.Chain_Store.from_rows(rows[-self._look_back:],
+                                                 columns, saved=True)
+                store.spill = self._spill(model, gal, var)
+                getattr(self, var)[model][gal] = store
+            # set activie param
+            self.active_chi[model][gal] = self.chi[model][gal][-1]
+            self.active_param[model][gal] = self.param[model][gal][-1]
+        for model in set(model for model, gal in objects):
             self.active_param[model] = pd.Panel(self.active_param[model])
         option.current = nu.array([[out_size]])
         # if multiprocessing send data
         lik_fun.send_fitting_data()
         self.SA(out_size, True)
         return lik_fun, option, burnin
-    
-    def _save_csv(self, indici, dump_number):
+
+    def _spill(self, model, gal, var):
+        '''Makes Chain_Store spill function that appends rows to
+        checkpoint'''
+        key = (model, gal, var)
+        def spill(rows):
+            self.checkpoint.append(key, rows)
+        return spill
+
+    def _save_checkpoint(self):
         '''Saves current state of chain incase run crashes'''
-        #ipdb.set_trace()
-        for model in self.save_path:
-            for gal in self.save_path[model]:
-                for param in self.save_path[model][gal]:
-                    if param in ['T_start']:
-                        save_param = eval('self.%s["%s"]'%(param,gal))
-                    else:
-                        try:
-                        
-                            save_param = eval('self.%s["%s"]["%s"]'%(param,
-                                                                    model, gal))
-                        except KeyError:
-                            print 'self.%s["%s"]["%s"] Does not exsist.'%(param
-                                                                ,model,gal)
-                        except:
-                            ipdb.set_trace()
-                    if isinstance(save_param, (nu.ndarray,list)):
-                        #check contents
-                        
-                        if isinstance(save_param[0], (float, nu.ndarray, list)):
-                            #check if
-                            nu.savetxt(self.save_path[model][gal][param][0],
-                                save_param[:-1])
-                        elif isinstance(save_param[0], pd.DataFrame):
-                            nu.savetxt(self.save_path[model][gal][param][0],
-                                    [i.values[0] for i in save_param[:-1]])
-                        # Save only current val
-                        if param in ['sigma']:
-                            nu.savetxt(self.save_path[model][gal][param][0],save_param)
-                            continue
-                        exec('self.%s["%s"]["%s"]=[save_param[-1]]'%(param, model, gal))
-                    elif isinstance(save_param, (float,int)):
-                        nu.savetxt(self.save_path[model][gal][param][0],
-                                   [save_param])
-                    else:
-                        ipdb.set_trace()
-                    if isinstance(self.save_path[model][gal][param][0],str):
-                        continue
-                    self.save_path[model][gal][param][0].flush()
+        for model in self.chi:
+            for gal in self.chi[model]:
+                for var in ['chi', 'acept_rate', 'param']:
+                    store = getattr(self, var)[model].get(gal)
+                    if isinstance(store, MC.Chain_Store):
+                        # write rows not saved yet
+                        store.flush()
+                # Save only current val
+                for var in ['sigma', 'Nacept', 'Nreject']:
+                    if gal in getattr(self, var)[model]:
+                        self.checkpoint.state((model, gal, var),
+                                              getattr(self, var)[model][gal])
+                self.checkpoint.state((model, gal, 'T_start'),
+                                      self.T_start[gal])
 
-    def _create_dir_sturct(self, path, lik):
-        '''Create dir structure for failure recovery.
-        Each model -> gal or object is giving a dir and
-        each varible is given own file. Global vars like sigma will be under
-        appropeate places'''
-        cur_parent = path
-        save_list = ['acept_rate', 'chi', 'sigma' ,'param'
-                     ,'T_start', 'Nacept', 'Nreject'] 
-        self.save_path = {}
-        # Top is model
-        models = self.chi.keys()
-        for model in models:
-            if not os.path.exists(os.path.join(cur_parent, model)):
-                os.mkdir(os.path.join(cur_parent, model))
-            cur_parent = os.path.join(cur_parent, model)
-            self.save_path[model] = {}
-            # save model param
-            for glob_modle in ['T_stop', 'burnin']:
-                nu.savetxt(os.path.join(cur_parent,glob_modle + '.csv'),
-                           [eval('self.%s'%glob_modle)])
-                
-            # Gal or obj
+    def _open_checkpoint(self, path, lik):
+        '''Starts checkpoint file for failure recovery in path.
+        Global vars, fitting data of each model -> gal or object and the
+        columns of param are saved first. Chains are appended as they
+        leave memory'''
+        self.checkpoint = MC.Checkpoint(os.path.join(path, CHECK_NAME))
+        for var in ['T_stop', 'burnin']:
+            self.checkpoint.state(('', '', var), getattr(self, var))
+        for model in self.chi:
             for gal in self.chi[model]:
-                if not os.path.exists(os.path.join(cur_parent, gal)):
-                    os.mkdir(os.path.join(cur_parent, gal))
-                cur_parent = os.path.join(cur_parent, gal)
-                self.save_path[model][gal] = {}
-                # save fitting data
-                nu.savetxt(os.path.join(cur_parent, gal+ '.csv'), lik.data[gal]
-                           ,header='wavelength, flux*%2.2f'%lik.norm[gal])
-                # Params in each Gal
-                for param in vars(self):
-                    if not param in save_list :
-                        continue
-                    # [save_obj, path]
-                    cur_parent = os.path.join(cur_parent, param +'.csv')
-                    # whether to append
-                    self.save_path[model][gal][param] =[]
-                    appender = self.save_path[model][gal][param].append
-                    if param in ['sigma','T_start', 'Nacept', 'Nreject']:
-                        # Overwrite
-                        appender(cur_parent)
-                    else:
-                        # Append
-                        appender(open(cur_parent,'a'))
-                    appender(cur_parent)
-                    if param == 'param':
-                        # Save header
-                        writer = self.save_path[model][gal][param][0].write
-                        writer(' '.join(self.param[model][gal][0].columns)+'\n')
-                        self.save_path[model][gal][param][0].flush()
-                    cur_parent = os.path.split(cur_parent)[0]
-                cur_parent = os.path.split(cur_parent)[0]
-            cur_parent = os.path.split(cur_parent)[0]
+                self.checkpoint.state((model, gal, 'data'), lik.data[gal])
+                self.checkpoint.state((model, gal, 'norm'), lik.norm[gal])
+                if self.param[model][gal].columns is not None:
+                    self.checkpoint.state((model, gal, 'columns'),
+                                          self.param[model][gal].columns)
+                for var in ['chi', 'acept_rate', 'param']:
+                    store = getattr(self, var)[model].get(gal)
+                    if isinstance(store, MC.Chain_Store):
+                        store.spill = self._spill(model, gal, var)
+        self._save_checkpoint()
+
+    def close_checkpoint(self):
+        '''Saves chains still in memory and closes checkpoint'''
+        if self.checkpoint is not None:
+            self._save_checkpoint()
+            self.checkpoint.close()
  
     def save_state(self, itter, lik=None):
         '''Saves current state of chain incase run crashes'''
@@ -467,9 +386,9 @@ class Param_MCMC(object):
                 os.mkdir('save_files')
             else:
                 raise OSError('Fail recovery exsits. Please delete before running again')
-            self._create_dir_sturct('save_files', lik)
+            self._open_checkpoint('save_files', lik)
         if itter % save_num == 0 and itter > 0:
-            self._save_csv(itter, save_num)
+            self._save_checkpoint()
             #print 'done'
             
     def singleObjSplit(self):
@@ -484,8 +403,8 @@ class Param_MCMC(object):
         else:
             self.Nacept[self.bins][gal] += 1
         
-        self.param[self.bins][gal].append(self.active_param[self.bins][gal].copy())
-        self.chi[self.bins][gal].append((new_chi)+0)
+        self.param[self.bins][gal].append(self.active_param[self.bins][gal])
+        self.chi[self.bins][gal].append(new_chi)
         
     def reject(self, gal):
         '''Rejects current state and gets data from memory'''
@@ -496,12 +415,10 @@ class Param_MCMC(object):
         else:
             self.Nreject[self.bins][gal] = 1
         
-        self.active_param[self.bins][gal] = pd.DataFrame(
-            self.param[self.bins][gal][-1].values.copy(),index=[0],
-            columns=self.param[self.bins][gal][-1].columns.copy())
-        self.param[self.bins][gal].append(self.param[self.bins][gal][-1].copy())
-        self.chi[self.bins][gal].append(self.chi[self.bins][gal][-1].copy())
-        self.active_chi[self.bins][gal] = self.chi[self.bins][gal][-1].copy()
+        self.active_param[self.bins][gal] = self.param[self.bins][gal][-1]
+        self.param[self.bins][gal].repeat()
+        self.chi[self.bins][gal].repeat()
+        self.active_chi[self.bins][gal] = self.chi[self.bins][gal][-1]
         
     def step(self, fun, num_iter,step_freq=500.):
         '''check if time to change step size'''
@@ -518,7 +435,7 @@ class Param_MCMC(object):
         bins = self.bins
         for gal in self.chi[bins]:
             if not gal in self.acept_rate[bins]:
-                self.acept_rate[bins][gal] = []
+                self.acept_rate[bins][gal] = MC.Chain_Store()
             # No Nacept acept_rate = 0
             if not gal in self.Nacept[bins]:
                 self.acept_rate[bins][gal].append(0.)
@@ -530,6 +447,19 @@ class Param_MCMC(object):
                                                 float(self.Nacept[bins][gal] +
                                                 self.Nreject[bins][gal]))
 
+    def ess(self, num_iter):
+        '''(Param_MCMC, int) -> float
+        Smallest effective sample size of all galaxies and params in the
+        last num_iter itterations. Autocorrelation time is from the rows
+        in memory and at least 1, so ess is never more than num_iter'''
+        bins = self.bins
+        out = []
+        for gal in self.param[bins]:
+            chain = self.param[bins][gal].window(num_iter)
+            tau = nu.nanmax(MC.integrated_time(chain))
+            out.append(num_iter / max(tau, 1.))
+        return nu.nanmin(out)
+
     def tune_sa(self):
         '''Tune acceptace rate by changing the SA param'''
         bins = self.Nacept.keys()[0]
@@ -564,7 +494,8 @@ class Param_MCMC(object):
         if chain_number < self.burnin or fail_recover:
             for gal in self.T_start:
                 # make temp close to chi
-                chi_max = abs(nu.max(self.chi[bins][gal]))
+                chi_max = abs(nu.max(self.chi[bins][gal].window(
+                    self._look_back)))
                 if self.T_start[gal] > chi_max:
                     self.T_start[gal] = chi_max
                 #calculate anneeling
@@ -37,7 +37,11 @@ import MC_utils as MC
 import pandas as pd
 from Age_mltry import Param_MCMC, MCMCError
 import ipdb
-from mpi4py import MPI as mpi
+try:
+    from mpi4py import MPI as mpi
+except ImportError:
+    # replicas on 1 node
+    mpi = None
 # import acor
 # from memory_profiler import profile
 from glob import glob
@@ -51,8 +55,11 @@ def tempering_main(fun, option, burnin=5*10**3,  max_iter=10**5,
     # see if to use specific seed
     if seed is not None:
         nu.random.seed(seed)
+        # own stream for proposals of each galaxy
+        if hasattr(fun, 'streams'):
+            fun.streams = MC.Random_Streams(seed)
     # set mpi comm
-    comm = mpi.COMM_WORLD
+    comm = mpi.COMM_WORLD if mpi is not None else None
     # initalize paramerts/class for use by program
     Param = Param_temp(fun, burnin)
     if fail_recover:
@@ -156,49 +163,83 @@ def mh_critera(chi_old, chi_new, sa=1.):
         return False
 
 def swap_temp(Param, itter, swap_it=20):
-    '''Does temp swap every few itterations'''
+    '''Does sweep of swaps between neighbouring temperatures every few
+    itterations, even pairs then odd pairs on the next sweep'''
     if itter % swap_it == 0 and itter > 0:
-        #select 2 chains to swap
         bins = Param.bins
-        keys = list(Param.active_param[bins].keys())
-        gal1 = nu.random.choice(keys)
-        # check if swap up or down one
-        if int(gal1.split('_')[-1]) == 0:
-            # Must be up
-            goto = 1
-        elif int(gal1.split('_')[-1]) == len(keys) -1 :
-            # must be down
-            goto = len(keys) - 2
-        else:
-            if nu.random.rand() > .5:
-                # Go up
-                goto = int(gal1.split('_')[-1]) + 1
-                
+        ladder = Param.ladder
+        chi = nu.array([Param.active_chi[bins][gal] for gal in ladder.keys],
+                       dtype=float)
+        sa = nu.array([Param.sa[gal] for gal in ladder.keys], dtype=float)
+        parity = (itter // swap_it) % 2
+        accepted = ladder.sweep(chi, sa, parity)
+        for i in nu.arange(parity, len(ladder.keys) - 1, 2):
+            gal1, gal2 = ladder.keys[i], ladder.keys[i + 1]
+            if i in accepted:
+                Param._change_state(gal1, gal2)
+                Param.temp_exchange[bins][gal1]['accept'] += 1
+                # reset Naccepted and Nrejected
+                for gal in [gal1, gal2]:
+                    Param.Nacept[bins][gal] = 1.
+                    Param.Nreject[bins][gal] = 1.
             else:
-                # Go down
-                goto = int(gal1.split('_')[-1]) - 1
-        for gal in keys:
-            if int(gal.split('_')[-1]) == goto:
-                gal2 = gal + ''
-                break
-        else:
-            print gal1, keys,'problem'
-        # MH criera with SA to see if should swap
-        if mh_critera(Param.active_chi[bins][gal1]/Param.sa[gal1],
-                      Param.active_chi[bins][gal2]/Param.sa[gal2]):
-            # accept
-            #ipdb.set_trace()
-            Param._change_state(gal1, gal2)
-            Param.temp_exchange[bins][gal1]['accept'] += 1
-            # reset Naccepted and Nrejected
-            for gal in [gal1, gal2]:
-                Param.Nacept[bins][gal] = 1.
-                Param.Nreject[bins][gal] = 1.
-            #print gal1, gal2
-        else:
-            # reject don't do anything
-            Param.temp_exchange[bins][gal1]['reject'] += 1
-        Param.tune_sa()
+                Param.temp_exchange[bins][gal1]['reject'] += 1
+        Param.tune_sa(itter)
+
+
+class Temp_Ladder(object):
+    '''Temperatures of replicas, coldest first. Swaps between all
+    neighbours of the same parity are tried at once and the spacing of the
+    temperatures is adapted toward the same swap rate between all
+    neighbours, keeping the coldest and hottest fixed.
+
+    Temperatures are sa of mh_critera, so replica i samples
+    exp(chi / (2 sa_i)).'''
+    def __init__(self, keys, temps, lag=100., gain=.1, memory=.05):
+        self.keys = list(keys)
+        self.temps = nu.asarray(temps, dtype=float)
+        self.lag = float(lag)
+        self.gain = gain
+        self.memory = memory
+        self.accept = nu.zeros(len(self.keys) - 1)
+        self.tries = nu.zeros(len(self.keys) - 1)
+        # running mean of swap acceptance probablity
+        self.rate = nu.zeros(len(self.keys) - 1) + .5
+        self._n_adapt = 0
+
+    def sweep(self, chi, sa=None, parity=0):
+        '''(Temp_Ladder, ndarray, ndarray, int) -> ndarray
+        Tries swaps of (i, i+1) for all i with parity, chi and sa of
+        replicas in ladder order (sa default temps). Returns i of accepted
+        pairs'''
+        if sa is None:
+            sa = self.temps
+        i = nu.arange(parity, len(self.keys) - 1, 2)
+        beta = 1. / (2. * nu.asarray(sa, dtype=float))
+        log_a = (beta[i] - beta[i + 1]) * (chi[i + 1] - chi[i])
+        log_a[~nu.isfinite(log_a)] = -nu.inf
+        accepted = nu.log(nu.random.rand(len(i))) < log_a
+        self.tries[i] += 1
+        self.accept[i] += accepted
+        self.rate[i] += self.memory * (nu.exp(nu.minimum(log_a, 0)) -
+                                       self.rate[i])
+        return i[accepted]
+
+    def adapt(self):
+        '''Changes spacing of log temperatures, wider where swaps are
+        accepted more than average. Step size decays with number of calls.
+        Returns new temps'''
+        if len(self.keys) < 3:
+            return self.temps
+        self._n_adapt += 1
+        kappa = self.gain * self.lag / (self.lag + self._n_adapt)
+        log_temp = nu.log(self.temps)
+        gap = nu.diff(log_temp)
+        gap *= nu.exp(kappa * (self.rate - self.rate.mean()))
+        gap *= (log_temp[-1] - log_temp[0]) / gap.sum()
+        self.temps = nu.exp(log_temp[0] + nu.concatenate(([0],
+                                                          nu.cumsum(gap))))
+        return self.temps
 
             
 class Param_temp(Param_MCMC):
@@ -218,7 +259,7 @@ class Param_temp(Param_MCMC):
                 #self.active_chi[bins][gal] = {}
                 self.out_sigma[bins][gal]  =  [self.sigma[bins][gal][:]]
             
-                self.acept_rate[bins][gal] = []
+                self.acept_rate[bins][gal] = MC.Chain_Store()
             
         # check if params are in range
         lik, prior = (lik_fun.lik(self.active_param, bins),
@@ -228,70 +269,30 @@ class Param_temp(Param_MCMC):
         for Prior, gal in prior:
             if not nu.isfinite(Prior):
                 return True
-            self.chi[bins][gal] = [Prior]
+            self.chi[bins][gal] = MC.Chain_Store(Prior)
             self.active_chi[bins][gal] = Prior
         for Lik, gal in lik:
             if not nu.isfinite(Lik):
                 return True
             self.chi[bins][gal][-1] += Lik
             self.active_chi[bins][gal] = Lik
-            self.param[bins][gal] = [self.active_param[bins][gal].copy()]
-            self.T_start[gal] = abs(nu.max(self.chi[bins].values()))
+            self.param[bins][gal] = MC.Chain_Store(self.active_param[bins][gal])
+            self.T_start[gal] = abs(nu.max([i[-1] for i in
+                                            self.chi[bins].values()]))
         # initalize tempering
         self.SA(0, size=lik_fun._size)
         #self.save_state(0, lik_fun)
-        return not nu.all(nu.isfinite(self.chi[bins].values()))
-
-    def tune_sa(self, min_rate=.2, max_rate=.6):
-        '''Turns T and delta T so interchange rate is 20-60%'''
-        bins = self.bins
-        for gal in self.acept_rate[bins]:
-            '''if self.acept_rate[bins][gal][-1] < .2:
-                # increase temp
-                self.T_start[gal] *= 1.05
-            elif self.acept_rate[bins][gal][-1] > .5:
-                # decrease temp
-                self.T_start[gal] /= 1.05'''
-        for gal in self.temp_exchange[bins]:
-            rate = (self.temp_exchange[bins][gal]['accept'] /
-                    float(self.temp_exchange[bins][gal]['accept']+
-                          self.temp_exchange[bins][gal]['reject']))
-            if rate < min_rate:
-                # decrease delta_t
-                self.delta_T[gal] *= 1.05
-                self._chg_delta_t()
-            elif rate > max_rate:
-                # increase delta_t
-                self.delta_T[gal] /= 1.05
-                self._chg_delta_t()
+        return not nu.all(nu.isfinite([i[-1] for i in
+                                       self.chi[bins].values()]))
 
-            
-        print rate #, self.T_stop,self.sa
-
-            
-    def _chg_delta_t(self):
-        '''Changes spacing between anneeling temp'''
-        start_temp = min(self.T_start.values()) 
-        stop_temp = min(self.T_stop.values())
-        for gal in self.T_start:
-            mult = int(gal.split('_')[-1])
-            self.T_start[gal] = start_temp + self.delta_T[gal] * mult
-            self.T_stop[gal] = stop_temp + self.delta_T[gal] * mult
-            # make sure T_stop is smaller
-            if self.T_stop[gal] > self.T_start[gal]:
-                temp = self.T_start[gal] + 0
-                self.T_start[gal] = self.T_stop[gal] + 0
-                self.T_stop[gal] = temp
-        # check if in right order
-        orderd_start = nu.sort(self.T_start.values())
-        orderd_stop = nu.sort(self.T_stop.values())
-        for gal in self.T_start:
-            mult = int(gal.split('_')[-1])
-            if not orderd_start[mult] == self.T_start[gal]:
-                self.T_start[gal] = orderd_start[mult] +0
-            if not orderd_stop[mult] == self.T_stop[gal]:
-                self.T_stop[gal] = orderd_stop[mult] +0
-        #print 'start',self.T_stop
+    def tune_sa(self, itter=None):
+        '''Adapts temperature ladder to same swap rate between neighbours,
+        once anneeling is done'''
+        if itter is None or itter < self.burnin:
+            return None
+        for gal, temp in zip(self.ladder.keys, self.ladder.adapt()):
+            self.T_stop[gal] = temp
+            self.sa[gal] = temp
 
     def _change_state(self, src, dest, swap=True):
         '''Changes state of mcmc. Everything except aneeling param'''
@@ -328,42 +329,31 @@ class Param_temp(Param_MCMC):
     def stop_tempering(self):
         '''stops tempering and starts all chains at T=1 state in
         parallel to save time'''
-        bins = self.active_param.keys()[0]
-        # find gal key for min temperature
-        for key in self.active_param[bins]:
-            if int(key.split('_')[-1]) == 0:
-                break
-        for gal in self.active_param[bins]:
+        # coldest chain
+        key = self.ladder.keys[0]
+        for gal in self.ladder.keys:
             self._change_state(key, gal, False)
             self.sa[gal] = 1.
-        self.T_stop[gal] = 1.
+            self.T_stop[gal] = 1.
             
     def SA(self, chain_number, fail_recover=False, size=5):
-        '''Calculates and initalizes anneeling params'''
+        '''Calculates and initalizes anneeling params. All chains start at
+        hottest temperature and are anneeled to a geometric ladder from 1
+        to the hottest'''
         bins = self.active_param.keys()[0]
-        max_chi = 0 #nu.max(self.active_chi[bins].values())
-        min_chi = nu.min(self.active_chi[bins].values())
         
         if chain_number == 0 or fail_recover:
-            # initalize
-            self.delta_T = {}
-            delta_T = (max_chi - min_chi) / float(size)
-            self.sa = {}
-            self.T_start = {}
-            self.T_stop = {}
-            # set range of temperatures
-            for gal,sa in enumerate(nu.arange(min_chi, max_chi, delta_T)):
-                for key in self.active_chi[bins]:
-                    #print key
-                    self.delta_T[key] = (max_chi - min_chi) / float(size)
-                    if int(key.split('_')[-1]) == gal:
-                        # stop at temp before current
-                        if gal == 0:
-                            self.T_stop[key] = 1.
-                        else:
-                            self.T_stop[key] = nu.max(self.sa.values())
-                        self.sa[key] = abs(sa)
-                        self.T_start[key] = abs(sa)
+            # initalize, replica number is after last _
+            keys = sorted(self.active_chi[bins],
+                          key=lambda gal: int(gal.split('_')[-1]))
+            hot = max(abs(nu.min(self.active_chi[bins].values())), 1.)
+            temps = hot ** (nu.arange(len(keys)) / max(len(keys) - 1., 1.))
+            self.ladder = Temp_Ladder(keys, temps)
+            self.sa, self.T_start, self.T_stop = {}, {}, {}
+            for key, temp in zip(keys, temps):
+                self.T_start[key] = hot
+                self.T_stop[key] = temp
+                self.sa[key] = hot
             if fail_recover:
                 # Check if before or after burnin
                 if chain_number > self.burnin * 2:
@@ -384,6 +374,3 @@ class Param_temp(Param_MCMC):
                     # check if sa is 0 and set to 1
                     if self.sa[gal] <= 0:
                         self.sa[gal] = 1.
-                    
-              
-    
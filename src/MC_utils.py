@@ -43,9 +43,12 @@ from scipy.cluster.hierarchy import fcluster,linkage
 import os, sys, subprocess
 from time import time
 import signal
-import acor
+import threading, Queue
+import hashlib
 import ipdb
 ###ALL##########
+#version of Checkpoint files
+CHECK_VERSION = 1
 
 ##########Proposals######
 def normal(mu,sigma):
@@ -146,7 +149,183 @@ def delayed_rejection(xi, pxi,xnext,pxnext,sigma,bins, fun):
     return xi, acc, lik, pr, prop
 
 
+########Random streams#############
+def stream_seed(*key):
+    '''(...) -> ndarray
+    Seed of random stream for key, 8 uint32 words of the sha256 of the
+    repr of key. Different keys give uncorrelated streams'''
+    digest = hashlib.sha256(repr(key)).digest()
+    return nu.frombuffer(digest, dtype='<u4').copy()
+
+class Random_Streams(object):
+    '''Independent random streams of a run, one for each chain, replica or
+    worker. Stream of a key (e.g. ('worker', rank) or ('proposal', gal))
+    is seeded from the run entropy and key, so a run with the same
+    entropy gives every chain the same numbers however many chains there
+    are or where they run. Streams are RandomStates, use size for batch
+    draws. Pickles with its streams, to send to workers'''
+    def __init__(self, entropy=None):
+        if entropy is None:
+            entropy = int(os.urandom(16).encode('hex'), 16)
+        self.entropy = entropy
+        self._streams = {}
+
+    def seed(self, *key):
+        '''(Random_Streams, ...) -> ndarray
+        Seed of stream key'''
+        return stream_seed(self.entropy, *key)
+
+    def stream(self, *key):
+        '''(Random_Streams, ...) -> RandomState
+        Stream of key, same object on every call'''
+        if key not in self._streams:
+            self._streams[key] = nu.random.RandomState(self.seed(*key))
+        return self._streams[key]
+
+    def spawn(self, n, *key):
+        '''(Random_Streams, int, ...) -> list(RandomState)
+        Streams key + (i,) for i in range(n)'''
+        return [self.stream(*(key + (i,))) for i in xrange(n)]
+
+    def seed_global(self, *key):
+        '''Seeds global numpy state with stream key, for workers whose
+        sampler draws from nu.random'''
+        nu.random.seed(self.seed(*key))
+
 ########Step Calulators#############
+class Adapt_Cov(object):
+    '''Adaptive Metropolis proposal. Keeps running mean and covariance of
+    chain rows (Welford) and draws steps mu + L z with a cached Cholesky
+    factor L of the proposal covariance sigma.
+
+    sigma starts as the given step size. Once min_rows rows are added
+    it is scale times the running covariance and L is kept up to date
+    with a rank-one update for each row, refactored every refactor rows
+    or after a batch of rows. Diagonal of sigma is kept above floor when
+    refactored. sigma is changed in place, so it can be handed back to
+    the sampler as the step size.'''
+    def __init__(self, sigma, min_rows=100, refactor=100, floor=0.):
+        self.sigma = nu.asarray(sigma, dtype=float)
+        if self.sigma.ndim < 2:
+            self.sigma = nu.diag(nu.atleast_1d(self.sigma))
+        self.scale = 1.
+        self.min_rows = min_rows
+        self.refactor = refactor
+        self.floor = floor
+        self.n = 0
+        self.mean = nu.zeros(self.sigma.shape[0])
+        self._m2 = nu.zeros_like(self.sigma)
+        #rows of chain already added
+        self.seen = 0
+        self._since = 0
+        self._factor()
+
+    @classmethod
+    def of(cls, sigma, cache, **kwargs):
+        '''(ndarray, dict, ...) -> Adapt_Cov
+        Adapt_Cov in cache whose sigma is the array sigma, or a new one
+        added to cache'''
+        adapt = cache.get(id(sigma))
+        if adapt is None or adapt.sigma is not sigma:
+            adapt = cls(sigma, **kwargs)
+            cache[id(adapt.sigma)] = adapt
+        return adapt
+
+    @property
+    def cov(self):
+        '''Running covariance of added rows'''
+        return self._m2 / max(self.n - 1., 1.)
+
+    def _factor(self):
+        #cholesky of sigma, adding jitter if it isn't positive definite
+        diag = nu.diagonal(self.sigma).copy()
+        self.sigma[nu.diag_indices_from(self.sigma)] = nu.maximum(diag,
+                                                                  self.floor)
+        jitter = 0.
+        for i in xrange(20):
+            try:
+                self.chol = nu.linalg.cholesky(self.sigma +
+                                               jitter * nu.eye(len(diag)))
+                break
+            except nu.linalg.LinAlgError:
+                jitter = jitter * 10 or 1e-10 * max(diag.max(), 1e-10)
+        else:
+            raise nu.linalg.LinAlgError('sigma is not positive definite')
+        self._since = 0
+
+    def _follow(self):
+        #sigma is scaled running covariance
+        self.sigma[:] = self.scale * self.cov
+        self._factor()
+
+    def update(self, rows):
+        '''Adds rows (N, d) or a row of the chain'''
+        rows = nu.asarray(rows, dtype=float)
+        rows = rows.reshape(-1, self.mean.shape[0])
+        if rows.shape[0] == 0:
+            return None
+        following = self.n >= self.min_rows
+        if not following and self.n + rows.shape[0] >= self.min_rows:
+            #switching from given step size to running covariance
+            self.scale = 1.
+        if rows.shape[0] == 1:
+            #welford
+            self.n += 1
+            delta = rows[0] - self.mean
+            self.mean += delta / self.n
+            self._m2 += nu.outer(delta, rows[0] - self.mean)
+            if following and self._since < self.refactor:
+                #sigma_n = a sigma_n-1 + scale/n delta delta^T
+                a = (self.n - 2.) / (self.n - 1.)
+                self.sigma *= a
+                self.sigma += self.scale / self.n * nu.outer(delta, delta)
+                self.chol *= nu.sqrt(a)
+                _chol_update(self.chol, nu.sqrt(self.scale / self.n) * delta)
+                self._since += 1
+                return None
+        else:
+            #merge with batch statistics
+            n = rows.shape[0]
+            mean = rows.mean(0)
+            dev = rows - mean
+            delta = mean - self.mean
+            total = self.n + n
+            self._m2 += (nu.dot(dev.T, dev) +
+                         nu.outer(delta, delta) * self.n * n / float(total))
+            self.mean += delta * n / float(total)
+            self.n = total
+        if self.n >= self.min_rows:
+            self._follow()
+
+    def rescale(self, factor):
+        '''Multiplies proposal covariance by factor'''
+        self.scale *= factor
+        self.sigma *= factor
+        self.chol *= nu.sqrt(factor)
+        if nu.any(nu.diagonal(self.sigma) < self.floor):
+            self._factor()
+
+    def draw(self, mu, size=None, random=None):
+        '''(Adapt_Cov, ndarray, int or None, RandomState) -> ndarray
+        Step from mu, or (size, d) array of steps. Drawn from stream
+        random, default global numpy state'''
+        if random is None:
+            random = nu.random
+        shape = (self.mean.shape[0],) if size is None else (size,
+                                                        self.mean.shape[0])
+        z = random.standard_normal(shape)
+        return nu.asarray(mu, dtype=float) + nu.dot(z, self.chol.T)
+
+def _chol_update(chol, x):
+    #in place rank-one update of lower cholesky factor, L L^T + x x^T
+    x = x.copy()
+    for k in xrange(x.shape[0]):
+        r = nu.hypot(chol[k, k], x[k])
+        c, s = r / chol[k, k], x[k] / chol[k, k]
+        chol[k, k] = r
+        chol[k + 1:, k] = (chol[k + 1:, k] + s * x[k + 1:]) / c
+        x[k + 1:] = c * x[k + 1:] - s * chol[k + 1:, k]
+
 def param_cov(param,samples):
     pass
 
@@ -356,57 +535,502 @@ def _check_len(tparam, key, age_unq):
             param = {key:tparam}
         else:
             raise TypeError('input must be dict or ndarray')
-        #make sure age is sorted
-        if not issorted(param[key][:,1]):
-            return False
-        #make sure bins do not overlap fix if they are
-        for i in xrange(param[key].shape[0]-1):
-            #assume orderd by age
-            max_age = param[key][i,0]/2. + param[key][i,1]
-            min_age_i = param[key][i+1,1] - param[key][i+1,0]/2.
-            if max_age > min_age_i:
-                #overlap
-                #make sure overlap is significant
-                if not nu.allclose(max_age, min_age_i):
-                    return False
-            #check if in age bounds
-            if i == 0:
-                if age_unq.min() > param[key][i,1] - param[key][i,0]/2.:
-                    return False
-        else:
-            if age_unq.max() < param[key][-1,1] + param[key][-1,0]/2.:
-                if not nu.allclose(param[key][-1,1] + param[key][-1,0]/2,age_unq.max()):
-                    return False
-        #check if length is less than age_unq.ptp()
-        if param[key][:,0].sum() > age_unq.ptp():
-            if not nu.allclose( param[key][:,0].sum(),age_unq.ptp()):
-                return False
-        #make sure age is in bounds
-        
-        #passed all tests
-        return True
+        return bool(check_len_many(param[key], age_unq)[0])
+
+def check_len_many(gal, age_unq):
+    '''(ndarray, ndarray) -> ndarray(bool)
+    _check_len of (N, nbins, 4) or (nbins, 4) array of [length, age, metal,
+    norm] bins. All points are checked at once.
+    '''
+    gal = nu.asarray(gal, dtype=float)
+    if gal.ndim == 2:
+        gal = gal[nu.newaxis]
+    length, age = gal[:, :, 0], gal[:, :, 1]
+    #make sure age is sorted
+    out = nu.all(age[:, 1:] >= age[:, :-1], 1)
+    #bins do not overlap, unless overlap isn't significant
+    max_age = length[:, :-1] / 2. + age[:, :-1]
+    min_age = age[:, 1:] - length[:, 1:] / 2.
+    out &= ~nu.any((max_age > min_age) & ~nu.isclose(max_age, min_age), 1)
+    #check if in age bounds, lower only checked with more than 1 bin
+    if gal.shape[1] > 1:
+        out &= ~(age_unq.min() > age[:, 0] - length[:, 0] / 2.)
+    end = age[:, -1] + length[:, -1] / 2.
+    out &= ~((age_unq.max() < end) & ~nu.isclose(end, age_unq.max()))
+    #check if length is less than age_unq.ptp()
+    total = length.sum(1)
+    out &= ~((total > age_unq.ptp()) & ~nu.isclose(total, age_unq.ptp()))
+    return out
+
+def norm_logpdf(x, mu, sigma):
+    '''(ndarray, ndarray, ndarray) -> ndarray
+    log of normal pdf, same as stats_dist.norm.logpdf without the
+    overhead'''
+    z = (nu.asarray(x) - mu) / sigma
+    return -0.5 * z**2 - nu.log(sigma) - 0.5 * nu.log(2 * nu.pi)
+
+class Gauss_Lik(object):
+    '''Gaussian log-likelihood of a data set. Inverse variances, the
+    normalization constant and data.data are made once, so each call is a
+    weighted dot product of the residuals.
+
+    Linear amplitudes of the models can be solved (amplitude), profiled
+    (profile) or marginalized with a flat prior (marginalize)
+    analytically. gram gives the normal equations for many amplitudes.
+    '''
+    def __init__(self, flux, sigma=None):
+        '''(Gauss_Lik, ndarray, ndarray or None) -> NoneType
+        flux and uncertanty of data, sigma=None is unit uncertanty'''
+        self.flux = nu.asarray(flux, dtype=float)
+        if sigma is None:
+            sigma = nu.ones_like(self.flux)
+        sigma = nu.asarray(sigma, dtype=float)
+        self.ivar = sigma**-2
+        self.wflux = self.flux * self.ivar
+        self.dd = nu.dot(self.wflux, self.flux)
+        self.log_norm = (-nu.log(sigma).sum() -
+                         0.5 * self.flux.shape[0] * nu.log(2 * nu.pi))
+
+    def __call__(self, model):
+        '''(Gauss_Lik, ndarray) -> ndarray
+        log-likelihood of each row of model'''
+        resid = nu.asarray(model) - self.flux
+        return self.log_norm - 0.5 * nu.dot(resid**2, self.ivar)
+
+    def _project(self, model):
+        #model.data and model.model for each row
+        model = nu.asarray(model)
+        return nu.dot(model, self.wflux), nu.dot(model**2, self.ivar)
+
+    def amplitude(self, model):
+        '''(Gauss_Lik, ndarray) -> ndarray
+        best fit amplitude of each row of model'''
+        md, mm = self._project(model)
+        return md / mm
+
+    def profile(self, model):
+        '''(Gauss_Lik, ndarray) -> ndarray, ndarray
+        log-likelihood of each row of model at its best fit amplitude and
+        the amplitudes'''
+        md, mm = self._project(model)
+        return self.log_norm - 0.5 * (self.dd - md**2 / mm), md / mm
+
+    def marginalize(self, model):
+        '''(Gauss_Lik, ndarray) -> ndarray
+        log-likelihood of each row of model with its amplitude integrated
+        out over a flat prior'''
+        md, mm = self._project(model)
+        return (self.log_norm - 0.5 * (self.dd - md**2 / mm) +
+                0.5 * nu.log(2 * nu.pi / mm))
+
+    def gram(self, components):
+        '''(Gauss_Lik, ndarray) -> ndarray, ndarray
+        Normal equations of (ncomp, npix) components, G = C W C^T and
+        b = C W d. chi2 of amplitudes a is dd - 2 a.b + a.G.a'''
+        components = nu.asarray(components)
+        return (nu.dot(components * self.ivar, components.T),
+                nu.dot(components, self.wflux))
+
+
+class Domain(object):
+    '''Box shaped domain of a flat parameter vector, with independent
+    uniform, normal or flat (free) priors on each parameter. Parameters
+    are added in order of the columns and bounds can be narrowed with
+    clip. contains and logpdf take an (N, ndim) array and do all points
+    at once with closed form priors.
+    '''
+    def __init__(self):
+        self.names = []
+        self.slices = {}
+        self.ndim = 0
+        self._lower, self._upper = [], []
+        self._mu, self._sigma = [], []
+        self._log_norm = 0.
+        self._compiled = False
+
+    def _add(self, name, size, lower, upper, mu, sigma):
+        assert name not in self.slices, '%s is already in domain' % name
+        self.names.append(name)
+        self.slices[name] = slice(self.ndim, self.ndim + size)
+        self.ndim += size
+        self._lower.append(nu.zeros(size) + lower)
+        self._upper.append(nu.zeros(size) + upper)
+        self._mu.append(nu.zeros(size) + mu)
+        self._sigma.append(nu.zeros(size) + sigma)
+        self._compiled = False
+
+    def uniform(self, name, loc, scale, size=1):
+        '''Uniform on [loc, loc + scale], like stats_dist.uniform'''
+        self._add(name, size, loc, nu.add(loc, scale), 0., nu.inf)
+        self._log_norm -= nu.sum(nu.zeros(size) + nu.log(scale))
+
+    def normal(self, name, mu, sigma, size=1):
+        '''Normal with mean mu and std sigma'''
+        self._add(name, size, -nu.inf, nu.inf, mu, sigma)
+        self._log_norm -= nu.sum(nu.zeros(size) + nu.log(sigma) +
+                                 0.5 * nu.log(2 * nu.pi))
+
+    def free(self, name, size=1):
+        '''No prior, only bounds from clip'''
+        self._add(name, size, -nu.inf, nu.inf, 0., nu.inf)
+
+    def clip(self, name, lower=-nu.inf, upper=nu.inf):
+        '''Narrows bounds of name, does not change normalization of its
+        prior'''
+        i = self.names.index(name)
+        self._lower[i] = nu.maximum(self._lower[i], lower)
+        self._upper[i] = nu.minimum(self._upper[i], upper)
+        self._compiled = False
+
+    def _compile(self):
+        self.lower = nu.concatenate(self._lower)
+        self.upper = nu.concatenate(self._upper)
+        sigma = nu.concatenate(self._sigma)
+        self._normal = nu.nonzero(nu.isfinite(sigma))[0]
+        self._normal_mu = nu.concatenate(self._mu)[self._normal]
+        self._normal_sigma = sigma[self._normal]
+        self._compiled = True
+
+    def contains(self, points):
+        '''(Domain, ndarray) -> ndarray(bool)
+        True for rows of points inside bounds'''
+        if not self._compiled:
+            self._compile()
+        points = nu.atleast_2d(points)
+        return nu.all((points >= self.lower) & (points <= self.upper), 1)
+
+    def logpdf(self, points):
+        '''(Domain, ndarray) -> ndarray
+        log-prior of each row of points, -inf outside bounds'''
+        if not self._compiled:
+            self._compile()
+        points = nu.atleast_2d(points)
+        out = nu.zeros(points.shape[0]) + self._log_norm
+        if len(self._normal) > 0:
+            z = ((points[:, self._normal] - self._normal_mu) /
+                 self._normal_sigma)
+            out -= 0.5 * (z**2).sum(1)
+        out[~self.contains(points)] = -nu.inf
+        return out
+
+class Chain_Store(object):
+    '''Chain of one model and galaxy in a preallocated array, used like a
+    list of rows. Rows can be 1 row DataFrames, 1-d arrays or floats and
+    are given back as the same type.
+
+    Appending is amortized O(1). The last keep rows are always in memory
+    and slices of them are views of the buffer, for tuning windows. Older
+    rows are dropped when the buffer fills, after being passed in chunks
+    to spill(rows) if it is set.'''
+    def __init__(self, first=None, keep=4096, spill=None):
+        self.keep = keep
+        self.spill = spill
+        self.columns = None
+        self._frame = None
+        self._buf = None
+        #total index of _buf[0], rows in _buf and rows passed to spill
+        self._start, self._end, self._saved = 0, 0, 0
+        if first is not None:
+            self.append(first)
+
+    @classmethod
+    def from_rows(cls, rows, columns=None, keep=4096, spill=None,
+                  saved=False):
+        '''(2-d ndarray, list, int, callable, bool) -> Chain_Store
+        Store of rows. If columns rows are given back as DataFrames,
+        if 1-d rows are floats. saved marks rows as already spilled'''
+        rows = nu.atleast_1d(nu.asarray(rows, dtype=float))
+        out = cls(keep=max(keep, rows.shape[0]), spill=spill)
+        out._alloc(1 if rows.ndim == 1 else rows.shape[1])
+        out._buf[:rows.shape[0]] = rows.reshape(rows.shape[0], -1)
+        out._end = rows.shape[0]
+        if columns is not None:
+            import pandas as pd
+            out.columns, out._frame = list(columns), pd.DataFrame
+        elif rows.ndim == 2:
+            out._frame = nu.ndarray
+        if saved:
+            out._saved = out._end
+        return out
+
+    def _alloc(self, width):
+        self._buf = nu.empty((2 * self.keep, width))
+
+    def _to_row(self, row):
+        #1-d float array of row, sets type on first row
+        if hasattr(row, 'columns'):
+            if self._frame is None:
+                self._frame, self.columns = type(row), list(row.columns)
+            return nu.asarray(row.values, dtype=float).ravel()
+        row = nu.asarray(row, dtype=float)
+        if self._buf is None and row.ndim > 0:
+            self._frame = nu.ndarray
+        return row.ravel()
+
+    def _from_row(self, row):
+        if self._frame is None:
+            return row[0]
+        if self._frame is nu.ndarray:
+            return row.copy()
+        return self._frame(row[nu.newaxis], columns=self.columns)
+
+    def __len__(self):
+        return self._start + self._end
+
+    def _local(self, i):
+        #index in _buf of total index i
+        if i < 0:
+            i += len(self)
+        if i < self._start or i >= len(self):
+            raise IndexError('Chain_Store index out of range or not in memory')
+        return i - self._start
+
+    def append(self, row):
+        '''Adds row to end of chain'''
+        row = self._to_row(row)
+        if self._buf is None:
+            self._alloc(row.shape[0])
+        elif self._end == self._buf.shape[0]:
+            self._compact()
+        self._buf[self._end] = row
+        self._end += 1
+
+    def repeat(self):
+        '''Appends a copy of the last row, without converting it'''
+        if self._end == self._buf.shape[0]:
+            self._compact()
+        self._buf[self._end] = self._buf[self._end - 1]
+        self._end += 1
+
+    def _compact(self):
+        #keep last keep rows, spilling the rest first
+        drop = self._end - self.keep
+        self.flush(self._start + drop)
+        self._buf[:self.keep] = self._buf[drop:self._end]
+        self._start += drop
+        self._end = self.keep
+
+    def flush(self, stop=None):
+        '''Passes rows not yet spilled, up to total index stop (default
+        all), to spill'''
+        if stop is None:
+            stop = len(self)
+        if self.spill is not None and stop > self._saved:
+            rows = self._buf[self._local(self._saved):stop - self._start]
+            self.spill(rows[:, 0] if self._frame is None else rows)
+        self._saved = max(self._saved, stop)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.window(i)
+        return self._from_row(self._buf[self._local(i)])
+
+    def __setitem__(self, i, row):
+        self._buf[self._local(i)] = self._to_row(row)
+
+    def window(self, i=slice(None)):
+        '''(Chain_Store, slice or int) -> ndarray
+        View of rows in memory, a slice of the chain or last i rows'''
+        if not isinstance(i, slice):
+            i = slice(-i, None)
+        start, stop, step = i.indices(len(self))
+        start = min(max(start, self._start), len(self))
+        stop = max(stop, start)
+        out = self._buf[start - self._start:stop - self._start:step]
+        if self._frame is None:
+            return out[:, 0]
+        return out
+
+    def __array__(self, dtype=None):
+        return nu.asarray(self.window(), dtype=dtype)
+
+    def __iter__(self):
+        for i in xrange(self._start, len(self)):
+            yield self[i]
+
+class Checkpoint(object):
+    '''Append-only binary checkpoint of a run in one file.
+
+    The file is a stream of npy records in pairs, a key (kind, model, gal,
+    var) as a string array then the data array. 'chain' records are chunks
+    of rows to be concatenated, 'state' records replace the last one with
+    the same key. Writes are done by a background thread from a bounded
+    queue, so the sampler only blocks when the disk falls behind.'''
+    def __init__(self, path, mode='w', max_queue=64):
+        self.path = path
+        self._file = open(path, mode + 'b')
+        self._queue = Queue.Queue(max_queue)
+        self._error = None
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.daemon = True
+        self._thread.start()
+        if mode == 'w':
+            self.state(('', '', 'version'), CHECK_VERSION)
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    self._file.flush()
+                    return
+                for arr in item:
+                    nu.save(self._file, arr, allow_pickle=False)
+                if self._queue.empty():
+                    self._file.flush()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _put(self, kind, key, arr):
+        if self._error is not None:
+            raise self._error
+        key = nu.array((kind,) + tuple(str(i) for i in key))
+        #copy as chain buffers are reused
+        self._queue.put((key, nu.array(arr)))
+
+    def append(self, key, rows):
+        '''((model, gal, var), ndarray) -> None
+        Appends chunk of rows to chain key'''
+        self._put('chain', key, rows)
+
+    def state(self, key, value):
+        '''((model, gal, var), array_like) -> None
+        Saves value of key, replacing older ones'''
+        self._put('state', key, value)
+
+    def sync(self):
+        '''Waits for queued records to be written to disk'''
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        '''Writes queued records and closes the file'''
+        if self._file.closed:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if self._error is not None:
+            raise self._error
+
+    @staticmethod
+    def read(path):
+        '''(str) -> dict, int
+        Reads checkpoint as {(model, gal, var): ndarray}. Chains are
+        concatenated and states are the last saved. A truncated record at the
+        end, from a crash while writing, is ignored. Also returns the byte
+        offset of the end of the last complete record pair, the file should
+        be truncated there before appending to it'''
+        chains, out = {}, {}
+        with open(path, 'rb') as f:
+            end = 0
+            while True:
+                try:
+                    key = nu.load(f, allow_pickle=False)
+                    arr = nu.load(f, allow_pickle=False)
+                except (IOError, ValueError, EOFError):
+                    break
+                end = f.tell()
+                kind, key = key[0], tuple(key[1:])
+                if kind == 'chain':
+                    chains.setdefault(key, []).append(arr)
+                else:
+                    out[key] = arr
+        for key in chains:
+            out[key] = nu.concatenate(chains[key])
+        return out, end
+
 
 ######Diagnostics
-def gr_convergence(relevantHistoryEnd, relevantHistoryStart):
-    """
-    Gelman-Rubin Convergence
-    Converged when sum(R <= 1.2) == nparam
-    """
-    start = relevantHistoryStart
-    end = relevantHistoryEnd
-    N = end - start
-    if N==0:
-        return  np.inf*np.ones(self.nchains)
-    N = min(min([len(self.seqhist[c]) for c in range(self.nchains)]), N)
-    seq = [self.seqhist[c][-N:] for c in range(self.nchains)]
-    sequences = array(seq) #this becomes an array (nchains,samples,dimensions)
-    variances  = var(sequences,axis = 1)#array(nchains,dim)
-    means = mean(sequences, axis = 1)#array(nchains,dim)
-    withinChainVariances = mean(variances, axis = 0)
-    betweenChainVariances = var(means, axis = 0) * N
-    varEstimate = (1 - 1.0/N) * withinChainVariances + (1.0/N) * betweenChainVariances
-    R = sqrt(varEstimate/ withinChainVariances)
-    return R
+def stack_chains(chains, n=None):
+    '''(list, int) -> ndarray
+    Stacks chains (Chain_Store, 1-d or 2-d arrays) into a 3-d array
+    (chain, itteration, param) of the last n rows of each, default the
+    length of the shortest chain in memory'''
+    chains = [nu.asarray(chain, dtype=float) for chain in chains]
+    if n is None:
+        n = min(len(chain) for chain in chains)
+    return nu.asarray([chain[len(chain) - n:].reshape(n, -1)
+                       for chain in chains])
+
+def _as_chains(chains):
+    #3-d array of 1 chain (itteration[, param]) or (chain, itter, param)
+    chains = nu.asarray(chains, dtype=float)
+    if chains.ndim < 3:
+        chains = chains.reshape(1, chains.shape[0], -1)
+    return chains
+
+def _autocov(x):
+    #biased autocovariance of (chain, itteration, param) at all lags
+    n = x.shape[1]
+    x = x - x.mean(1)[:, nu.newaxis]
+    #zero pad to power of 2 at least 2n so there is no wrap around
+    size = 2 ** int(nu.ceil(nu.log2(2 * n)))
+    f = nu.fft.rfft(x, size, axis=1)
+    return nu.fft.irfft(f * f.conjugate(), size, axis=1)[:, :n] / n
+
+def autocorr(chains):
+    '''(ndarray) -> ndarray
+    Autocorrelation at all lags of each chain and param, with FFT.
+    chains is 1 chain (itteration[, param]) or (chain, itteration, param).
+    Returns (chain, lag, param) array'''
+    acov = _autocov(_as_chains(chains))
+    with nu.errstate(invalid='ignore', divide='ignore'):
+        return acov / acov[:, :1]
+
+def integrated_time(chains):
+    '''(ndarray) -> ndarray
+    Integrated autocorrelation time of each param using all chains, with
+    Geyer's initial monotone sequence. nan for constant params'''
+    x = _as_chains(chains)
+    m, n = x.shape[:2]
+    if n < 4:
+        return nu.nan + nu.zeros(x.shape[2])
+    acov = _autocov(x)
+    # within and pooled varance
+    within = acov[:, 0].mean(0) * n / (n - 1.)
+    var_plus = within * (n - 1.) / n
+    if m > 1:
+        var_plus += x.mean(1).var(0, ddof=1)
+    with nu.errstate(invalid='ignore', divide='ignore'):
+        rho = 1. - (within - acov.mean(0)) / var_plus
+        # sum of pairs of lags up to first negative pair, made monotone
+        pairs = rho[:n - n % 2:2] + rho[1:n - n % 2:2]
+        positive = nu.cumprod(pairs > 0, axis=0).astype(bool)
+        pairs = nu.minimum.accumulate(nu.where(positive, pairs, 0.), axis=0)
+        tau = 2. * pairs.sum(0) - 1.
+    tau[~(var_plus > 0)] = nu.nan
+    return tau
+
+def ess(chains):
+    '''(ndarray) -> ndarray
+    Effective sample size of each param from all chains'''
+    x = _as_chains(chains)
+    return x.shape[0] * x.shape[1] / integrated_time(x)
+
+def split_rhat(chains):
+    '''(ndarray) -> ndarray
+    Split Gelman-Rubin R of each param, chains are cut in half so it is
+    also > 1 for a single chain that hasn't converged. Converged when all
+    R are about 1 (< 1.01 to 1.1)'''
+    x = _as_chains(chains)
+    half = x.shape[1] // 2
+    x = nu.concatenate((x[:, :half], x[:, x.shape[1] - half:]))
+    within = x.var(1, ddof=1).mean(0)
+    var_plus = (half - 1.) / half * within + x.mean(1).var(0, ddof=1)
+    with nu.errstate(invalid='ignore', divide='ignore'):
+        return nu.sqrt(var_plus / within)
+
+def effectiveSampleSize(data, stepSize=1):
+    '''(ndarray, int) -> float
+    Smallest effective sample size of params of a chain, in samples
+    of the chain before thinning by stepSize'''
+    return stepSize * nu.nanmin(ess(data))
 
 def Convergence_tests(param,keys,n=1000):
     #uses Levene's test to see if var between chains are the same if that is True
@@ -465,84 +1089,6 @@ def Convergence_tests(param,keys,n=1000):
                                                                 param[0][i].shape[1])
     return False
 
-def ess(t):
-    '''returns the average sample size of a N,M ndarray (doesn't actually take a N,M ndarray'''
-    #extract data from dictoranry
-    data = []
-    for i in t:
-        dics = []
-        for j in i.keys():
-            dics.append(nu.ravel(i[j]))
-        data.append(nu.hstack(dics))
-    data = nu.asarray(data)
-    temp_ess,Len = [],float(len(data[:,0]))
-    #calculate ess for each parameter
-    for i in range(data.shape[1]):
-        try:
-            temp_ess.append(Len/acor.acor(data[:,i])[0])
-        except ZeroDivisionError:
-            pass
-        except RuntimeError:
-            pass
-    if len(temp_ess) == 0:
-        return 0.
-    #return max
-    return nu.nanmax(temp_ess)
-
-
-def effectiveSampleSize(data, stepSize = 1) :
-  """ Effective sample size, as computed by BEAST Tracer."""
-  samples = len(data)
-
-  assert len(data) > 1,"no stats for short sequences"
-  
-  maxLag = min(samples // 3, 1000)
-
-  gammaStat = [0,] * maxLag
-  #varGammaStat = [0,]*maxLag
-
-  varStat = 0.0
-
-  if isinstance(data[0], dict):
-    data = list_dict_to(data,data[0].keys())
-    data = nu.array(data)[:,-1]
-
-  normalizedData = data - data.mean()
-  
-  for lag in xrange(maxLag) :
-    v1 = normalizedData[:samples-lag]
-    v2 = normalizedData[lag:]
-    v = v1 * v2
-    gammaStat[lag] = nu.sum(v) / len(v)
-    #varGammaStat[lag] = nu.sum(v*v) / len(v)
-    #varGammaStat[lag] -= gammaStat[0] ** 2
-
-    #print lag, gammaStat[lag], varGammaStat[lag]
-    
-    if lag == 0 :
-      varStat = gammaStat[0]
-    elif lag % 2 == 0 :
-      s = gammaStat[lag-1] + gammaStat[lag]
-      if s > 0:
-        varStat += 2.0*s
-      else:
-        break
-      '''
-      varStat[s > 0] += 2.0 * s[s > 0]
-      if not nu.any(s[s > 0]):
-        break'''
-      
-  # standard error of mean
-  #stdErrorOfMean = nu.sqrt(varStat/samples);
-
-  # auto correlation time
-  act = stepSize * varStat / gammaStat[0]
-
-  # effective sample size
-  ess = (stepSize * samples) / act
-
-  return ess
-
 #####SIMULATED ANNEELING#####
 def SA(i,i_fin,T_start,T_stop):
     '''temperature parameter for Simulated anneling (SA). 
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+#
+# Name:  Benchmarks
+#
+# Author: Thuso S Simon
+#
+# Date: 17th of Oct, 2026
+#TODO:
+#
+#    vvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvvv
+#    Copyright (C) 2013 Thuso S Simon
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    For the GNU General Public License, see <http://www.gnu.org/licenses/>.
+#    ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
+#History (version,date, change author)
+'''
+Timings of the hot parts of the likelihood calculations, on synthetic SSP
+libraries and burst databases so they run without the model files.
+
+Run as a script: python benchmarks.py [small|large] [out.json] [old.json]
+Times are written as json to out.json (default benchmarks.json) and
+compared with old.json if given.
+'''
+import numpy as nu
+import os
+import sys
+import json
+import itertools
+import shutil
+import tempfile
+import platform
+import subprocess
+from time import time
+import spectra_utils as ag
+import database_utils as util
+
+#sizes of synthetic libraries, databases and data
+SIZES = {'small': {'nmetal': 4, 'nage': 30, 'nwave': 2000, 'npix': 1000,
+                   'nbins': 3, 'ntau': 4, 'nage_db': 6, 'nmetal_db': 3,
+                   'nwave_db': 600, 'npoints': 100},
+         'large': {'nmetal': 6, 'nage': 100, 'nwave': 8000, 'npix': 4000,
+                   'nbins': 8, 'ntau': 10, 'nage_db': 20, 'nmetal_db': 6,
+                   'nwave_db': 4000, 'npoints': 1000}}
+
+
+def timeit(fun, *args, **kwargs):
+    '''(callable, ...) -> float
+    Best time in seconds of calling fun(*args, **kwargs) repeat times.
+    repeat is taken from kwargs, default 5. Each time is of number calls
+    (kwargs, default 1) and is divided by number'''
+    repeat = kwargs.pop('repeat', 5)
+    number = kwargs.pop('number', 1)
+    best = nu.inf
+    for i in xrange(repeat):
+        t = time()
+        for j in xrange(number):
+            fun(*args, **kwargs)
+        best = min(best, (time() - t) / number)
+    return best
+
+def fake_spectra(ncomp=10, npix=4000, wave_range=(3500., 8000.), seed=0):
+    '''(int, int, tuple, int) -> ndarray, ndarray
+    Makes smooth positive spectra on a linear wavelength grid'''
+    random = nu.random.RandomState(seed)
+    wave = nu.linspace(wave_range[0], wave_range[1], npix)
+    x = (wave - wave.mean()) / wave.ptp()
+    flux = nu.ones((ncomp, npix))
+    for i in xrange(5):
+        flux += (random.rand(ncomp, 1) * 0.2 *
+                 nu.sin(2 * nu.pi * (i + 1) * x + random.rand(ncomp, 1) * 6))
+    #some absorption lines
+    for line in random.rand(20) * wave.ptp() + wave[0]:
+        flux *= 1 - 0.3 * nu.exp(-(wave - line)**2 / 8.)
+    return wave, flux
+
+def synth_ssp_lib(nmetal=4, nage=30, nwave=2000, wave_range=(3000., 9000.),
+                  seed=0):
+    '''(int, int, int, tuple, int) -> list(ndarray, None), ndarray
+    Deterministic SSP library in the format of ez_to_rj, log10 metalicity
+    and log10 age (yrs) of each ssp and (nwave, nssp + 1) spectra with
+    wavelength in the first column. Ssps are black bodies that cool and
+    fade with age, with metal lines that deepen with metalicity'''
+    random = nu.random.RandomState(seed)
+    wave = nu.linspace(wave_range[0], wave_range[1], nwave)
+    metals = nu.log10(nu.linspace(0.0004, 0.05, nmetal))
+    ages = nu.linspace(6.5, 10.1, nage)
+    lines = random.rand(30) * (wave[-1] - wave[0]) + wave[0]
+    depth = random.rand(30) * 0.5
+    info, spect = [], [wave]
+    for metal in metals:
+        absorb = nu.ones(nwave)
+        for line, d in zip(lines, depth):
+            absorb *= 1 - d * (1 + metal / 2.) * nu.exp(-(wave - line)**2 / 18.)
+        for age in ages:
+            temp = 4e4 * 10**(-(age - 6.5) / 4.)
+            planck = wave**-5 / nu.expm1(1.4388e8 / (wave * temp))
+            info.append([metal, age])
+            spect.append(planck / planck.max() * 10**(-(age - 6.5) / 2.) *
+                         absorb)
+    return [nu.asarray(info), None], nu.asarray(spect).T
+
+def synth_burst_db(path, ntau=4, nage=6, nmetal=3, nwave=600,
+                   wave_range=(3000., 9000.), seed=0):
+    '''(str, int, int, int, int, tuple, int) -> str
+    Writes deterministic sqlite burst grid (table burst, like
+    burst_dtau_10.db) of ntau * nage * nmetal spectra to path. Returns
+    path'''
+    if os.path.exists(path):
+        os.remove(path)
+    random = nu.random.RandomState(seed)
+    wave = nu.linspace(wave_range[0], wave_range[1], nwave)
+    db = util.numpy_sql(path)
+    db.execute('CREATE TABLE burst (imf text, model text, tau real, '
+               'age real, metalicity real, spec array)')
+    for tau in nu.linspace(0, 5, ntau):
+        for age in nu.linspace(8, 10.1, nage):
+            for metal in nu.linspace(-2.5, -1.3, nmetal):
+                flux = nu.abs(1 + 0.3 * nu.sin(wave / 300. *
+                                               (1 + random.rand())) +
+                              0.1 * (age - 8) + 0.05 * tau + 0.2 * metal)
+                db.execute('INSERT INTO burst VALUES (?,?,?,?,?,?)',
+                           ('salp', 'bc03', tau, age, metal,
+                            nu.vstack((wave, flux)).T))
+    db.commit()
+    db.close()
+    return path
+
+def register_synth_lib(path, lib_vals, spect, spec_lib='bc03', imf='salp'):
+    '''(str, list, ndarray, str, str) -> str
+    Makes an empty model file in path and registers lib_vals, spect as
+    the spec_lib library there, so VESPA_fit(spec_lib_path=path) runs
+    without EZGAL. Returns path'''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    open(os.path.join(path, '%s_%s_synth.model'%(spec_lib, imf)), 'w').close()
+    ag.register_ssp_lib(spec_lib, imf, path, lib_vals, spect)
+    return path
+
+def synth_data(wave, flux, npix, wave_range=(3600., 8000.), snr=30., seed=0):
+    '''(ndarray, ndarray, int, tuple, float, int) -> ndarray
+    (npix, 3) array of wavelength, noisy flux and uncertanty of flux
+    rebinned to npix pixels'''
+    random = nu.random.RandomState(seed)
+    new_wave = nu.linspace(wave_range[0], wave_range[1], npix)
+    model = nu.interp(new_wave, wave, flux)
+    sigma = nu.abs(model) / snr
+    return nu.vstack((new_wave, model + random.randn(npix) * sigma,
+                      sigma)).T
+
+def losvd_old(wave, flux, resolution, param):
+    '''LOSVD like it was done before the cached operators, pysynphot
+    rebinning to and from log lambda and a direct convolution for each
+    spectra, with a new (not memoized) kernel each time'''
+    out = nu.empty_like(flux)
+    for i in xrange(flux.shape[0]):
+        kernel = ag.gauss_kernel.func(resolution, param[0], param[2],
+                                      param[3])
+        lx, ly = ag.logify(wave, flux[i])
+        out[i] = ag.linearize(lx, nu.convolve(ly, kernel, 'same'))[1]
+    return out
+
+def losvd_exact(wave, flux, resolution, param):
+    '''LOSVD of the old path with the pysynphot rebinning replaced by
+    exact_bin_average, as a reference'''
+    lx = nu.logspace(nu.log10(wave.min()), nu.log10(wave.max()), len(wave))
+    linear = nu.linspace(lx.min(), lx.max(), len(lx))
+    kernel = ag.gauss_kernel.func(resolution, param[0], param[2], param[3])
+    return nu.asarray([exact_bin_average(lx, nu.convolve(
+        exact_bin_average(wave, spec, lx), kernel, 'same'), linear)
+                       for spec in flux])
+
+def losvd_accuracy(sigmas=(50, 200, 500), ncomp=3, npix=4000, edge=100.):
+    '''(list, int, int, float) -> list
+    Checks fft_conv against losvd_exact and the old pysynphot path
+    losvd_old, on pixels more than edge A from the ends like LOSVD's
+    buffer. Returns list of (sigma, max relative difference of fft_conv
+    from exact, of fft_conv from old path)'''
+    wave, flux = fake_spectra(ncomp, npix)
+    resolution = 299792.458 * nu.diff(wave).mean() / wave.mean()
+    inside = nu.logical_and(wave > wave[0] + edge, wave < wave[-1] - edge)
+    out = []
+    for sigma in sigmas:
+        param = nu.array([float(sigma), 0., 0., 0.])
+        new = ag.fft_conv(wave, flux, resolution, param)[:, inside]
+        exact = losvd_exact(wave, flux, resolution, param)[:, inside]
+        old = losvd_old(wave, flux, resolution, param)[:, inside]
+        out.append((sigma, _max_rel(new, exact), _max_rel(new, old)))
+    return out
+
+def bench_losvd(sigmas=(50, 100, 200, 300, 400, 500), ncomp=10, npix=4000):
+    '''(list, int, int) -> list
+    Times LOSVD convolution of ncomp spectra for each sigma (km/s), old
+    way and with fft_conv and cached operators. Returns list of
+    (sigma, old, new) times in seconds'''
+    wave, flux = fake_spectra(ncomp, npix)
+    #km/s per pixel
+    resolution = 299792.458 * nu.diff(wave).mean() / wave.mean()
+    cache = {}
+    out = []
+    for sigma in sigmas:
+        param = nu.array([float(sigma), 0., 0., 0.])
+        #fill cache so only the convolution is timed
+        ag.fft_conv(wave, flux, resolution, param, cache)
+        old = timeit(losvd_old, wave, flux, resolution, param, repeat=3)
+        new = timeit(ag.fft_conv, wave, flux, resolution, param, cache)
+        out.append((sigma, old, new))
+    return out
+
+def exact_bin_average(wave, flux, wavnew):
+    '''(ndarray, ndarray, ndarray) -> ndarray
+    Exact mean over each bin of wavnew (bin centers) of the spectra linear
+    between points of wave and going to zero one step past each end, the
+    spectra rebin_operator rebins. Done with the closed form integral of
+    each linear piece, as a reference for rebinning'''
+    taper = nu.hstack((wave[0]**2 / wave[1], wave, wave[-1]**2 / wave[-2]))
+    f = nu.hstack((0., flux, 0.))
+    step = nu.diff(taper)
+    #integral from taper[0] to each point of taper
+    total = nu.hstack((0., nu.cumsum(step * (f[1:] + f[:-1]) / 2.)))
+    edges = nu.empty(wavnew.shape[0] + 1)
+    edges[1:-1] = (wavnew[1:] + wavnew[:-1]) / 2.
+    edges[0] = 2 * wavnew[0] - edges[1]
+    edges[-1] = 2 * wavnew[-1] - edges[-2]
+    x = nu.clip(edges, taper[0], taper[-1])
+    k = nu.clip(nu.searchsorted(taper, x, 'right') - 1, 0,
+                taper.shape[0] - 2)
+    dx = x - taper[k]
+    area = total[k] + f[k] * dx + (f[k + 1] - f[k]) * dx**2 / (2 * step[k])
+    return nu.diff(area) / nu.diff(edges)
+
+def _max_rel(a, b):
+    #largest relative difference of a from b
+    return float(nu.max(nu.abs(a - b) / nu.abs(b)))
+
+def rebin_accuracy(npixs=(1000, 6000), wave_range=(3600., 8000.)):
+    '''(list, tuple) -> list
+    Checks rebin_operator and pysynphot rebin_spec against the exact bin
+    average of fake spectra with 4000 pixels from 3000 to 9000A, rebinned
+    to npix pixels in wave_range. Returns list of (npix, max relative
+    difference of rebin_operator from exact, of rebin_spec from exact, of
+    rebin_operator from rebin_spec)'''
+    wave, flux = fake_spectra(1, 4000, (3000., 9000.))
+    out = []
+    for npix in npixs:
+        wavnew = nu.linspace(wave_range[0], wave_range[1], npix)
+        exact = exact_bin_average(wave, flux[0], wavnew)
+        op = ag.rebin_operator(wave, wavnew).dot(flux[0])
+        spec = ag.rebin_spec(wave, flux[0], wavnew)
+        out.append((npix, _max_rel(op, exact), _max_rel(spec, exact),
+                    _max_rel(op, spec)))
+    return out
+
+def _burst_params(lib_index, nbins, seed=0):
+    #VESPA_fit like gal rows [length, age, metal, log norm] in the library
+    random = nu.random.RandomState(seed)
+    age, metal = lib_index.age_unq, lib_index.metal_unq
+    length = age.ptp() / float(nbins)
+    return nu.asarray([[length * random.rand(), (i + .5) * length + age[0],
+                        random.rand() * metal.ptp() + metal[0], 0.]
+                       for i in xrange(nbins)])
+
+def bench_ssp(size):
+    '''(dict) -> dict
+    Times of making bursts and ssp models from a synthetic library'''
+    lib_vals, spect = synth_ssp_lib(size['nmetal'], size['nage'],
+                                    size['nwave'])
+    lib_index = ag.SSP_index(lib_vals, spect)
+    params = _burst_params(lib_index, size['nbins'])
+    points = params[:, [2, 1]]
+    out = {}
+    out['SSP_index'] = timeit(ag.SSP_index, lib_vals, spect, repeat=3)
+    out['make_burst'] = timeit(ag.make_burst, params[0, 0], params[0, 1],
+                               params[0, 2], lib_vals, spect, lib_index,
+                               number=20)
+    out['make_bursts'] = timeit(ag.make_bursts, params, lib_index, number=20)
+    out['get_model_fit_opt'] = timeit(
+        ag.get_model_fit_opt, points, lib_vals, lib_index.age_unq,
+        lib_index.metal_unq, size['nbins'], spect, lib_index, number=20)
+    return out
+
+def bench_dust(size):
+    '''(dict) -> dict
+    Times of dust on a model of nbins bursts, with and without the
+    cached transmission curves'''
+    wave, flux = fake_spectra(size['nbins'], size['nwave'], (3000., 9000.))
+    ages = nu.linspace(7, 10, size['nbins'])
+    tau = nu.linspace(0.01, 3, size['nwave'])
+    param = nu.array([.5, 1.2])
+    def dust():
+        ag.dust(param, ag.SpectralModel(wave, flux.copy(), ages))
+    def dust_cold():
+        ag.dust_curve.cache_clear()
+        dust()
+    out = {}
+    out['dust'] = timeit(dust, number=20)
+    out['dust_uncached'] = timeit(dust_cold, number=5)
+    out['f_dust'] = timeit(ag.f_dust, tau, number=20)
+    return out
+
+def bench_kernel(size):
+    '''(dict) -> dict
+    Times of LOSVD kernels and convolution of nbins spectra'''
+    wave, flux = fake_spectra(size['nbins'], size['nwave'], (3000., 9000.))
+    resolution = 299792.458 * nu.diff(wave).mean() / wave.mean()
+    param = nu.array([nu.log10(250.), 0., 0.01, 0.02])
+    wave_range = [wave[0] + 600, wave[-1] - 600]
+    cache = {}
+    def losvd():
+        ag.LOSVD(ag.SpectralModel(wave, flux.copy()), param, wave_range,
+                 resolution, cache)
+    losvd()
+    out = {}
+    out['gauss_kernel'] = timeit(ag.gauss_kernel, resolution, 250., 0.,
+                                 0.01, 0.02, number=20)
+    out['gauss_kernel_uncached'] = timeit(ag.gauss_kernel.func, resolution,
+                                          250., 0., 0.01, 0.02, number=20)
+    out['fft_conv'] = timeit(ag.fft_conv, wave, flux, resolution,
+                             [250., 0., 0.01, 0.02], cache, number=5)
+    out['LOSVD'] = timeit(losvd, number=5)
+    return out
+
+def bench_rebin(size):
+    '''(dict) -> dict
+    Times of matching nbins model spectra to data wavelengths'''
+    wave, flux = fake_spectra(size['nbins'], size['nwave'], (3000., 9000.))
+    data = synth_data(wave, flux[0], size['npix'])
+    cache = {}
+    ag.data_match(data, ag.SpectralModel(wave, flux.copy()), op_cache=cache)
+    out = {}
+    out['data_match'] = timeit(
+        lambda: ag.data_match(data, ag.SpectralModel(wave, flux.copy()),
+                              op_cache=cache), number=20)
+    out['rebin_operator'] = timeit(ag.rebin_operator, wave, data[:, 0],
+                                   repeat=3)
+    out['rebin_spec'] = timeit(ag.rebin_spec, wave, flux[0], data[:, 0],
+                               repeat=3)
+    return out
+
+def _import_lrg():
+    #LRG likelihoods are in cur_proj/LRG
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'cur_proj', 'LRG')
+    if path not in sys.path:
+        sys.path.append(path)
+    import LRG_lik
+    return LRG_lik
+
+def bench_lrg(size, tmp_dir):
+    '''(dict, str) -> dict
+    Times of Grid_Cube interpolation (trilinear) and Multi_LRG_burst.lik
+    on a synthetic burst database. lik is timed over points with different
+    grid params, redshift, dust and sigma, like a sampler would ask for'''
+    LRG_lik = _import_lrg()
+    db = synth_burst_db(os.path.join(tmp_dir, 'burst.db'), size['ntau'],
+                        size['nage_db'], size['nmetal_db'],
+                        size['nwave_db'])
+    cube = LRG_lik.Grid_Cube(db, use_cache=False)
+    random = nu.random.RandomState(0)
+    points = nu.asarray([grid[0] + random.rand(size['npoints']) * grid.ptp()
+                         for grid in cube.param_range]).T
+    wave = cube.wave
+    data = {'gal': synth_data(wave, nu.asarray(cube.interp(points[:1]))[0],
+                              size['npix'], (wave[0] + 400, wave[-1] - 400))}
+    fun = LRG_lik.Multi_LRG_burst(data, db, have_dust=True, have_losvd=True)
+    nu.random.seed(0)
+    start = fun.initalize_param('gal')[0]
+    params = []
+    for point in points[:20]:
+        gal = start.copy()
+        gal[['tau', 'age', 'metalicity']] = point
+        gal['redshift'] = random.rand() * .05
+        gal[['$T_{bc}$', '$T_{ism}$']] = random.rand(2) * 2
+        gal['$\\sigma$'] = nu.log10(50 + random.rand() * 350)
+        params.append({'burst': {'gal': gal}})
+    steps = itertools.cycle(params)
+    lik = lambda: list(fun.lik(steps.next(), 'burst'))
+    lik()
+    out = {}
+    out['Grid_Cube.interp'] = timeit(cube.interp, points, number=5)
+    out['Multi_LRG_burst.lik'] = timeit(lik, number=len(params))
+    return out
+
+def bench_vespa(size, tmp_dir):
+    '''(dict, str) -> dict
+    Times of VESPA_fit.lik with dust and LOSVD on a synthetic library'''
+    import likelihood_class as lik
+    lib_vals, spect = synth_ssp_lib(size['nmetal'], size['nage'],
+                                    size['nwave'])
+    path = register_synth_lib(os.path.join(tmp_dir, 'ssp'), lib_vals, spect)
+    lib_index = ag.SSP_index(lib_vals, spect)
+    params = _burst_params(lib_index, size['nbins'])
+    data = synth_data(spect[:, 0], ag.make_bursts(params, lib_index).sum(0),
+                      size['npix'])
+    fun = lik.VESPA_fit(data, spec_lib='bc03', imf='salp',
+                        spec_lib_path=path)
+    bins = str(size['nbins'])
+    param = {bins: {'gal': params, 'dust': nu.array([.5, 1.2]),
+                    'losvd': nu.array([nu.log10(250.), 0., 0., 0.])}}
+    fun.lik(param, bins)
+    return {'VESPA_fit.lik': timeit(fun.lik, param, bins, number=5)}
+
+def run_suite(size='small', repeat=5):
+    '''(str, int) -> dict
+    Runs all benchmarks with size in SIZES. Returns dict with times in
+    seconds in results, benchmarks that couldn't run (missing
+    dependencies) with the error in skipped, and differences from
+    reference results in accuracy'''
+    config = SIZES[size]
+    out = {'size': size, 'config': config, 'version': _version(),
+           'python': platform.python_version(), 'numpy': nu.__version__,
+           'pysynphot': _pysynphot_version(),
+           'machine': platform.machine(), 'time': time(),
+           'results': {}, 'skipped': {},
+           'accuracy': {'rebin': rebin_accuracy(),
+                        'losvd': losvd_accuracy()}}
+    tmp_dir = tempfile.mkdtemp()
+    benches = [('ssp', lambda: bench_ssp(config)),
+               ('dust', lambda: bench_dust(config)),
+               ('kernel', lambda: bench_kernel(config)),
+               ('rebin', lambda: bench_rebin(config)),
+               ('lrg', lambda: bench_lrg(config, tmp_dir)),
+               ('vespa', lambda: bench_vespa(config, tmp_dir))]
+    try:
+        for name, bench in benches:
+            try:
+                out['results'].update(bench())
+            except ImportError as e:
+                out['skipped'][name] = str(e)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out
+
+def _pysynphot_version():
+    #version of pysynphot the old rebinning is compared with
+    try:
+        import pysynphot
+        return pysynphot.__version__
+    except (ImportError, AttributeError):
+        return None
+
+def _version():
+    #git commit of the tree, None if not a git checkout
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    '''(dict, dict) -> list
+    (name, old, new) times of benchmarks in both run_suite outputs'''
+    return [(name, old['results'][name], new['results'][name])
+            for name in sorted(new['results']) if name in old['results']]
+
+
+if __name__ == '__main__':
+    size = sys.argv[1] if len(sys.argv) > 1 else 'small'
+    out_path = sys.argv[2] if len(sys.argv) > 2 else 'benchmarks.json'
+    print 'LOSVD of 10 spectra with 4000 pixels'
+    print '%8s %12s %12s %8s'%('sigma', 'old (ms)', 'new (ms)', 'speedup')
+    for sigma, old, new in bench_losvd():
+        print '%8i %12.3f %12.3f %8.1f'%(sigma, old * 1000, new * 1000,
+                                           old / new)
+    results = run_suite(size)
+    print '\nRebinning of 4000 pixels, max relative difference'
+    print '%8s %14s %14s %14s'%('pixels', 'operator-exact', 'pysynphot-exact',
+                                'operator-pysyn')
+    for row in results['accuracy']['rebin']:
+        print '%8i %14.2e %14.2e %14.2e'%row
+    print '\nLOSVD fft_conv, max relative difference'
+    print '%8s %14s %14s'%('sigma', 'from exact', 'from old')
+    for row in results['accuracy']['losvd']:
+        print '%8i %14.2e %14.2e'%row
+    json.dump(results, open(out_path, 'w'), indent=1, sort_keys=True)
+    print '\n%s suite, saved to %s'%(size, out_path)
+    for name in sorted(results['results']):
+        print '%24s %12.3f ms'%(name, results['results'][name] * 1000)
+    for name, error in results['skipped'].items():
+        print '%24s skipped: %s'%(name, error)
+    if len(sys.argv) > 3:
+        print '\nchange from %s'%sys.argv[3]
+        for name, old, new in compare(json.load(open(sys.argv[3])), results):
+            print '%24s %12.3f ms %12.3f ms %8.2fx'%(name, old * 1000,
+                                                     new * 1000, old / new)
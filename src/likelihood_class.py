@@ -520,7 +520,8 @@ class VESPA_fit(object):
     
     def __init__(self,data,weights=None, resol=180.,min_sfh=1,max_sfh=16,lin_space=False,use_dust=True, 
 		use_losvd=True, spec_lib='p2',imf='salp',
-			spec_lib_path='/home/thuso/Phd/stellar_models/ezgal/'):
+			spec_lib_path='/home/thuso/Phd/stellar_models/ezgal/',
+                 profile_norm=False):
         '''(VESPA_fitclass, ndarray,int,int) -> NoneType
         data - spectrum to fit
         weights/mask for data
@@ -530,6 +531,8 @@ class VESPA_fit(object):
         spec_lib - spectral lib to use
         imf - inital mass function to use
         spec_lib_path - path to ssps
+        profile_norm - solve burst norms with nnls each step instead of
+        sampling them
         sets up vespa like fits
         '''
         #set externel functions
@@ -550,21 +553,27 @@ class VESPA_fit(object):
         else:
             self.weights = weights
             self.data[:,1] *= weights
-        #load models
-        cur_lib = ['basti', 'bc03', 'cb07','m05','c09','p2']
-        assert spec_lib.lower() in cur_lib, ('%s is not in ' %spec_lib.lower() + str(cur_lib))
-        if not spec_lib_path.endswith('/') :
-            spec_lib_path += '/'
-        models = glob(spec_lib_path+spec_lib+'*'+imf+'*')
-        if len(models) == 0:
-            models = glob(spec_lib_path+spec_lib.lower()+'*'+imf+'*')
-        assert len(models) > 0, "Did not find any models"
-        #crate ezgal class of models
-        SSP = gal.wrapper(models)
-        #make sure is matched for interpolatioin
-        SSP.is_matched = True
-        #extract seds from ezgal wrapper
-        self._lib_val, self._spect = ag.ez_to_rj(SSP)
+        #gaussian likelihood of data
+        if self.data.shape[1] == 3:
+            #uncertanty calc
+            self._gauss = MC.Gauss_Lik(self.data[:,1], self.data[:,2])
+        else:
+            self._gauss = MC.Gauss_Lik(self.data[:,1])
+        #load models, shared with other fits in this process
+        self._lib_index = ag.get_ssp_lib(spec_lib, imf, spec_lib_path)
+        self._lib_val = self._lib_index.lib_vals
+        self._spect = self._lib_index.spect
+        #rebinning operators for data_match
+        self._rebin_cache = {}
+        #adaptive proposals of each step size
+        self._adapt = {}
+        #random streams of proposals, global numpy state if None
+        self.streams = None
+        #prior domains for each number of bins
+        self._domains = {}
+        #norms solved not sampled, last nnls solution of each bins
+        self._profile_norm = profile_norm
+        self._nnls_passive = {}
         #extra models to use
         self._has_dust = use_dust
         self._has_losvd = use_losvd
@@ -594,9 +603,10 @@ class VESPA_fit(object):
         self._max_age = self._age_unq.ptp()
 
     def _seed(self,Seed):
-        '''Changes the random seed'''
-        nu.random = nu.random.RandomState(Seed)
-        nu.random.seed(Seed)
+        '''Changes the random seed. Global numpy state is seeded from the
+        stream of Seed, so workers with different seeds are uncorrelated'''
+        self.streams = MC.Random_Streams(Seed)
+        self.streams.seed_global('VESPA_fit')
             
     def proposal(self,Mu,sigma):
         '''(Example_lik_class, ndarray,ndarray) -> ndarray
@@ -610,10 +620,27 @@ class VESPA_fit(object):
         
         mu = nu.hstack([i for j in self._key_order for i in Mu[j] ])
         try:
-            t_out = nu.random.multivariate_normal(mu,sigma)
+            t_out = self._adapt_for(sigma).draw(mu, random=self._random())
         except nu.linalg.LinAlgError:
             print sigma
             return Mu
+        return self._from_vector(t_out, Mu)
+
+    def _random(self):
+        '''(VESPA_class) -> RandomState
+        Stream proposals are drawn from'''
+        if self.streams is None:
+            return nu.random
+        return self.streams.stream('proposal')
+
+    def _adapt_for(self, sigma):
+        '''(VESPA_class, ndarray) -> MC.Adapt_Cov
+        Adaptive proposal with step size sigma'''
+        return MC.Adapt_Cov.of(sigma, self._adapt, floor=10**-6)
+
+    def _from_vector(self, t_out, Mu):
+        '''(VESPA_class, ndarray, dict(ndarray)) -> dict(ndarray)
+        Puts a step drawn from Mu back into dict shape'''
         bins = Mu['gal'].shape[0]
         #save params for multi-block
         '''if str(bins) not in self._multi_block_param.keys():
@@ -671,6 +698,9 @@ class VESPA_fit(object):
                 i+=4
         #gal lengths must be positve
         out['gal'][:,0] = nu.abs(out['gal'][:,0])
+        if self._profile_norm:
+            #norms are solved and filled in by lik
+            out['gal'][:,3] = Mu['gal'][:,3]
         #chech if only 1 metalicity
         if len(self._metal_unq) == 1:
             #set all metalicites to only value
@@ -678,11 +708,112 @@ class VESPA_fit(object):
 
         return out
         
-    def multi_try_all(self,param,bins,N=15):
-        '''(VESPA_class,ndarray,str,int)-> float
-        Does all things for multi try (proposal,lik, and selects best param'''
-        temp_param = map(self.proposal,[param]*N, [self._sigma]*N)
-    
+    def multi_try_all(self, param, bins, sigma, N=15):
+        '''(VESPA_class, dict(ndarray), str, ndarray, int) -> dict(ndarray),
+        float, float
+        Does all things for multi try (proposal,lik, and selects best param.
+        Draws N proposals from param, evaluates them together with lik_many
+        and prior_many and picks one with probablity proportional to its
+        posterior. Returns the picked param, its lik and prior'''
+        mu = nu.hstack([i for j in self._key_order for i in param[j]])
+        random = self._random()
+        temp_param = [{bins: self._from_vector(t_out, param)}
+                      for t_out in self._adapt_for(sigma).draw(mu, N, random)]
+        prior = self.prior_many(temp_param, bins)
+        lik = nu.zeros(N) - nu.inf
+        index = nu.isfinite(prior)
+        if nu.any(index):
+            lik[index] = self.lik_many([temp_param[i] for i in
+                                        nu.nonzero(index)[0]], bins)
+        post = lik + prior
+        if not nu.any(nu.isfinite(post)):
+            i = random.randint(N)
+        else:
+            weight = nu.exp(post - post[nu.isfinite(post)].max())
+            i = random.choice(N, p=weight / weight.sum())
+        return temp_param[i][bins], lik[i], prior[i]
+
+    def _make_models(self, params, bins, components=False):
+        '''(VESPA_class, list(dict), str, bool) -> ndarray
+        Makes weighted model spectra on data wavelengths for a list of
+        params, one row each. Bursts of all params are made with one
+        make_bursts call and all models are rebinned to the data at once.
+        If components returns list of (nbins, npix) unnormalized bursts
+        of each param instead'''
+        gals = [param[bins]['gal'] for param in params]
+        all_gal = nu.vstack(gals)
+        bursts = ag.make_bursts(all_gal, self._lib_index)
+        if not components:
+            bursts *= 10**all_gal[:, 3][:, None]
+        split = nu.cumsum([gal.shape[0] for gal in gals])[:-1]
+        flux = []
+        for param, gal, burst in izip(params, gals, nu.split(bursts, split)):
+            model = ag.SpectralModel(self._spect[:,0], burst, gal[:, 1])
+            #do dust
+            if self._has_dust:
+                #dust requires wavelengths
+                model = ag.dust(param[bins]['dust'], model)
+            #add all spectra for speed
+            if not components:
+                model.sum()
+            #do losvd
+            if self._has_losvd:
+                #make buffer for edge effects
+                wave_range = [self.data[:,0].min(),self.data[:,0].max()]
+                model = ag.LOSVD(model, param[bins]['losvd'],
+                                 wave_range,self.resol, self._rebin_cache)
+            flux.append(model.flux)
+        #need to match data wavelength ranges and wavelengths
+        model = ag.data_match(self.data,
+                              ag.SpectralModel(model.wave, nu.vstack(flux)),
+                              op_cache=self._rebin_cache)
+        #weight or mask model
+        model.flux *= self.weights
+        if components:
+            return nu.split(model.flux, split)
+        return model.flux
+
+    def _profile(self, components, bins):
+        '''(VESPA_class, list(ndarray), str) -> ndarray, list(ndarray)
+        Log-likelihood of each (nbins, npix) components with norms solved
+        by nnls on the normal equations, warm started from the last
+        solution with the same bins. Returns log-likelihoods and norms'''
+        out, norms = nu.zeros(len(components)) - nu.inf, []
+        for i, comp in enumerate(components):
+            if not nu.all(nu.isfinite(comp)):
+                norms.append(nu.zeros(comp.shape[0]))
+                continue
+            G, b = self._gauss.gram(comp)
+            norm = ag.nnls_gram(G, b, self._nnls_passive.get(bins))
+            self._nnls_passive[bins] = norm > 0
+            chi2 = self._gauss.dd - 2 * nu.dot(norm, b) + norm.dot(G).dot(norm)
+            out[i] = self._gauss.log_norm - 0.5 * chi2
+            norms.append(norm)
+        return out, norms
+
+    def _lik_models(self, params, bins):
+        '''(VESPA_class, list(dict), str) -> ndarray, ndarray
+        Log-likelihoods and model spectra of a list of params. If norms are
+        profiled the solved norms are put into the norm column of each
+        param, so chains store them'''
+        if not self._profile_norm:
+            flux = self._make_models(params, bins)
+            return self._loglik(flux), flux
+        components = self._make_models(params, bins, True)
+        prob, norms = self._profile(components, bins)
+        for param, norm, p in izip(params, norms, prob):
+            if nu.isfinite(p):
+                #log10 weight, bins not used get smallest float
+                param[bins]['gal'][:,3] = nu.log10(nu.maximum(
+                    norm, nu.finfo(float).tiny))
+        return prob, nu.asarray([nu.dot(norm, comp) for norm, comp in
+                                 izip(norms, components)])
+
+    def _loglik(self, flux):
+        '''(VESPA_class, ndarray) -> ndarray
+        Log-likelihood of each row of model flux'''
+        return self._gauss(flux)
+
     #@profile
     def lik(self,param, bins,return_all=False):
         '''(Example_lik_class, ndarray) -> float
@@ -690,90 +821,80 @@ class VESPA_fit(object):
         if not self._check_len(param[bins]['gal'],bins,self._age_unq):
             return -nu.inf
         #with profile.timestamp("Get_SSP"):
-        burst_model = {}
-        for i in param[bins]['gal']:
-            burst_model[str(i[1])] =  10**i[3]*ag.make_burst(i[0],i[1],i[2],
-            self._lib_val, self._spect)
-        burst_model['wave'] = nu.copy(self._spect[:,0])
-        '''if not self.issorted(burst_model['wave']):
-            for i in burst_model.keys():
-                burst_model[i] = burst_model[i][::-1]'''
-        #return None
-        #return None
-		#do dust
-        if self._has_dust:
-            #dust requires wavelengths
-            burst_model = ag.dust(param[bins]['dust'],burst_model)
-        #add all spectra for speed
-        model = {}
-        model['wave'] = burst_model['wave'].copy()
-        burst_model.pop('wave')
-        model['0'] = nu.add.reduce(burst_model.values())
-		#do losvd
-        if self._has_losvd:
-            #make buffer for edge effects
-            wave_range = [self.data[:,0].min(),self.data[:,0].max()]
-            model = ag.LOSVD(model, param[bins]['losvd'],
-                                   wave_range,self.resol)
-        #need to match data wavelength ranges and wavelengths
-		#get loglik
-        
-        model = ag.data_match(self.data,model)
-        #model = nu.sum(burst_model.values(),0)
-        #weight or mask model
-        model['0'] *= self.weights
-		#return loglik
-        if self.data.shape[1] == 3:
-            #uncertanty calc
-            prob = stats_dist.norm.logpdf(model['0'],self.data[:,1],self.data[:,2]).sum()
-        else:
-            prob = stats_dist.norm.logpdf(model['0'],self.data[:,1]).sum()
-            #prob = -nu.sum((model -	self.data[:,1])**2)
+        prob, model = self._lik_models([param], bins)
+        prob, model = prob[0], model[0]
         #return
         if 	return_all:
-            return prob, model['0']
+            return prob, model
         else:
             return prob
-   
-    def prior(self,param,bins):
-        '''(Example_lik_class, ndarray) -> float
-        Calculates log-probablity for prior'''
-        #return logprior
-        out = 0.
-        #make sure shape is ok
-        if not self._check_len(param[bins]['gal'],bins,self._age_unq):
-            return -nu.inf
-        #uniform priors
-        #gal priors
-        gal = param[bins]['gal']
-        #length
-        out += stats_dist.uniform.logpdf(gal[:,0],0.,self._age_unq.ptp()).sum()
-        #age
-        #weight for older
-        out += stats_dist.uniform.logpdf(gal[:,1],self._age_unq.min(),self._age_unq.max()).sum()
-        #out += stats_dist.norm.logpdf(gal[:,1],9.5,0.2).sum()
-        if nu.any(gal[:,1] > self._age_unq.max()):
-            return -nu.inf
-        #metals
-        if len(self._metal_unq) > 1:
+
+    def lik_many(self, params, bins):
+        '''(VESPA_class, list(dict), str) -> ndarray
+        lik for a list of params with the same bins. Model construction is
+        shared, see _make_models. Returns array of log-likelyhoods'''
+        out = nu.zeros(len(params)) - nu.inf
+        index = nu.nonzero(MC.check_len_many(
+            [param[bins]['gal'] for param in params], self._age_unq))[0]
+        if len(index) > 0:
+            out[index] = self._lik_models([params[i] for i in index],
+                                          bins)[0]
+        return out
+
+    def _domain(self, nbins):
+        '''(VESPA_class, int) -> MC.Domain
+        Prior domain for nbins bursts, made once for each nbins. Columns
+        are lengths, ages, metals and weights of all bins then dust and
+        losvd'''
+        if nbins not in self._domains:
+            domain = MC.Domain()
+            #uniform priors
+            domain.uniform('length', 0., self._age_unq.ptp(), nbins)
+            #weight for older
+            domain.uniform('age', self._age_unq.min(), self._age_unq.max(),
+                           nbins)
+            domain.clip('age', upper=self._age_unq.max())
+            if len(self._metal_unq) > 1:
                 #if has metal range
-                out += stats_dist.uniform.logpdf(gal[:,2],self._metal_unq.min(),self._metal_unq.ptp()).sum()
-            #weight
-        out += stats_dist.uniform.logpdf(gal[:,3], -300, 500).sum()
-        #dust
+                domain.uniform('metal', self._metal_unq.min(),
+                               self._metal_unq.ptp(), nbins)
+            else:
+                domain.free('metal', nbins)
+            if self._profile_norm:
+                #norms are solved in lik
+                domain.free('weight', nbins)
+            else:
+                domain.uniform('weight', -300, 500, nbins)
+            if self._has_dust:
+                domain.uniform('dust', 0, 4, 2)
+            if self._has_losvd:
+                domain.uniform('sigma', 0, 3.)
+                domain.uniform('z', 0, .05)
+                domain.uniform('h3_h4', -.5, .5, 2)
+            self._domains[nbins] = domain
+        return self._domains[nbins]
+
+    def prior_many(self, params, bins):
+        '''(VESPA_class, list(dict), str) -> ndarray
+        prior for a list of params with the same bins, done for all params
+        at once'''
+        gal = nu.asarray([param[bins]['gal'] for param in params], dtype=float)
+        points = [gal.transpose(0, 2, 1).reshape(len(params), -1)]
         if self._has_dust:
-            #uniform priors
-            out += stats_dist.uniform.logpdf(param[bins]['dust'],0,4).sum()
-        #losvd
+            points.append(nu.asarray([param[bins]['dust'] for param in params]))
         if self._has_losvd:
-            #sigma
-            out += stats_dist.uniform.logpdf(param[bins]['losvd'][0],0,3.)
-            #z
-            out += stats_dist.uniform.logpdf(param[bins]['losvd'][1],0,.05)
-            #h3 and h4
-            out += stats_dist.uniform.logpdf(param[bins]['losvd'][2:],-.5,.5).sum()
+            points.append(nu.asarray([param[bins]['losvd']
+                                      for param in params]))
+        out = self._domain(gal.shape[1]).logpdf(nu.hstack(points))
+        #make sure shape is ok
+        out[~MC.check_len_many(gal, self._age_unq)] = -nu.inf
         return out
 
+    def prior(self,param,bins):
+        '''(Example_lik_class, ndarray) -> float
+        Calculates log-probablity for prior'''
+        return self.prior_many([param], bins)[0]
+
 
     def model_prior(self,model):
         '''(Example_lik_class, any type) -> float
@@ -832,18 +953,19 @@ class VESPA_fit(object):
         Evaluates step_criteria, with help of param and model and 
         changes step size during burn-in perior. Outputs new step size
         '''
-        if step_crit > .60 and nu.all(step_size[model].diagonal() < 10.):
-            step_size[model] *= 1.05
-        elif step_crit < .2 and nu.any(step_size[model].diagonal() > 10**-6):
-            step_size[model] /= 1.05
-        #cov matrix
+        adapt = self._adapt_for(step_size[model])
+        if step_crit > .60 and nu.all(adapt.sigma.diagonal() < 10.):
+            adapt.rescale(1.05)
+        elif step_crit < .2 and nu.any(adapt.sigma.diagonal() > 10**-6):
+            adapt.rescale(1 / 1.05)
+        #running cov matrix of new states
         if len(param) % 200 == 0 and len(param) > 0.:
-            temp = nu.cov(MC.list_dict_to(param[-2000:],self._key_order).T)
-            #make sure not stuck
-            if nu.any(temp.diagonal() > 10**-6):
-                step_size[model] = temp
+            rows = param[adapt.seen:]
+            if len(rows) > 0:
+                adapt.update(MC.list_dict_to(rows, self._key_order))
+            adapt.seen = len(param)
         
-        return step_size[model]
+        return adapt.sigma
 
 
     def birth_death(self,birth_rate, model, Param):
@@ -918,18 +1040,8 @@ class SSP_fit(object):
         #check data, reduice wavelenght range, match wavelengths to lib
         self._norm = 1./(self.data[:,1].mean()/100.)
         self.data[:,1] *= self._norm
-        #load models
-        cur_lib = ['basti', 'bc03', 'cb07','m05','c09','p2']
-        assert spec_lib.lower() in cur_lib, ('%s is not in ' %spec_lib.lower() + str(cur_lib))
-        if not spec_lib_path.endswith('/') :
-            spec_lib_path += '/'
-        models = glob(spec_lib_path+spec_lib+'*'+imf+'*')
-        if len(models) == 0:
-            models = glob(spec_lib_path+spec_lib.lower()+'*'+imf+'*')
-        assert len(models) > 0, "Did not find any models"
-        #crate ezgal class of models
-        SSP = gal.wrapper(models)
-        self.SSP = SSP
+        #load models, shared with other fits in this process
+        self._lib_index = ag.get_ssp_lib(spec_lib, imf, spec_lib_path)
         
         #extra models to use
         self._has_dust = use_dust
@@ -942,8 +1054,8 @@ class SSP_fit(object):
             self._key_order.append('losvd')
 		#set hidden varibles
         #self._lib_vals = info
-        self._age_unq = nu.unique(nu.log10(SSP[0].ages))[1:]
-        self._metal_unq = nu.log10(nu.float64(SSP.meta_data['met']))
+        self._age_unq = self._lib_index.age_unq
+        self._metal_unq = self._lib_index.metal_unq
         #self._lib_vals[0][:,0] = 10**self._lib_vals[0][:,0]
         self._min_sfh, self._max_sfh = min_sfh,max_sfh +1
 		#params
@@ -1075,7 +1187,8 @@ class SSP_fit(object):
                 step_size[model][i] /= 1.05
         #cov matrix
         if len(param) % 2000 == 0:
-            step_size[model] = [nu.cov(nu.asarray(param[-2000:])[:,0,:].T)]
+            temp = nu.asarray(param[-2000:])
+            step_size[model] = [nu.cov(temp.reshape(temp.shape[0], -1).T)]
         return step_size[model]
 
 
@@ -1479,7 +1592,7 @@ class Multinest_fit(object):
     
     def __init__(self,data,nbins, use_dust=True, use_losvd=True,
                  spec_lib='p2',imf='salp',
-			spec_lib_path='/home/thuso/Phd/stellar_models/ezgal/'):
+			spec_lib_path='/home/thuso/Phd/stellar_models/ezgal/', resol=180.):
         '''(VESPA_fitclass, ndarray,int,int) -> NoneType
         data - spectrum to fit
         *_sfh - range number of burst to allow
@@ -1488,37 +1601,25 @@ class Multinest_fit(object):
         spec_lib - spectral lib to use
         imf - inital mass function to use
         spec_lib_path - path to ssps
+        resol - resolution of data in km/s
         sets up vespa like fits
         '''
         self.data = nu.copy(data)
 		#make mean value of data= 100
         self._norm = 1./(self.data[:,1].mean()/100.)
         self.data[:,1] *= self._norm
-        #load models
-        cur_lib = ['basti', 'bc03', 'cb07','m05','c09','p2']
-        assert spec_lib.lower() in cur_lib, ('%s is not in ' %spec_lib.lower() + str(cur_lib))
-        if not spec_lib_path.endswith('/') :
-            spec_lib_path += '/'
-        models = glob(spec_lib_path+spec_lib+'*'+imf+'*')
-        if len(models) == 0:
-			models = glob(spec_lib_path+spec_lib.lower()+'*'+imf+'*')
-        assert len(models) > 0, "Did not find any models"
-        #crate ezgal class of models
-        SSP = gal.wrapper(models)
-        self.SSP = SSP
-        #extract seds from ezgal wrapper
-        spect, info = [SSP.sed_ls], []
-        for i in SSP:
-			metal = float(i.meta_data['met'])
-			ages = nu.float64(i.ages)
-			for j in ages:
-				if j == 0:
-					continue
-				spect.append(i.get_sed(j,age_units='yrs'))
-				info.append([metal+0,j])
-        info,self._spect = [nu.log10(info),None],nu.asarray(spect).T
-        #test if sorted
-        self._spect = self._spect[::-1,:]
+        #gaussian likelihood of data
+        if self.data.shape[1] == 3:
+            #uncertanty calc
+            self._gauss = MC.Gauss_Lik(self.data[:,1], self.data[:,2])
+        else:
+            self._gauss = MC.Gauss_Lik(self.data[:,1])
+        #resoluion of data
+        self.resol = resol
+        #load models, shared with other fits in this process
+        lib_index = ag.get_ssp_lib(spec_lib, imf, spec_lib_path)
+        #copy lib_vals since metals are made linear below
+        info, self._spect = [nu.array(lib_index.lib_vals[0]), None], lib_index.spect
         #make spect match wavelengths of data
         #self._spect = ag.data_match_all(data,self._spect)[0]
         #extra models to use
@@ -1534,6 +1635,9 @@ class Multinest_fit(object):
         self._lib_vals = info
         self._age_unq = nu.unique(info[0][:,1])
         self._metal_unq = nu.unique(info[0][:,0])
+        self._lib_index = lib_index
+        #rebinning operators for data_match
+        self._rebin_cache = {}
         self._lib_vals[0][:,0] = 10**self._lib_vals[0][:,0]
         #calculate number of parameters and number of bins
         self.nbins = nbins
@@ -1546,6 +1650,44 @@ class Multinest_fit(object):
         self.nparams = nparams
 
     
+    def _make_models(self, params):
+        '''(Multinest_fit, list(dict)) -> ndarray
+        Makes model spectra on data wavelengths for a list of params from
+        set_param, one row each. Bursts of all params are made with one
+        make_bursts call and all models are rebinned to the data at once'''
+        gals = [param['gal'] for param in params]
+        all_gal = nu.vstack(gals)
+        bursts = ag.make_bursts(all_gal, self._lib_index)
+        bursts *= 10**all_gal[:, 3][:, None]
+        split = nu.cumsum([gal.shape[0] for gal in gals])[:-1]
+        flux = []
+        for param, gal, burst in izip(params, gals, nu.split(bursts, split)):
+            burst_model = ag.SpectralModel(self._spect[:,0], burst, gal[:, 1])
+            #do dust
+            if self._has_dust:
+                #dust requires wavelengths
+                burst_model = ag.dust(param['dust'],burst_model)
+            burst_model.sum()
+            #do losvd
+            if self._has_losvd:
+                #make buffer for edge effects
+                wave_range = [self.data[:,0].min(),self.data[:,0].max()]
+                burst_model = ag.LOSVD(burst_model, param['losvd'],
+                                       wave_range, self.resol,
+                                       self._rebin_cache)
+            flux.append(burst_model.flux[0])
+        #need to match data wavelength ranges and wavelengths
+        burst_model = ag.data_match(self.data,
+                                    ag.SpectralModel(burst_model.wave, flux),
+                                    op_cache=self._rebin_cache)
+        return burst_model.flux
+
+    def _loglik(self, model):
+        '''(Multinest_fit, ndarray) -> ndarray
+        Log-likelihood of each row of model, -inf if nan'''
+        prob = self._gauss(model)
+        return nu.where(nu.isnan(prob), -nu.inf, prob)
+
     def lik(self,p, bins,nbins,return_spec=False):
         '''(Example_lik_class, ndarray) -> float
         Calculates likelihood for input parameters. Outuputs log-likelyhood'''
@@ -1554,49 +1696,28 @@ class Multinest_fit(object):
         #check if should run or end quickly
         if not self._check_len(param['gal'],'1'):
             return -nu.inf
-        burst_model = {}
-        for i in param['gal']:
-            burst_model[str(i[1])] =  10**i[3]*ag.make_burst(i[0],i[1],i[2],
-            self.SSP)
-        burst_model['wave'] = nu.copy(self._spect[:,0])
-		#do dust
-        if self._has_dust:
-            #dust requires wavelengths
-            burst_model = ag.dust(param['dust'],burst_model)
-		#do losvd
-        if self._has_losvd:
-            #check if wavelength exsist
-            if 'wave' not in burst_model.keys():
-                burst_model['wave'] = nu.copy(self._spect[:,0])
-            #make buffer for edge effects
-            wave_range = [self.data[:,0].min(),self.data[:,0].max()]
-            burst_model = ag.LOSVD(burst_model, param['losvd'], wave_range)
-        #need to match data wavelength ranges and wavelengths
-		#get loglik
-        
-        burst_model = ag.data_match(self.data,burst_model,bins)
-        #check if wavelength is still here
-        if  burst_model.has_key('wave'):
-            #remove
-            burst_model.pop('wave')
-        model = nu.sum(burst_model.values(),0)
-        
+        model = self._make_models([param])[0]
 		#return loglik
-        if self.data.shape[1] == 3:
-            #uncertanty calc
-            pass
-        else:
-            prob = stats_dist.norm.logpdf(model,self.data[:,1]).sum()
-            #prob = -nu.sum((model -	self.data[:,1])**2)
-        #return
-        if nu.isnan(prob):
-            return -nu.inf
+        prob = float(self._loglik(model))
         #print prob
         if return_spec:
             return prob, model
         else:
             return prob        
 
+    def lik_many(self, P, bins, nbins):
+        '''(Multinest_fit, ndarray, int, int) -> ndarray
+        lik for (N, nparams) array of points, model construction is shared
+        between points. Returns array of log-likelyhoods'''
+        params = [self.set_param(p) for p in nu.atleast_2d(P)]
+        out = nu.zeros(len(params)) - nu.inf
+        index = nu.nonzero(MC.check_len_many(
+            [param['gal'] for param in params], self._age_unq))[0]
+        if len(index) > 0:
+            out[index] = self._loglik(self._make_models(
+                [params[i] for i in index]))
+        return out
+
     def prior(self,p, bins, nbins):
         '''(Example_lik_class, ndarray) -> float
         Calculates log-probablity for prior'''
@@ -1640,6 +1761,30 @@ class Multinest_fit(object):
         
         #self.param_prior.append(param)
 
+    def prior_many(self, P, bins, nbins):
+        '''(Multinest_fit, ndarray, int, int) -> NoneType
+        prior for (N, nparams) array of unit cube points, transforms
+        all rows in place like prior'''
+        gal = 4 * self.nbins
+        #uniform age
+        P[:, 1:gal:4] *= self._age_unq.ptp()
+        P[:, 1:gal:4] += self._age_unq.min()
+        #length bin is conditional on age
+        P[:, 0:gal:4] *= nu.minimum(
+            nu.abs(P[:, 1:gal:4] - self._age_unq.min()),
+            nu.abs(self._age_unq.max() - P[:, 1:gal:4]))
+        P[:, 2:gal:4] *= self._metal_unq.ptp()
+        P[:, 2:gal:4] += self._metal_unq.min()
+        P[:, 3:gal:4] *= 150
+        P[:, 3:gal:4] -= 50
+        count = gal
+        if self._has_dust:
+            P[:, count:count + 2] *= 4.
+            count += 2
+        if self._has_losvd:
+            P[:, count] *= 2.7
+            P[:, count + 1:count + 4] *= 0
+
     def set_param(self,p):
         '''takes param from nested sampling and puts it into correct dictorany
         for use in lik and prior'''
@@ -1659,48 +1804,6 @@ class Multinest_fit(object):
 
     def _check_len(self, tparam, key):
         '''(VESPA_class, dict(ndarray) or ndarray,str)-> ndarray
-        Make sure parameters ahere to criterion listed below:
-        1. bins cannot overlap
-        2. total length of bins must be less than length of age_unq
-        3. ages must be in increseing order
-        4. make sure bins are with in age range
-        5. No bin is larger than the age range
-        '''
-        
-        #check input type
-        if type(tparam) == dict:
-            param = tparam.copy()
-        elif  type(tparam) == nu.ndarray:
-            param = {key:tparam}
-        else:
-            raise TypeError('input must be dict or ndarray')
-        #make sure age is sorted
-        if not issorted(param[key][:,1]):
-            return False
-        #make sure bins do not overlap fix if they are
-        for i in xrange(param[key].shape[0]-1):
-            #assume orderd by age
-            max_age = param[key][i,0]/2. + param[key][i,1]
-            min_age_i = param[key][i+1,1] - param[key][i+1,0]/2.
-            if max_age > min_age_i:
-                #overlap
-                #make sure overlap is significant
-                if not nu.allclose(max_age, min_age_i):
-                    return False
-            #check if in age bounds
-            if i == 0:
-                if self._age_unq.min() > param[key][i,1] - param[key][i,0]/2.:
-                    return False
-        else:
-            if self._age_unq.max() < param[key][-1,1] + param[key][-1,0]/2.:
-                if not nu.allclose(param[key][-1,1] + param[key][-1,0]/2,self._age_unq.max()):
-                    return False
-        #check if length is less than age_unq.ptp()
-        if param[key][:,0].sum() > self._age_unq.ptp():
-            if not nu.allclose( param[key][:,0].sum(),self._age_unq.ptp()):
-                return False
-        #make sure age is in bounds
-        
-        #passed all tests
-        return True
+        MC._check_len with age range of library'''
+        return MC._check_len(tparam, key, self._age_unq)
 
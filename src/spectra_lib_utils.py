@@ -30,14 +30,24 @@
 """
 
 import cPickle as pik
+import json
 import numpy as nu
 import os
 import sys
+import tempfile
 from multiprocessing import Pool
 import boundary as bound
 import ezgal as gal
 from glob import glob
 
+#binary library format
+LIB_MAGIC = 'AGELIB\x00\x00'
+LIB_VERSION = 1
+LIB_EXT = '.aglib'
+LIB_ALIGN = 64
+#shared arrays for pool workers, in memory on linux
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
 def read_spec(name, lib_path='/home/thuso/Phd/Code/Spectra_lib/'):
     #reads in spec and turns into numpy array [lambda,flux]
     return nu.loadtxt(lib_path+name)
@@ -59,6 +69,8 @@ def get_fitting_info(lib_path='/home/thuso/Phd/Code/Spectra_lib/',
         spect,lib = load_spec_lib(lib_path,spec_lib)
         out = nu.zeros([len(lib), 2])
     else:
+        #skip library files made from the .spec files
+        lib = standard_file
         out = nu.zeros([len(lib), 2])
     for j, i in enumerate(lib):
         out[j, :] = [float(i[4:10]), float(i[11:-5])]
@@ -67,11 +79,18 @@ def get_fitting_info(lib_path='/home/thuso/Phd/Code/Spectra_lib/',
 
     return out,lib
 
-def load_spec_lib(lib_path='/home/thuso/Phd/Spectra_lib/', lib='BC03.splib'):
+def load_spec_lib(lib_path='/home/thuso/Phd/Spectra_lib/', lib='BC03.splib',
+                  outname=None):
     '''loads all spectra into libary first load of lib may be slow.
-    .splib files take precendence over .spec files'''
-    #check if exsiting .splib file 
+    binary .aglib files are opened as a read only memmap and take
+    precendence over .splib files, which take precendence over .spec files.
+    First load of .spec files writes lib_path/outname.aglib (outname
+    defaults to name of lib)'''
+    #check if exsiting binary or .splib file 
     files = os.listdir(lib_path)
+    name = os.path.splitext(lib)[0]
+    if name + LIB_EXT in files:
+        return open_spec_lib(os.path.join(lib_path, name + LIB_EXT))[:2]
     splib_files = []
     splib_checker = lambda i: True if i.endswith('splib') else False
     if sum(map(splib_checker,files)) > 0: #quick check to se
@@ -84,8 +103,8 @@ def load_spec_lib(lib_path='/home/thuso/Phd/Spectra_lib/', lib='BC03.splib'):
             raise IOError('SSP Libraiy does not exsist.')
     else:
         print 'First Load, May take some time'
-        outname = raw_input('Please Give name of input Lib ')
-        
+        if outname is None:
+            outname = name
         lib = get_fitting_info(lib_path)[1]
         temp = read_spec(lib[0], lib_path)
         #create array
@@ -94,8 +113,81 @@ def load_spec_lib(lib_path='/home/thuso/Phd/Spectra_lib/', lib='BC03.splib'):
         tempout =map(read_spec,lib,[lib_path] * len(lib))
         for i, j in enumerate(tempout):
             out[:, i + 1] = j[:, 1]
-        pik.dump((out, lib), open(lib_path + outname + '.splib', 'w'), 2)
-        return out, lib
+        outname = os.path.join(lib_path, outname + LIB_EXT)
+        save_spec_lib(outname, out, lib)
+        return open_spec_lib(outname)[:2]
+
+def _align(offset):
+    #next multiple of LIB_ALIGN
+    return -(-offset // LIB_ALIGN) * LIB_ALIGN
+
+def save_spec_lib(path, spect, lib, index=None, dtype=nu.float64):
+    '''(str, ndarray, list, ndarray, dtype) -> None
+    Writes library to path in the versioned binary format.
+
+    File is LIB_MAGIC, version and header length (uint32), json header
+    and then the wavelength vector (float64), the (metal, age) index
+    table (float64) and the spectra in dtype, each block aligned to
+    LIB_ALIGN bytes and little endian. spect is [wave, spec1, spec2, ...]
+    columns like load_spec_lib returns and is stored in that layout so
+    the memmap can be used in its place. lib is the ssp_metal_age.spec
+    names, index is taken from them if not given'''
+    spect = nu.asarray(spect)
+    nwave, nspec = spect.shape[0], spect.shape[1] - 1
+    assert len(lib) == nspec, 'Need a name for every spectra'
+    if index is None:
+        index = [[float(i[4:10]), float(i[11:-5])] for i in lib]
+    index = nu.asarray(index, dtype='<f8').reshape(nspec, 2)
+    dtype = nu.dtype(dtype).newbyteorder('<')
+    header = {'nwave': nwave, 'nspec': nspec, 'dtype': dtype.str,
+              'names': list(lib), 'index_columns': ['metal', 'age']}
+    #offsets depend on header length so make room for them first
+    for key in ('wave_offset', 'index_offset', 'flux_offset'):
+        header[key] = 0
+    head_len = _align(len(json.dumps(header)) + 64)
+    header['wave_offset'] = _align(16 + head_len)
+    header['index_offset'] = _align(header['wave_offset'] + 8 * nwave)
+    header['flux_offset'] = _align(header['index_offset'] + 16 * nspec)
+    text = json.dumps(header).ljust(head_len)
+    out = open(path, 'wb')
+    try:
+        out.write(LIB_MAGIC)
+        nu.array([LIB_VERSION, head_len], dtype='<u4').tofile(out)
+        out.write(text)
+        for key, block in (('wave_offset', spect[:, 0].astype('<f8')),
+                           ('index_offset', index),
+                           ('flux_offset', spect.astype(dtype))):
+            out.write('\x00' * (header[key] - out.tell()))
+            block.tofile(out)
+    finally:
+        out.close()
+
+def open_spec_lib(path):
+    '''(str) -> ndarray, list, dict
+    Opens a binary library read only with numpy.memmap, so all processes
+    on a node share the same pages. Returns spect [wave, spec1, ...]
+    columns, the ssp names and the header, which also holds wave
+    (float64) and index (metal, age) memmaps'''
+    lib_file = open(path, 'rb')
+    try:
+        if lib_file.read(len(LIB_MAGIC)) != LIB_MAGIC:
+            raise IOError('%s is not a binary spectral library' % path)
+        version, head_len = nu.fromfile(lib_file, '<u4', 2)
+        if version > LIB_VERSION:
+            raise IOError('%s has version %i, can only read up to %i' %
+                          (path, version, LIB_VERSION))
+        header = json.loads(lib_file.read(head_len))
+    finally:
+        lib_file.close()
+    nwave, nspec = header['nwave'], header['nspec']
+    header['version'] = int(version)
+    header['wave'] = nu.memmap(path, '<f8', 'r', header['wave_offset'],
+                               (nwave,))
+    header['index'] = nu.memmap(path, '<f8', 'r', header['index_offset'],
+                                (nspec, 2))
+    spect = nu.memmap(path, str(header['dtype']), 'r', header['flux_offset'],
+                      (nwave, nspec + 1))
+    return spect, map(str, header['names']), header
 
     
 def edit_spec_range(spect, lam_min, lam_max):
@@ -119,6 +211,63 @@ def load_ezgal_lib(spec_lib, spec_lib_path, imf):
     
     return SSP
 
+class Shared_Array(object):
+    '''Read only array published once as a .npy file in SHARED_DIR so
+    pool workers get it without copies. Pickles as the path of the file
+    and view() gives a memmap of it, opened once in each process. The
+    file is removed by close or when the publishing object is deleted'''
+    _views = {}
+    def __init__(self, arr):
+        fd, self.path = tempfile.mkstemp('.npy', 'agedate_', SHARED_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            nu.save(f, nu.ascontiguousarray(arr))
+        self._owner = os.getpid()
+
+    def __getstate__(self):
+        return {'path': self.path, '_owner': None}
+
+    def view(self):
+        '''Read only memmap of array'''
+        if self.path not in Shared_Array._views:
+            Shared_Array._views[self.path] = nu.load(self.path, mmap_mode='r')
+        return Shared_Array._views[self.path]
+
+    def close(self):
+        '''Removes file, only by process that made it. Unpickled copies
+        in workers leave the file and its view alone, so the view is kept
+        for the life of the worker'''
+        if self._owner != os.getpid():
+            return
+        Shared_Array._views.pop(self.path, None)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __del__(self):
+        self.close()
+
+def share(obj):
+    '''(ndarray or tuple or list or dict) -> same type
+    Publishes arrays in obj as Shared_Array, so tasks only carry their
+    paths. Use attach in workers to get arrays back'''
+    if isinstance(obj, nu.ndarray):
+        return Shared_Array(obj)
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(share(i) for i in obj)
+    if isinstance(obj, dict):
+        return dict((key, share(obj[key])) for key in obj)
+    return obj
+
+def attach(obj):
+    '''(Shared_Array or tuple or list or dict) -> same type
+    Zero copy views of Shared_Arrays in obj, other values unchanged'''
+    if isinstance(obj, Shared_Array):
+        return obj.view()
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(attach(i) for i in obj)
+    if isinstance(obj, dict):
+        return dict((key, attach(obj[key])) for key in obj)
+    return obj
+
 def info_for_lib(lib_path='/home/thuso/Phd/Code/Spectra_lib/'):
     #calculates information content of spectral library
     spec_lib, info = load_spec_lib(lib_path)
@@ -133,33 +282,60 @@ def info_for_lib(lib_path='/home/thuso/Phd/Code/Spectra_lib/'):
 
     return prob_dist
 
+def pack_prob_dist(prob_dist):
+    '''(dict) -> ndarray, ndarray, ndarray
+    prob_dist from info_for_lib as sorted wavelengths, start of each in
+    table and (value, prob) rows of all wavelengths stacked, so it can be
+    shared'''
+    keys = sorted(prob_dist, key=float)
+    waves = nu.array([float(i) for i in keys])
+    start = nu.cumsum([0] + [len(prob_dist[i]) for i in keys])
+    table = nu.vstack([prob_dist[i] for i in keys])
+    return waves, start, table
+
 def info_for_spec(data, prob_dist=None,
                   lib_path='/home/thuso/Phd/Code/Spectra_lib/'):
     #calculates information content of single spectra with respect to
     #current spectral library #only works is spectra have same wavelenths
+    #prob_dist can be from info_for_lib or pack_prob_dist, or shared
     if not prob_dist:
         prob_dist = info_for_lib(lib_path)
+    prob_dist = attach(prob_dist)
+    if isinstance(prob_dist, dict):
+        prob_dist = pack_prob_dist(prob_dist)
+    waves, start, table = prob_dist
     H = 0
     for i in range(data.shape[0]):
-        if not any(nu.array(prob_dist.keys()) == str(data[i, 0])):
+        #same matching as str keys of info_for_lib
+        wave = float(str(data[i, 0]))
+        j = nu.searchsorted(waves, wave)
+        if j == len(waves) or waves[j] != wave:
             print 'wavelenthd to not match'
             raise
 
-        temp = prob_dist[str(data[i, 0])]
+        temp = table[start[j]:start[j + 1]]
         H = (H - temp[nu.argsort((temp[:, 0] - 
                                   data[i, 1])**2), 1][0] * 
              nu.log10(temp[nu.argsort(temp[:, 0] - data[i, 1]), 1][0]))
 
     return H
 
+def _info_for_column(spec_lib, i, prob_dist):
+    #info_for_spec of column i of spec_lib, for pool tasks
+    spec_lib = attach(spec_lib)
+    return info_for_spec(nu.vstack((spec_lib[:, 0], spec_lib[:, i])).T,
+                         prob_dist)
+
 
 if __name__=='__main__':
 
     import cPickle as pik
     po=Pool()
-    prob=info_for_lib()
+    #publish once, tasks only send column number
+    prob=share(pack_prob_dist(info_for_lib()))
     spec_lib,info=load_spec_lib()
-    results=[po.apply_async(info_for_spec,(nu.vstack((spec_lib[:,0],spec_lib[:,i])).T,prob,)) for i in range(1,1195)]
+    lib=share(nu.asarray(spec_lib))
+    results=[po.apply_async(_info_for_column,(lib,i,prob,)) for i in range(1,1195)]
     H=[]
     for i,j in enumerate(results):
         print '%i out of 1195' %i
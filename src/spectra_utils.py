@@ -32,6 +32,9 @@
 import numpy as nu
 import os
 import sys
+from collections import OrderedDict
+from glob import glob
+import ezgal as gal
 from interp_utils import *
 from spectra_lib_utils import *
 from scipy.optimize import nnls
@@ -39,10 +42,12 @@ from scipy.optimize.minpack import leastsq
 from scipy.optimize import fmin_l_bfgs_b as fmin_bound
 from scipy.special import exp1 
 from scipy.integrate import simps
+from scipy import sparse
+from scipy.fftpack import next_fast_len
 from pysynphot import observation,spectrum
 import time as Time
 import boundary as bound
-from MC_utils import issorted
+from MC_utils import issorted, stream_seed
 #sfr2energy = 1.0/7.9D-42    ; (erg/s) / (M_sun/yr) [Kennicutt 1998]
 
 #123456789012345678901234567890123456789012345678901234567890123456789
@@ -51,48 +56,93 @@ class memoized(object):
     '''Decorator. Caches a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned
     (not reevaluated).
+
+    Used as @memoized or @memoized(quantize={'sigma': .1}, max_bytes=...).
+    quantize maps argument names to a step, those arguments (floats or
+    ndarrays) are rounded to a multiple of the step before the call, so
+    values closer than the step share one cache entry. ndarray arguments
+    are keyed by shape, dtype and the bytes of their data. Least recently
+    used entries are removed when the cached values take more than
+    max_bytes. Cached ndarrays are made read only.
     '''
-    def __init__(self, func):
+    def __init__(self, func=None, quantize=None, max_bytes=2**26):
+      self.quantize = {} if quantize is None else dict(quantize)
+      self.max_bytes = max_bytes
+      self.cache = OrderedDict()
+      self.nbytes = 0
+      self.hits, self.misses, self.evictions = 0, 0, 0
+      self.func = None
+      if func is not None:
+        self._wrap(func)
+
+    def _wrap(self, func):
       self.func = func
       self.__doc__ = func.__doc__
-      self.cache = {}
-      self.cache['gauss1'] = {}
-      self.cache['dust'] = {}
-    def __call__(self, *args):
-      #works different for different functions
-      if self.func.__name__ == 'gauss_kernel':
-        #remove cache if get's too big
-        if nu.random.rand() < .01:
-          l = len(self.cache['gauss1'])
-          if l > 10**5:
-            self.cache['gauss1'].clear()
-        arg = ''
-        for i in args:
-          arg+=str(i)+ ' '
-        if arg in self.cache['gauss1']:
-          return self.cache['gauss1'][arg]
-        else:
-          value = self.func(*args)
-          self.cache['gauss1'][arg] = value
-          return value
-      
-      elif self.func.__name__ == 'f_dust':
-        if nu.random.rand() < .01:
-          l = len(self.cache['dust'])
-          if l > 10**5:
-            self.cache['dust'].clear()
-
-        arg = str(args)
-        if not arg in self.cache['dust']:
-          self.cache['dust'][arg] = self.func(*args)
-        return self.cache['dust'][arg]
+      self.__name__ = func.__name__
+      code = func.func_code
+      self._arg_names = code.co_varnames[:code.co_argcount]
+
+    def _key(self, name, value):
+      '''Returns hashable key and (maybe quantized) value of an arg'''
+      step = self.quantize.get(name)
+      if isinstance(value, nu.ndarray):
+        if step is not None:
+          value = nu.round(value / step) * step
+        value = nu.ascontiguousarray(value)
+        return (value.shape, value.dtype.str, value.tostring()), value
+      if step is not None:
+        index = int(round(float(value) / step))
+        return index, index * step
+      return value, value
+
+    def __call__(self, *args, **kwargs):
+      if self.func is None:
+        #@memoized(...) form, this call gives the function
+        self._wrap(args[0])
+        return self
+      key, call_args = [], []
+      for name, value in zip(self._arg_names, args):
+        k, value = self._key(name, value)
+        key.append(k)
+        call_args.append(value)
+      call_kwargs = {}
+      for name in sorted(kwargs):
+        k, call_kwargs[name] = self._key(name, kwargs[name])
+        key.append((name, k))
+      key = tuple(key)
+      if key in self.cache:
+        self.hits += 1
+        value = self.cache.pop(key)
+        #move to most recently used
+        self.cache[key] = value
+        return value
+      self.misses += 1
+      value = self.func(*call_args, **call_kwargs)
+      if isinstance(value, nu.ndarray):
+        value.flags.writeable = False
+        size = value.nbytes
       else:
-          if args in self.cache:
-            return self.cache[args]
-          else:
-            value = self.func(*args)
-            self.cache[args] = value
-            return value
+        size = sys.getsizeof(value)
+      self.cache[key] = value
+      self.nbytes += size
+      while self.nbytes > self.max_bytes and len(self.cache) > 1:
+        old = self.cache.popitem(last=False)[1]
+        self.nbytes -= (old.nbytes if isinstance(old, nu.ndarray)
+                        else sys.getsizeof(old))
+        self.evictions += 1
+      return value
+
+    def cache_info(self):
+      '''Returns dict of hits, misses, evictions, entries and bytes'''
+      return {'hits': self.hits, 'misses': self.misses,
+              'evictions': self.evictions, 'entries': len(self.cache),
+              'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def cache_clear(self):
+      '''Empties cache and resets counters'''
+      self.cache.clear()
+      self.nbytes = 0
+      self.hits, self.misses, self.evictions = 0, 0, 0
 
     def __repr__(self):
       '''Return the function's docstring.'''
@@ -151,91 +201,248 @@ def find_az_box(param, age_unq, metal_unq):
     return metal, age,line
 
 
+class SSP_index(object):
+    '''Index of a spectral library on its (metal, age) grid.
+
+    Built once from the output of ez_to_rj. Maps grid coordinates straight
+    to columns of spect so the bracketing ssp's of any point are found with
+    a searchsorted on each axis, not a scan of the whole library.
+    '''
+    def __init__(self, lib_vals, spect):
+        '''(SSP_index, list(ndarray,ndarray), ndarray) -> NoneType
+        lib_vals and spect are the outputs of ez_to_rj
+        '''
+        self.lib_vals = lib_vals
+        self.spect = spect
+        self.wave = spect[:, 0]
+        self.metal_unq = nu.unique(lib_vals[0][:, 0])
+        self.age_unq = nu.unique(lib_vals[0][:, 1])
+        #column in spect for each grid point, -1 if not in library
+        self.columns = nu.zeros((self.metal_unq.shape[0],
+                                 self.age_unq.shape[0]), dtype=nu.int64) - 1
+        i_metal = nu.searchsorted(self.metal_unq, lib_vals[0][:, 0])
+        i_age = nu.searchsorted(self.age_unq, lib_vals[0][:, 1])
+        #reversed so first match in lib_vals wins, like nu.nonzero(...)[0][0]
+        self.columns[i_metal[::-1], i_age[::-1]] = nu.arange(
+            lib_vals[0].shape[0], 0, -1)
+        self._make_cumulative()
+
+    def _make_cumulative(self):
+        '''Makes cumulative, the integral over linear age of the ssp's of
+        each metalicity from the youngest age to every age on the grid.
+        Shape is (nmetal, nage, nwave). Intervals with an end not in the
+        library add 0 and are counted in missing (nmetal, nage), so they
+        only spoil the bursts that cover them.'''
+        nmetal, nage = self.columns.shape
+        self.cumulative = nu.zeros((nmetal, nage, self.spect.shape[0]))
+        self.missing = nu.zeros((nmetal, nage), dtype=nu.int64)
+        if nage < 2:
+            return
+        step = nu.diff(self.age_unq)
+        for i in xrange(nmetal):
+            interval = self._partial(nu.zeros(nage - 1, dtype=int) + i,
+                                     nu.arange(nage - 1), step)
+            hole = nu.isnan(interval).any(1)
+            interval[hole] = 0.
+            self.cumulative[i, 1:] = nu.cumsum(interval, 0)
+            self.missing[i, 1:] = nu.cumsum(hole)
+
+    def _age_cell(self, age):
+        '''Finds age interval each age is in and the offset into it'''
+        lower = nu.searchsorted(self.age_unq, age, 'right') - 1
+        lower = nu.clip(lower, 0, max(self.age_unq.shape[0] - 2, 0))
+        return lower, age - self.age_unq[lower]
+
+    def _partial(self, i_metal, i_age, x):
+        '''(SSP_index, ndarray(int), ndarray(int), ndarray) -> ndarray
+        Integral over linear age from age_unq[i_age] to age_unq[i_age] + x
+        (log yr) of the ssp's at metal_unq[i_metal]. Spectra are linear in
+        log age between grid points, same as interp, so the integral is
+        exact. Rows are nan if an end of a non empty interval is not in the
+        library.'''
+        start = self.columns[i_metal, i_age]
+        end = self.columns[i_metal, i_age + 1]
+        missing = nu.logical_and(nu.logical_or(start < 0, end < 0), x > 0)
+        s_start = self.spect[:, nu.where(start < 0, 1, start)].T
+        s_end = self.spect[:, nu.where(end < 0, 1, end)].T
+        step = self.age_unq[i_age + 1] - self.age_unq[i_age]
+        grow = nu.expm1(x * nu.log(10))
+        slope = (x * 10**x - grow / nu.log(10)) / step
+        out = (10**self.age_unq[i_age])[:, None] * (
+            s_start * grow[:, None] + (s_end - s_start) * slope[:, None])
+        out[missing] = nu.nan
+        return out
+
+    def burst(self, metal, t_min, t_max):
+        '''(SSP_index, ndarray, ndarray, ndarray) -> ndarray
+        Mean spectrum of constant star formation between log ages t_min
+        and t_max for each point, from differences of cumulative, so the
+        cost doesn't depend on the length of the burst. Returns (n, nwave)
+        array, rows are inf where the burst is out of the library or needs
+        a grid point that is not in it. Zero length bursts are the ssp.'''
+        metal = nu.atleast_1d(nu.asarray(metal, dtype=float))
+        t_min = nu.atleast_1d(nu.asarray(t_min, dtype=float))
+        t_max = nu.atleast_1d(nu.asarray(t_max, dtype=float))
+        bad = nu.logical_not(nu.logical_and(self.in_range(metal, t_min),
+                                            self.in_range(metal, t_max)))
+        #move bad points into range so the lookups don't fail
+        metal = nu.where(bad, self.metal_unq[0], metal)
+        t_min = nu.where(bad, self.age_unq[0], t_min)
+        t_max = nu.where(bad, self.age_unq[0], t_max)
+        m_low, m_up, m_w = self._axis(self.metal_unq, metal)
+        low, x_low = self._age_cell(t_min)
+        up, x_up = self._age_cell(t_max)
+        out = nu.zeros((metal.shape[0], self.spect.shape[0]))
+        if self.age_unq.shape[0] > 1:
+            for i_metal, weight in ((m_low, 1 - m_w), (m_up, m_w)):
+                #whole intervals and the pieces at each end are kept apart
+                #so short bursts don't lose precision
+                total = (self.cumulative[i_metal, up] -
+                         self.cumulative[i_metal, low])
+                total[self.missing[i_metal, up] >
+                      self.missing[i_metal, low]] = nu.nan
+                total += (self._partial(i_metal, up, x_up) -
+                          self._partial(i_metal, low, x_low))
+                use = weight > 0
+                out[use] += weight[use, None] * total[use]
+        width = 10**t_max - 10**t_min
+        single = width <= 0
+        out[~single] /= width[~single, None]
+        if nu.any(single):
+            out[single] = self.interp(metal[single], t_min[single])
+        out[nu.logical_or(bad, ~nu.isfinite(out).all(1))] = nu.inf
+        return out
+
+    def in_range(self, metal, age):
+        '''(SSP_index, ndarray, ndarray) -> ndarray(bool)
+        True where the point is inside the library grid'''
+        metal, age = nu.asarray(metal), nu.asarray(age)
+        return nu.logical_and(
+            nu.logical_and(metal >= self.metal_unq[0],
+                           metal <= self.metal_unq[-1]),
+            nu.logical_and(age >= self.age_unq[0], age <= self.age_unq[-1]))
+
+    def _axis(self, grid, value):
+        '''Finds lower grid index and linear weight of upper point'''
+        lower = nu.searchsorted(grid, value, 'right') - 1
+        lower = nu.clip(lower, 0, max(grid.shape[0] - 2, 0))
+        upper = nu.minimum(lower + 1, grid.shape[0] - 1)
+        width = grid[upper] - grid[lower]
+        weight = nu.zeros(lower.shape)
+        index = width > 0
+        weight[index] = (value[index] - grid[lower][index]) / width[index]
+        return lower, upper, weight
+
+    def bracket(self, metal, age):
+        '''(SSP_index, ndarray, ndarray) -> ndarray(int), ndarray
+        Returns the (n, 4) columns of spect that surround each point and
+        the (n, 4) bilinear interpolation weights. Points on an age or
+        metal line get zero weight on the unused corners. Columns with
+        value -1 are corners that are not in the library.
+        Raises ValueError if any point is outside the library.'''
+        metal = nu.atleast_1d(nu.asarray(metal, dtype=float))
+        age = nu.atleast_1d(nu.asarray(age, dtype=float))
+        if not nu.all(self.in_range(metal, age)):
+            raise ValueError('metal or age param is out of bounds')
+        m_low, m_up, m_w = self._axis(self.metal_unq, metal)
+        a_low, a_up, a_w = self._axis(self.age_unq, age)
+        columns = nu.vstack((self.columns[m_low, a_low],
+                             self.columns[m_up, a_low],
+                             self.columns[m_low, a_up],
+                             self.columns[m_up, a_up])).T
+        weights = nu.vstack(((1 - m_w) * (1 - a_w), m_w * (1 - a_w),
+                             (1 - m_w) * a_w, m_w * a_w)).T
+        return columns, weights
+
+    def corners(self, metal, age):
+        '''(SSP_index, float, float) -> ndarray(int), ndarray
+        Like bracket for a single point but only returns the 1, 2 or 4
+        columns with non-zero weight'''
+        columns, weights = self.bracket(metal, age)
+        index = weights[0] > 0
+        #on a lib spectra all weight can fall on a single corner
+        if not nu.any(index):
+            index[0] = True
+        return columns[0][index], weights[0][index]
+
+    def interp(self, metal, age):
+        '''(SSP_index, ndarray, ndarray) -> ndarray
+        Bilinear interpolation of spectra at each point. Returns
+        (n, nwave) array, rows are inf where a needed corner is not in
+        the library.'''
+        columns, weights = self.bracket(metal, age)
+        #missing corners with no weight are not needed
+        missing = nu.logical_and(columns < 0, weights > 0).any(1)
+        columns = nu.where(columns < 0, 1, columns)
+        ssps = self.spect[:, columns.ravel()].T.reshape(
+            columns.shape + (self.spect.shape[0],))
+        out = nu.einsum('ij,ijk->ik', weights, ssps)
+        out[missing] = nu.inf
+        return out
+
+
+class SpectralModel(object):
+    '''Spectra of a model on a shared wavelength axis.
+
+    flux is (ncomp, nwave) with one component per row and age the log age
+    of each row (nan if a row has no single age, like a sum of bursts).
+    dust, LOSVD, data_match and N_normalize work on it in place, and still
+    take the old dict of spectra keyed by age by going through from_dict
+    and to_dict.
+    '''
+    def __init__(self, wave, flux, age=None, names=None):
+        '''(SpectralModel, ndarray, ndarray, ndarray or None,
+        list or None) -> NoneType'''
+        self.wave = nu.asarray(wave, dtype=float)
+        self.flux = nu.atleast_2d(nu.asarray(flux, dtype=float))
+        if age is None:
+            age = nu.zeros(self.flux.shape[0]) + nu.nan
+        self.age = nu.atleast_1d(nu.asarray(age, dtype=float))
+        #dict keys for to_dict
+        if names is None:
+            names = [str(i) for i in xrange(self.flux.shape[0])]
+        self.names = list(names)
+
+    @classmethod
+    def from_dict(cls, model):
+        '''(dict(ndarray)) -> SpectralModel
+        Makes from dict of spectra, keys other than 'wave' are ages'''
+        names = [i for i in model.keys() if i != 'wave']
+        names.sort(key=float)
+        flux = nu.asarray([model[i] for i in names])
+        return cls(model.get('wave', nu.zeros(flux.shape[-1])), flux,
+                   [float(i) for i in names], names)
+
+    def to_dict(self, keep_wave=True):
+        '''(SpectralModel, bool) -> dict(ndarray)
+        Inverse of from_dict'''
+        out = dict(zip(self.names, self.flux))
+        if keep_wave:
+            out['wave'] = self.wave
+        return out
+
+    def sum(self):
+        '''(SpectralModel) -> SpectralModel
+        Adds all components into one, in place'''
+        self.flux = self.flux.sum(0)[None, :]
+        self.age = nu.zeros(1) + nu.nan
+        self.names = ['0']
+        return self
+
+
 def get_model_fit_opt(param, lib_vals, age_unq, metal_unq, bins, 
-						spect):
+                      spect, lib_index=None):
     '''does dirty work to make spectra models
     search age_unq and metal_unq to find closet box spectra and interps
-    does multi componets spectra'''
+    does multi componets spectra.
+    lib_index is a SSP_index of lib_vals and spect, made if not given'''
+    if lib_index is None:
+        lib_index = SSP_index(lib_vals, spect)
+    param = nu.asarray(param, dtype=float)[:bins]
+    ssps = lib_index.interp(param[:, 0], param[:, 1])
     out = {}
     for ii in xrange(bins):
-        temp_param = param[ii]
-        metal, age, line = find_az_box(temp_param, age_unq, metal_unq)
-        closest = []
-        #check to see if on a lib spectra or on a line
-        if line == 'age': #run 1 d interp along metal only
-            metal = nu.array([metal[0], metal[-1]])
-            metal.sort()
-            age = age[0]
-            #find spectra
-            for i in  metal:
-                index = nu.nonzero(nu.logical_and(lib_vals[0][:,0] == i
-                                                  ,lib_vals[0][:,1] ==age))[0]
-                if len(index)<1: #if not in lib_vals return dummy array
-                    out[str(ii)] = spect[:,0] + nu.inf
-                    interp = False
-                    break
-                else:
-                    closest.append(spect[:,index[0] + 1])
-                    interp = True
-            if interp:
-                out[str(ii)] = linear_interpolation(metal,
-                                                    closest,  
-                                                    temp_param[0])
-        elif line == 'metal': #run 1 d interp along age only
-            age = nu.array([age[0], age[-1]])
-            age.sort()
-            metal = metal[0]
-            #find spectra
-            
-            for i in age:
-                index = nu.nonzero(nu.logical_and(lib_vals[0][:,1] ==
-                                                  i, lib_vals[0][:,0]
-                                                  ==  metal))[0]
-                
-                if len(index)<1: #if not in lib_vals return dummy array
-                    out[str(ii)] = spect[:,0] + nu.inf
-                    interp = False
-                    break
-                else:
-                    closest.append(spect[:,index[0] + 1])
-                    interp = True
-            if interp:
-                out[str(ii)] = linear_interpolation(age, closest,
-                                                    temp_param[1])
-
-        elif line == 'both': #on a lib spectra
-            index=nu.nonzero(nu.logical_and(lib_vals[0][:,0] == 
-                                            temp_param[0], 
-                                            lib_vals[0][:,1] == 
-                                            temp_param[1]))[0]
-            if len(index) < 1: #if not in lib_vals return dummy array
-                out[str(ii)] = spect[:,0] + nu.inf
-            else:
-                out[str(ii)] = nu.copy(spect[:,index[0] + 1])
-        #run 2 d interp
-        else:
-            metal.sort()
-            metal = nu.array(metal)[nu.array([0, 3, 1, 2], dtype =
-                                             'int32')]
-            age.sort()
-            
-            for i in xrange(4):
-                index = nu.nonzero(nu.logical_and(lib_vals[0][:, 1] ==
-                                                  age[i],
-                                                  lib_vals[0][:, 0] ==
-                                                   metal[i]))[0]
-                if len(index)<1: #if not in lib_vals return dummy array
-                    out[str(ii)] = spect[:, 0] + nu.inf
-                    interp = False
-                    break
-                else:
-                    closest.append(spect[:, index[0] + 1])
-                    interp = True
-            if interp:
-                out[str(ii)] = bilinear_interpolation( metal, age
-                                                      , closest,
-                                                      temp_param[0],
-                                                      temp_param[1])
+        out[str(ii)] = ssps[ii]
     #give wavelength axis
     out['wave'] = nu.copy(spect[:, 0])
 
@@ -260,66 +467,166 @@ def ez_to_rj(SSP):
 
     return info, spect
 
+###spectral lib registry####
+#ez_to_rj output is saved here so other processes skip EZGAL
+LIB_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.agedate_cache')
+_ssp_registry = {}
+
+def find_ezgal_models(spec_lib, imf, spec_lib_path):
+    '''(str, str, str) -> list
+    EZGAL model files for spec_lib and imf in spec_lib_path'''
+    cur_lib = ['basti', 'bc03', 'cb07','m05','c09','p2']
+    assert spec_lib.lower() in cur_lib, ('%s is not in ' %spec_lib.lower() + str(cur_lib))
+    if not spec_lib_path.endswith('/') :
+        spec_lib_path += '/'
+    models = glob(spec_lib_path+spec_lib+'*'+imf+'*')
+    if len(models) == 0:
+        models = glob(spec_lib_path+spec_lib.lower()+'*'+imf+'*')
+    assert len(models) > 0, "Did not find any models"
+    return models
+
+def get_ssp_lib(spec_lib, imf, spec_lib_path, cache_dir=LIB_CACHE_DIR):
+    '''(str, str, str, str) -> SSP_index
+    Shared SSP_index of an EZGAL library. Made once per process for each
+    (spec_lib, imf, path, mtime), later calls return the same object so
+    its lib_vals and spect are read only. The ez_to_rj output is stored
+    in cache_dir as a binary library (see save_spec_lib), cache_dir=None
+    turns off the disk cache.'''
+    key, models = _ssp_key(spec_lib, imf, spec_lib_path)
+    if key not in _ssp_registry:
+        lib_vals, spect = _load_ssp_cache(key, models, cache_dir)
+        _ssp_registry[key] = SSP_index(lib_vals, spect)
+    return _ssp_registry[key]
+
+def _ssp_key(spec_lib, imf, spec_lib_path):
+    '''Registry key and model files of a library'''
+    models = find_ezgal_models(spec_lib, imf, spec_lib_path)
+    mtime = max(os.path.getmtime(i) for i in models)
+    return (spec_lib.lower(), imf, os.path.abspath(spec_lib_path),
+            mtime), models
+
+def register_ssp_lib(spec_lib, imf, spec_lib_path, lib_vals, spect):
+    '''(str, str, str, list(ndarray,ndarray), ndarray) -> SSP_index
+    Makes lib_vals and spect (like ez_to_rj output, e.g. a synthetic
+    library) the library get_ssp_lib gives for spec_lib and imf in
+    spec_lib_path. Model files there are only globbed, so can be empty'''
+    key = _ssp_key(spec_lib, imf, spec_lib_path)[0]
+    _ssp_registry[key] = SSP_index(lib_vals, spect)
+    return _ssp_registry[key]
+
+def _load_ssp_cache(key, models, cache_dir):
+    '''Loads ez_to_rj output of models from cache_dir, or makes it with
+    EZGAL and tries to save it there'''
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, '%s_%s_%x%s'%(
+            key[0], key[1], abs(hash((tuple(sorted(models)), key[3]))),
+            LIB_EXT))
+        if os.path.exists(path):
+            spect, names, header = open_spec_lib(path)
+            return [header['index'], None], spect
+    SSP = gal.wrapper(models)
+    #make sure is matched for interpolatioin
+    SSP.is_matched = True
+    lib_vals, spect = ez_to_rj(SSP)
+    lib_vals[0].setflags(write=False)
+    spect.setflags(write=False)
+    if path is not None:
+        #index is log10 metal and age, names have linear metal
+        names = ['ssp_%1.4f_%1.6f.spec'%(10**metal, age)
+                 for metal, age in lib_vals[0]]
+        temp = '%s.%i'%(path, os.getpid())
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            #rename so other processes never see a partly written file
+            save_spec_lib(temp, spect, names, lib_vals[0])
+            os.rename(temp, path)
+        except (IOError, OSError):
+            pass
+    return lib_vals, spect
+
 #@profile
-def make_burst(length, T, metal, lib_vals, spect):
+def make_burst(length, T, metal, lib_vals, spect, lib_index=None):
     '''def make_burst(length, t, metal, lib_vals,spect)
     (float, float,float, list(ndarray,ndarry),ndarray) -> ndarray(float)
 Turns SSP into busrt of constant stellar formation and of length dt at
 age t for a const metalicity 10**(t-9) - length/2 to 10**(t-9) + length/2.
 All terms are logrythmic.
+lib_index is a SSP_index of lib_vals and spect, made if not given.
 '''
-    #set up boundaries
-    age_unq = nu.unique(lib_vals[0][:,1])
-    t = 10**T
-    #metal = 10**Metal
-    metal_unq = nu.unique(lib_vals[0][:,0])
-    if T < age_unq.min() or T > age_unq.max():
-		#Age not in range
-		return spect[:,0] +  nu.inf
-    if metal < metal_unq.min() or metal > metal_unq.max():
-		#Metalicity not in range
-		return spect[:,0] +  nu.inf
-	#get all ssp's with correct age range and metalicity
-	#min age range
-    if (T - length/2.) < age_unq.min():
-		t_min = age_unq.min() + 0.
-    else:
-		t_min = T - length/2.
-	#max age range
-    if 	T + length/2. > age_unq.max():
-		t_max = age_unq.max() + 0.
-    else:
-		t_max = T + length/2.
-    index = nu.searchsorted(age_unq, [t_min,t_max])
-    ages = age_unq[index[0]:index[1]]
-	#get SSP's
-	
-	#handel situation where stepsize is small
-    if len(ages) < 10:
-        ages = nu.linspace(t_min,t_max,10)
-    temp_param = []
-    #get ssp's
-    try:
-        #param [[metal,age,norm]]
-        for i in ages:
-            temp_param.append([metal,i,0]) 
-        ssps = get_model_fit_opt(temp_param, lib_vals, age_unq, metal_unq,
-                                ages.shape[0],spect)
-        ssps.pop('wave')
-        #sort for simps
-        ssp = nu.zeros((ages.shape[0],ssps['0'].shape[0]))
-        for i in xrange(ages.shape[0]):
-            ssp[i] = ssps[str(i)]
-        ages = 10**ages
-    except ValueError as e:
-        #interp failed
-        print e
-        return spect[:,0] +  nu.inf
-    #integrate and normalize
-    #del ssps,ages, age_unq,metal_unq
-    return simps(ssp, ages, axis=0)/(ages.ptp())
-    
+    if lib_index is None:
+        lib_index = SSP_index(lib_vals, spect)
+    return make_bursts([[length, T, metal, 0]], lib_index)[0]
+
+
+_simps_cache = {}
+def simps_weights(n):
+    '''(int) -> ndarray
+    Composite Simpson weights for n evenly spaced points on [0, 1].
+    n must be odd. Weights are cached after the first call.'''
+    if n not in _simps_cache:
+        if n < 3 or n % 2 == 0:
+            raise ValueError('Simpson rule needs an odd number of points')
+        w = nu.ones(n)
+        w[1:-1:2] = 4.
+        w[2:-1:2] = 2.
+        _simps_cache[n] = w / (3. * (n - 1))
+    return _simps_cache[n]
+
+def make_bursts(params, lib_index, nsamp=None):
+    '''(ndarray, SSP_index, int) -> ndarray
+    Batched make_burst. params is (nbins, 4) [length, t, metal, norm] like
+    the rows of VESPA_fit's gal array (norm is not applied). Returns
+    (nbins, nwave) array of bursts, rows are inf if a burst is out of the
+    library range.
 
+    By default bursts are differences of lib_index's cumulative spectra.
+    If nsamp is given each burst is instead integrated over linear age
+    with Simpson's rule on nsamp points evenly spaced in log age, with the
+    weight of every ssp needed by every burst put into one
+    (nbins, ncolumns) matrix so the bursts are made with a single gather
+    and matrix product.'''
+    params = nu.atleast_2d(nu.asarray(params, dtype=float))
+    nbins = params.shape[0]
+    length, T, metal = params[:, 0], params[:, 1], params[:, 2]
+    age_unq, metal_unq = lib_index.age_unq, lib_index.metal_unq
+    bad = nu.logical_not(lib_index.in_range(metal, T))
+    #move bad bins into range so the interpolation doesn't fail
+    T = nu.where(bad, age_unq[0], T)
+    metal = nu.where(bad, metal_unq[0], metal)
+    t_min = nu.maximum(T - length / 2., age_unq[0])
+    t_max = nu.minimum(T + length / 2., age_unq[-1])
+    if nsamp is None:
+        out = lib_index.burst(metal, t_min, t_max)
+        out[bad] = nu.inf
+        return out
+    #simpson nodes in log age and weights for integral over linear age
+    frac = nu.linspace(0, 1, nsamp)
+    ages = t_min[:, None] + (t_max - t_min)[:, None] * frac
+    width = 10**t_max - 10**t_min
+    weights = (simps_weights(nsamp) * nu.log(10) * 10**ages *
+               (t_max - t_min)[:, None])
+    #zero length burst is just the ssp
+    single = width <= 0
+    weights[single] = simps_weights(nsamp)
+    weights[~single] /= width[~single, None]
+    #get interpolation corners and weights for all nodes at once
+    columns, interp_w = lib_index.bracket(nu.repeat(metal, nsamp),
+                                          ages.ravel())
+    missing = nu.logical_and(columns < 0, interp_w > 0)
+    bad[missing.reshape(nbins, -1).any(1)] = True
+    columns[columns < 0] = 1
+    interp_w *= weights.reshape(-1, 1)
+    #sum weights for each column of spect used by each bin
+    col_unq, inverse = nu.unique(columns, return_inverse=True)
+    row = nu.repeat(nu.arange(nbins), nsamp * 4)
+    W = nu.bincount(row * col_unq.shape[0] + inverse.ravel(),
+                    interp_w.ravel(), nbins * col_unq.shape[0])
+    out = nu.dot(W.reshape(nbins, col_unq.shape[0]),
+                 lib_index.spect[:, col_unq].T)
+    out[bad] = nu.inf
+    return out
 
 def make_numeric( age, sfh, max_bins, metals=None, return_param=False):
         '''(ndarray,ndarray,ndarray,int,ndarray or None) -> ndarray
@@ -366,31 +673,15 @@ def make_numeric( age, sfh, max_bins, metals=None, return_param=False):
             return out
         
 def random_permute(seed):
-    '''(seed (int)) -> int
-    does random sequences to produice a random seed for parallel programs'''
-    ##middle squared method
-    seed = str(seed**2)
-    while len(seed) < 7:
-        seed=str(int(seed)**2)
-    #do more randomization
-    ##multiply with carry
-    a,b,c = int(seed[-1]), 2**32, int(seed[-3])
-    i = 0
-    while a == 0:
-        a = int(seed[-i])
-        i+=1
-    j = nu.random.random_integers(4, len(seed))
-    for i in range(int(seed[-j:-j+3])):
-        seed = (a*int(seed) + c) % b
-        c = (a * seed + c) / b
-        seed = str(seed)
-    return int(seed)
+    '''(seed (int)) -> ndarray
+    Seed of random stream for a parallel program from seed (rank or
+    index of worker), same as Age_RJMCMC.random_permute'''
+    return stream_seed('random_permute', seed)
 
 def data_match_all(data, spect):
     '''makes sure data and model have same 
     wavelength range and points for library. Removes uncertanties = 0
     from data and lib spec'''
-    model = {}
     #remove sigma = 0
     if data.shape[1] == 3:
         if nu.sum(data[:,2] == 0) > 0:
@@ -398,68 +689,73 @@ def data_match_all(data, spect):
  
     out_data = nu.copy(data)
     #make spect_lib correct shape for changing
-    for i in xrange(spect[0, :].shape[0]):
-        if i == 0:
-            model['wave'] = nu.copy(spect[:, i])
-        else:
-            model[str(i - 1)] = nu.copy(spect[:, i])
+    model = SpectralModel(spect[:, 0], spect[:, 1:].T)
    #check to see if data wavelength is outside of spectra lib
-    min_index = nu.searchsorted(model['wave'], out_data[0, 0])
-    max_index = nu.searchsorted(model['wave'], out_data[-1, 0])
+    min_index = nu.searchsorted(model.wave, out_data[0, 0])
+    max_index = nu.searchsorted(model.wave, out_data[-1, 0])
     if min_index == 0: #data is bellow spectra lib
         print ('Spectra Library has does not go down to the same'
                + ' wavelength as input spectrum.')
-        out_data = data[nu.searchsorted(model['wave'], out_data[:, 0])
+        out_data = data[nu.searchsorted(model.wave, out_data[:, 0])
                         > 0, :]
     #data goes above spectra lib
-    if max_index == model['wave'].shape[0]: 
+    if max_index == model.wave.shape[0]: 
         print ('Spectra Library has does not go up to the same '
                +  'wavelength as input spectrum.')
-        out_data = out_data[nu.searchsorted(model['wave'], 
+        out_data = out_data[nu.searchsorted(model.wave, 
                                             out_data[:,0]) <
-                            model['wave'].shape[0], :]
+                            model.wave.shape[0], :]
     #interpolate spectra lib so it has same wavelength axis as data 
-    model = data_match(out_data, model,spect[0, :].shape[0] - 1)
-    out = nu.zeros([model['0'].shape[0], len(model.keys()) + 1])
-    out[:, 0] = nu.copy(out_data[:, 0])
-    for i in model.keys():
-        out[:, int(i) + 1] = model[i]
-    spect = nu.copy(out)
+    model = data_match(out_data, model)
+    spect = nu.column_stack((model.wave, model.flux.T))
     return spect, out_data
 
-def data_match(data, model, keep_wave=False, rebin=True):
-   '''(ndarray,dict(ndarray),bool) -> dict(ndarray)
+def data_match(data, model, keep_wave=False, rebin=True, op_cache=None):
+   '''(ndarray,SpectralModel or dict(ndarray),bool,bool,dict or None) ->
+   SpectralModel or dict
    Makes sure data and model have same wavelength range 
-    and points but with a dictionary
+    and points. A SpectralModel is changed in place and gets the data
+    wavelengths, for a dict keep_wave says if 'wave' is kept.
     assumes model wavelength range is longer than data.
-    Keeps intergrated flux the same'''
-   
-   out = {}
+    Keeps intergrated flux the same. op_cache is a dict to keep rebinning
+    operators in between calls.'''
+   if isinstance(model, dict):
+      return data_match(data, SpectralModel.from_dict(model), rebin=rebin,
+                        op_cache=op_cache).to_dict(keep_wave)
     #if they have the same x-axis
-   if nu.all(model['wave'] == data[:, 0]):
-      for i in model.keys():
-          if i == 'wave':
-              continue
-          out[i] = model[i]
-   else:
+   if not (model.wave.shape == data[:, 0].shape and
+           nu.all(model.wave == data[:, 0])):
      #not same shape, interp or rebin flux (correct way)
-      for i in model.keys():
-        if i == 'wave':
-          continue
-        if rebin:
-            out[i] = rebin_spec(model['wave'], model[i], data[:,0])
-        else:
-          # interpolate
-          out[i] = linear_interpolation(model['wave'], model[i], data[:,0])
-          
-   if keep_wave:
-      out['wave'] = nu.copy(data[:,0])
-   return out
+      if rebin:
+         op = cached_rebin_operator(model.wave, data[:, 0], op_cache)
+         model.flux = op.dot(model.flux.T).T
+      else:
+        # interpolate
+        out = nu.empty((model.flux.shape[0], data.shape[0]))
+        for i in xrange(model.flux.shape[0]):
+          out[i] = linear_interpolation(model.wave, model.flux[i], data[:,0])
+        model.flux = out
+   model.wave = nu.copy(data[:,0])
+   return model
 
 def redshift(wave, redshift):
    #changes redshift of models
    return wave * (1. + nu.asarray(redshift))
 
+def redshift_flux(wave, flux, redshift):
+    '''(ndarray, ndarray, float) -> ndarray
+    Flux of (n, len(wave)) spectra after redshifting, sampled on the same
+    wavelengths by linear interpolation. Keeps the wavelength grid fixed
+    so cached operators made from it are reused for every redshift.
+    Wavelengths bluer than the shifted grid get the first flux point.'''
+    flux = nu.atleast_2d(flux)
+    rest = wave / (1. + redshift)
+    lower = nu.clip(nu.searchsorted(wave, rest, 'right') - 1, 0,
+                    wave.shape[0] - 2)
+    weight = nu.clip((rest - wave[lower]) / (wave[lower + 1] - wave[lower]),
+                     0, 1)
+    return flux[:, lower] * (1 - weight) + flux[:, lower + 1] * weight
+
 def normalize(data, model):
     #normalizes the model spectra so it is closest to the data
     if data.shape[1] == 2:
@@ -477,25 +773,25 @@ def N_normalize(data, model, bins):
     
     #match data axis with model already done by program
     #need to remove 'wave' key since no data_match_new
-    if model.has_key('wave'):
-        model.pop('wave')
+    if isinstance(model, dict):
+        if model.has_key('wave'):
+            model.pop('wave')
+        model = SpectralModel.from_dict(model)
+    #components are already in age order
+    flux = model.flux
     #do non-negitave least squares fit
     if bins == 1:
-        N = [normalize(data, model['0'])]
-        return N, nu.sum((data[:, 1] - N[0] * model['0']) ** 2)
+        N = [normalize(data, flux[0])]
+        return N, nu.sum((data[:, 1] - N[0] * flux[0]) ** 2)
     try:
         #if data has only wavelength and flux axis
         if data.shape[1] == 2:
-            N, chi = nnls(nu.array(model.values()).T[:, 
-                    nu.argsort(nu.int64(nu.array(model.keys())))],
-                          data[:, 1])
+            N, chi = nnls(flux.T, data[:, 1])
         #if data has wave,flux and uncertanty axis
         elif data.shape[1] == 3:
             #from P Dosesquelles1, T M H Ha1, A Korichi1,
             #F Le Blanc2 and C M Petrache 2009
-            N , chi = nnls(nu.array(model.values()).T[:, 
-                    nu.argsort(nu.int64(nu.array(model.keys())))] /
-                           nu.tile(data[:, 2], (bins, 1)).T,data[:,1]
+            N , chi = nnls(flux.T / data[:, 2][:, None], data[:,1]
                            / data[:,2]) 
         else:
             print 'wrong data shape'
@@ -503,10 +799,10 @@ def N_normalize(data, model, bins):
 
     except RuntimeError:
         print "nnls error"
-        N = nu.zeros([len(model.keys())])
+        N = nu.zeros([flux.shape[0]])
         chi = nu.inf
     except ValueError:
-        N = nu.zeros([len(model.keys())])
+        N = nu.zeros([flux.shape[0]])
         chi = nu.inf
     #N[N==0] += 10 ** -6 #may cause problems in data[:,1]<10**-6 and not == 0
     #for numpy version 1.6
@@ -515,6 +811,51 @@ def N_normalize(data, model, bins):
     except OverflowError:
         return N, chi
     
+def nnls_gram(G, b, passive=None):
+    '''(ndarray, ndarray, ndarray(bool)) -> ndarray
+    Non-negative least squares from the normal equations G = A^T W A and
+    b = A^T W y (Lawson and Hanson active set). passive is a guess of which
+    amplitudes are positive, like the mask of the last solution, the solve
+    starts from it so nearby problems take only a few iterations.
+    '''
+    n = b.shape[0]
+    tol = 10 * nu.finfo(float).eps * max(nu.abs(G).max(), 1.) * n
+    def solve(P):
+        #least squares on the passive set
+        z = nu.zeros(n)
+        if nu.any(P):
+            try:
+                z[P] = nu.linalg.solve(G[nu.ix_(P, P)], b[P])
+            except nu.linalg.LinAlgError:
+                z[P] = nu.linalg.lstsq(G[nu.ix_(P, P)], b[P], rcond=None)[0]
+        return z
+    #warm start, drop guesses that are not positive until all are
+    P = nu.zeros(n, dtype=bool)
+    if passive is not None:
+        P[:] = passive
+    x = solve(P)
+    while nu.any(P & (x <= 0)):
+        P &= x > 0
+        x = solve(P)
+    for itter in xrange(3 * n + 1):
+        #negative gradient
+        w = b - nu.dot(G, x)
+        if nu.all(P) or nu.all(w[~P] <= tol):
+            break
+        P[nu.argmax(nu.where(P, -nu.inf, w))] = True
+        while True:
+            z = solve(P)
+            if nu.all(z[P] > 0):
+                x = z
+                break
+            #step back to feasible region
+            neg = P & (z <= 0)
+            alpha = nu.min(x[neg] / (x[neg] - z[neg]))
+            x += alpha * (z - x)
+            P &= x > tol
+            x[~P] = 0
+    return x
+
 def multivariate_student(mu,sigma,n):
     #samples from a multivariate student t distriburtion
     #with mean mu,sigma as covarence matrix, and n is degrees of freedom
@@ -579,36 +920,40 @@ def dict_size(dic):
     return size
 
 def dust(param, model):
-    '''(ndarray, dict(ndarray)) -> ndarray
+    '''(ndarray, SpectralModel or dict(ndarray)) -> SpectralModel or dict
     
     Applies 2 componet dust model following charlot and fall 2000 on model
-    returns same shape as model
+    in place, returns same type as model
     
-    Keys of the model dict should be age of ssp.
+    Components younger than t_bc get birth cloud and ism dust, others
+    only ism. Keys of a dict model should be age of ssp.
     
     param is dust parameters [tau_bc, tau_ism]
     '''
+    if isinstance(model, dict):
+        return dust(param, SpectralModel.from_dict(model)).to_dict()
     t_bc = 7.4771212547196626 #log10(.03*10**9)
     if nu.any(param[-2:] <= 0):
         return model
-    #set all itterated varibles for speed
-    bins = (param.shape[0] - 2) / 3
-    tau_lam = (model['wave'] / 5500.) ** (-.7)
-    T_ism = f_dust(param[1] * tau_lam)
-    T_bc = f_dust(param[0] * tau_lam)
-    for i in model.keys():
-        if i == 'wave':
-            continue 
-        #choose which combo of dust models to use
-        if float(i) <= t_bc: 
-            #fdust*fbc
-            model[i] *= T_ism * T_bc
-        else:
-            #fdust
-            model[str(i)] *= T_ism
+    T_ism = dust_curve(param[1], model.wave)
+    T_bc = dust_curve(param[0], model.wave)
+    young = model.age <= t_bc
+    #fdust*fbc for young, fdust for the rest in one multiply
+    model.flux *= nu.where(young[:, None], T_ism * T_bc, T_ism)
     return model
 
-#@memoized
+@memoized
+def tau_lambda(wave):
+    '''(ndarray) -> ndarray
+    Wavelength dependence of optical depth, made once per wavelength grid'''
+    return (wave / 5500.) ** (-.7)
+
+@memoized(quantize={'tau': 1e-4})
+def dust_curve(tau, wave):
+    '''(float, ndarray) -> ndarray
+    Dust transmission on wavelength grid for optical depth tau at 5500A'''
+    return f_dust(tau * tau_lambda(wave))
+
 def f_dust(tau): 
     '''(ndarray) -> ndarray
     Dust extinction functin'''
@@ -624,7 +969,7 @@ def f_dust(tau):
     out[tau > 1] = nu.exp(-tau[tau > 1])
     return out
 
-#@memoized
+@memoized(quantize={'sigma': .1, 'vel': .1, 'h3': 1e-3, 'h4': 1e-3})
 def gauss_kernel(resol,sigma,vel=0,h3=0,h4=0):
     '''sigma:     Dispersion velocity in km/s. Defaulted to 1.
     h3, h4:       Gauss-Hermite coefficients. Defaulted to 0.
@@ -656,47 +1001,65 @@ def gauss_kernel(resol,sigma,vel=0,h3=0,h4=0):
        slitout /= Sum
     return slitout
 
-def LOSVD(model, param, wave_range,resolution):
-    '''(dict(ndarray), ndarray, ndarray) -> dict(ndarray)
+def LOSVD(model, param, wave_range,resolution, op_cache=None):
+    '''(SpectralModel or dict(ndarray), ndarray, ndarray) -> SpectralModel
+    or dict(ndarray)
 
     Convolves data with a gausian with dispersion of sigma, velocity, and hermite poly
     of h3 and h4
 
-    model is dict of ssp with ages being the keys
+    model is SpectralModel, changed in place, or dict of ssp with ages
+    being the keys
     param is a 4x1 flat array with params of losvd [log10(sigma), v , h3, h4]
     wave_range is gives edge support for convolution
     resolution is the resolution of spectra in km/s
+    op_cache is a dict to keep the log lambda resampling operators in
     '''
+    if isinstance(model, dict):
+        return LOSVD(SpectralModel.from_dict(model), param, wave_range,
+                     resolution, op_cache).to_dict()
     #find wavelength range to do convolution for
     wave_range = nu.array(wave_range) - nu.asarray([100, -100])
-    index = nu.searchsorted(model['wave'], [wave_range[0], wave_range[1]])
-    wave = nu.copy(model['wave'][index[0]:index[1]])
-    #convolve each spectra
-    sum_spec = {'wave':wave}
-    tparam = param.copy()
+    index = nu.searchsorted(model.wave, [wave_range[0], wave_range[1]])
+    wave = nu.copy(model.wave[index[0]:index[1]])
+    #convolve all spectra at once
+    tparam = nu.array(param, dtype=float)
     tparam[0] = 10**tparam[0]
-    for i in model.keys():
-        if i == 'wave':
-            continue
-        sum_spec[i] = fft_conv(wave,model[i][index[0]:index[1]],resolution,tparam)
-    return sum_spec
+    model.flux = fft_conv(wave, model.flux[:, index[0]:index[1]],
+                          resolution, tparam, op_cache)
+    model.wave = wave
+    return model
 
-def fft_conv(x, y, vs, losvd_param):
+def fft_conv(x, y, vs, losvd_param, op_cache=None):
     '''
-    (wavelength,flux,velocity scale,losvd parameters) -> convolved flux
+    (wavelength,flux,velocity scale,losvd parameters, dict or None) ->
+    convolved flux
     Does LOSVD convolution by rebinning the wavelength into log scale and
-    taking the fft to convolve it.
+    taking the fft to convolve it. y can be 1 spectra or (n, len(x)) array
+    of them. The resampling operators to and from log scale are kept in
+    op_cache if given.
     '''
+    y = nu.asarray(y, dtype=float)
     #make logspaced
-    lx,ly = logify(x,y)
-    #lx,ly = x,y
+    lx = nu.logspace(nu.log10(x.min()), nu.log10(x.max()), len(x))
+    to_log = cached_rebin_operator(x, lx, op_cache)
+    #rebin back to linear, same as linearize
+    from_log = cached_rebin_operator(
+        lx, nu.linspace(lx.min(), lx.max(), len(lx)), op_cache)
+    ly = to_log.dot(nu.atleast_2d(y).T).T
     #make kernelresol,sigma,vel=0,h3=0,h4=0
     kernel = gauss_kernel(vs,losvd_param[0],losvd_param[2],losvd_param[3])
-    #convolve fast
-    ys = nu.convolve(ly,kernel,'same')
+    #convolve with fft, same output as nu.convolve(ly, kernel, 'same')
+    n_fft = next_fast_len(ly.shape[1] + kernel.shape[0] - 1)
+    ys = nu.fft.irfft(nu.fft.rfft(ly, n_fft, axis=1) *
+                      nu.fft.rfft(kernel, n_fft), n_fft, axis=1)
+    start = (kernel.shape[0] - 1) // 2
+    ys = ys[:, start:start + ly.shape[1]]
     #rebin to match input
-    #return rebin_spec(lx,ys,x)
-    return linearize(lx,ys)[1]
+    ys = from_log.dot(ys.T).T
+    if y.ndim == 1:
+        return ys[0]
+    return ys
     
 ##not mine
 def rebin_spec(wave, specin, wavnew):
@@ -710,6 +1073,72 @@ def rebin_spec(wave, specin, wavnew):
  
     return obs.binflux
 
+def rebin_operator(wave, wavnew):
+    '''(ndarray, ndarray) -> scipy.sparse.csr_matrix
+    Sparse (len(wavnew), len(wave)) matrix of overlap weights so that
+    rebin_operator(wave, wavnew).dot(specin) is rebin_spec(wave, specin,
+    wavnew). Does the same flux conserving integral as pysynphot's binflux
+    with force='taper', the spectra is linear between points and goes to
+    zero one step past each end, and wavnew are bin centers. Unlike
+    pysynphot negative fluxes are not set to zero.
+    '''
+    wave = nu.asarray(wave, dtype=float)
+    wavnew = nu.asarray(wavnew, dtype=float)
+    #taper with same ratio as 2 end points
+    taper = nu.hstack((wave[0]**2 / wave[1], wave, wave[-1]**2 / wave[-2]))
+    edges = nu.empty(wavnew.shape[0] + 1)
+    edges[1:-1] = (wavnew[1:] + wavnew[:-1]) / 2.
+    edges[0] = 2 * wavnew[0] - edges[1]
+    edges[-1] = 2 * wavnew[-1] - edges[-2]
+    merged = nu.union1d(nu.union1d(taper, edges), wavnew)
+    #linear interpolation of tapered spectra onto merged points
+    inside = nu.logical_and(merged >= taper[0], merged <= taper[-1])
+    lower = nu.clip(nu.searchsorted(taper, merged, 'right') - 1, 0,
+                    taper.shape[0] - 2)
+    weight = (merged - taper[lower]) / (taper[lower + 1] - taper[lower])
+    rows = nu.arange(merged.shape[0])
+    sample = sparse.csr_matrix((nu.hstack(((1 - weight)[inside],
+                                           weight[inside])),
+                                (nu.hstack((rows[inside], rows[inside])),
+                                 nu.hstack((lower[inside],
+                                            lower[inside] + 1)))),
+                               shape=(merged.shape[0], taper.shape[0]))
+    #trapezoid rule over segments in each bin
+    dw = nu.diff(merged)
+    seg = nu.arange(dw.shape[0])
+    in_bin = nu.searchsorted(edges, merged[:-1], 'right') - 1
+    use = nu.logical_and(in_bin >= 0, in_bin < wavnew.shape[0])
+    width = nu.bincount(in_bin[use], dw[use], wavnew.shape[0])
+    width[width == 0] = 1.
+    area = sparse.csr_matrix(((dw / 2.)[use] / width[in_bin[use]],
+                              (in_bin[use], seg[use])),
+                             shape=(wavnew.shape[0], merged.shape[0] - 1))
+    trap = sparse.hstack((area, sparse.csr_matrix((wavnew.shape[0], 1))))
+    trap = trap + sparse.hstack((sparse.csr_matrix((wavnew.shape[0], 1)),
+                                 area))
+    #tapered end points are 0
+    return sparse.csr_matrix(trap.dot(sample)[:, 1:-1])
+
+def grid_key(wave):
+    '''(ndarray) -> tuple
+    Hashable key of a wavelength grid for caching things made from it'''
+    wave = nu.ascontiguousarray(wave, dtype=float)
+    return (wave.shape[0], wave.tostring())
+
+def cached_rebin_operator(wave, wavnew, cache=None, max_size=100):
+    '''(ndarray, ndarray, dict or None, int) -> scipy.sparse.csr_matrix
+    rebin_operator that is kept in cache, a dict on the caller, so it is
+    only made once for each pair of grids. Cache is cleared if it gets
+    bigger than max_size.'''
+    if cache is None:
+        return rebin_operator(wave, wavnew)
+    key = grid_key(wave) + grid_key(wavnew)
+    if key not in cache:
+        if len(cache) >= max_size:
+            cache.clear()
+        cache[key] = rebin_operator(wave, wavnew)
+    return cache[key]
+
 #https://github.com/eteq/astropysics/blob/master/astropysics/spec.py
 
 def getDx(x,mean=True):